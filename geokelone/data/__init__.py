@@ -4,15 +4,29 @@ Collection of data helpers
 """
 
 
+from . import alternates
+from . import binary
+from . import compact
+from . import database
 from . import geonames
+from . import ingest
 from . import load
+from . import registers
+from . import update
 from . import utils
 from . import validators
 from . import wikipedia
 
 __all__ = [
+    'alternates',
+    'binary',
+    'compact',
+    'database',
     'geonames',
+    'ingest',
     'load',
+    'registers',
+    'update',
     'utils',
     'validators',
     'wikipedia',
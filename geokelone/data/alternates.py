@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Language-aware alternate names from the Geonames file alternateNamesV2.
+"""
+
+# compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# standard
+import logging
+import sys
+
+# own
+from .. import settings
+from . import validators
+from .compact import PostingsBuilder
+from .ingest import iterlines
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+# columns: alternateNameId, geonameid, isolanguage, alternate name, isPreferredName, isShortName, isColloquial, isHistoric, from, to
+NUM_COLUMNS = 10
+
+
+def iteralternates(filename, language=None, historic=True, short=True, colloquial=False, ids=None):
+    """
+    Stream an alternateNamesV2 file (text or ZIP archive) and yield (Geonames ID, name) pairs
+    for a given language (default: settings.LANGUAGE), optionally restricted to known IDs.
+    Historic, short and colloquial names can be left out.
+    """
+    if language is None:
+        language = settings.LANGUAGE
+    language = language.lower()
+    j, k = 0, 0
+    for line in iterlines(filename):
+        j += 1
+        columns = line.decode('utf-8').rstrip('\n').split('\t')
+        if len(columns) < NUM_COLUMNS - 2:
+            logger.debug('malformed: %s', columns)
+            continue
+        # language filter
+        if columns[2] != language:
+            continue
+        if ids is not None and columns[1] not in ids:
+            continue
+        # flags
+        if (historic is False and columns[7] == '1') or (short is False and columns[5] == '1') or (colloquial is False and columns[6] == '1'):
+            continue
+        if validators.validate_entry(columns[3]) is False:
+            continue
+        k += 1
+        yield columns[1], columns[3]
+    logger.info('%s alternate names seen, %s selected', j, k)
+
+
+def load_alternates(filename, metainfo=None, codesdict=None, compact=False, **filters):
+    """
+    Index alternate names by Geonames ID, restricted to the entries of a metainfo register if given.
+    Names are added to an existing codes register or stored in a new dictionary,
+    or in a read-only table of integer postings (compact option, see compact.CodesTable).
+    See iteralternates for the filters.
+    """
+    if compact is True:
+        builder = PostingsBuilder()
+        for nameid, name in iteralternates(filename, ids=metainfo, **filters):
+            builder.add(name, nameid)
+        return builder.build()
+    if codesdict is None:
+        codesdict = dict()
+    for nameid, name in iteralternates(filename, ids=metainfo, **filters):
+        # share the ID strings
+        nameid = sys.intern(nameid)
+        if name not in codesdict:
+            codesdict[name] = list()
+        if isinstance(codesdict[name], set):
+            codesdict[name].add(nameid)
+        elif nameid not in codesdict[name]:
+            codesdict[name].append(nameid)
+    logger.info('different codes: %s', len(codesdict))
+    return codesdict
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Binary gazetteer format, written once and opened with mmap for instant startup.
+"""
+
+# compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# standard
+import logging
+import mmap
+import struct
+
+# external
+import numpy as np
+
+# own
+from .compact import CodesTable, MetaInfoTable, TableBuilder
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+MAGIC = b'GEOKLN01'
+# sections of the file: name, type of the values
+SECTIONS = (
+    ('ids', np.int64),
+    ('lat', np.float32),
+    ('lon', np.float32),
+    ('population', np.int64),
+    ('ftype', np.uint8),
+    ('country', 'S2'),
+    ('name_offsets', np.uint64),
+    ('post_offsets', np.uint64),
+    ('postings', np.int64),
+    ('names', np.uint8),
+)
+# magic string, then offset and number of items for each section
+HEADER = struct.Struct('<8s' + 'QQ' * len(SECTIONS))
+ALIGNMENT = 8
+
+
+def write_gazetteer(filename, codesdict, metainfo):
+    """
+    Compile codes and metainfo registers into a binary file: fixed-width metainfo
+    columns sorted by ID, a sorted name table with offsets and the postings.
+    The registers are stored as they are, filter levels apply before compilation.
+    """
+    # metainfo columns
+    if not isinstance(metainfo, MetaInfoTable):
+        builder = TableBuilder()
+        for nameid, values in metainfo.items():
+            builder.append(nameid, *values[:5])
+        metainfo = builder.build()
+    # name table and postings
+    if not isinstance(codesdict, CodesTable):
+        codesdict = CodesTable.from_dict(codesdict)
+    columns = {
+        'ids': metainfo.ids,
+        'lat': metainfo.lat,
+        'lon': metainfo.lon,
+        'population': metainfo.population,
+        'ftype': metainfo.ftype,
+        'country': metainfo.country,
+        'name_offsets': codesdict.name_offsets,
+        'post_offsets': codesdict.post_offsets,
+        'postings': codesdict.postings,
+        'names': np.frombuffer(codesdict.names[0:len(codesdict.names)], dtype=np.uint8),
+    }
+    # layout
+    header = list()
+    position = HEADER.size
+    for section, dtype in SECTIONS:
+        position += -position % ALIGNMENT
+        header.extend((position, len(columns[section])))
+        position += np.dtype(dtype).itemsize * len(columns[section])
+    # write
+    with open(filename, 'wb') as outfh:
+        outfh.write(HEADER.pack(MAGIC, *header))
+        for (section, dtype), offset in zip(SECTIONS, header[::2]):
+            outfh.write(b'\0' * (offset - outfh.tell()))
+            outfh.write(np.ascontiguousarray(columns[section], dtype=dtype).tobytes())
+    logger.info('%s names and %s entries written to %s', len(codesdict), len(metainfo), filename)
+
+
+def load_gazetteer(filename):
+    """
+    Open a binary gazetteer file, the data is mapped into memory and shared between processes.
+    Returns read-only codes and metainfo registers.
+    """
+    with open(filename, 'rb') as inputfh:
+        mapped = mmap.mmap(inputfh.fileno(), 0, access=mmap.ACCESS_READ)
+    fields = HEADER.unpack_from(mapped)
+    if fields[0] != MAGIC:
+        raise ValueError('not a binary gazetteer: %s' % filename)
+    columns = dict()
+    for number, (section, dtype) in enumerate(SECTIONS):
+        offset, count = fields[1 + 2*number], fields[2 + 2*number]
+        columns[section] = np.frombuffer(mapped, dtype=dtype, count=count, offset=offset)
+    metainfo = MetaInfoTable(columns['ids'], columns['lat'], columns['lon'], columns['ftype'], columns['country'], columns['population'])
+    # names are read as bytes directly from the mapped file
+    names = _Section(mapped, fields[1 + 2*(len(SECTIONS) - 1)], len(columns['names']))
+    codesdict = CodesTable(names, columns['name_offsets'], columns['post_offsets'], columns['postings'])
+    logger.info('%s names and %s entries mapped from %s', len(codesdict), len(metainfo), filename)
+    return codesdict, metainfo
+
+
+class _Section(object):
+    """
+    Slice a part of a mapped file into bytes objects.
+    """
+    def __init__(self, mapped, start, length):
+        self.mapped = mapped
+        self.start = start
+        self.length = length
+
+    def __getitem__(self, index):
+        return self.mapped[self.start + index.start:self.start + index.stop]
+
+    def __len__(self):
+        return self.length
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Compact read-only structures for gazetteer data.
+"""
+
+# compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# standard
+import logging
+import re
+
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+from zlib import crc32
+
+# external
+import numpy as np
+
+# own
+from . import validators
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+class MetaInfoTable(Mapping):
+    """
+    Columnar store for Geonames metadata: sorted numeric IDs and typed arrays.
+    Rows are read like the entries of the dictionary version: metainfo[id][k]
+    gives latitude, longitude, feature class, country code and population.
+    """
+    def __init__(self, ids, lat, lon, ftype, country, population, precision=5):
+        self.ids = ids
+        self.lat = lat
+        self.lon = lon
+        self.ftype = ftype
+        self.country = country
+        self.population = population
+        # decimals of the coordinates stored as floats
+        self.precision = precision
+
+    @classmethod
+    def from_columns(cls, ids, lat, lon, ftype, country, population, coord_dtype=np.float32):
+        """
+        Build a table from unsorted columns, the last row wins for duplicate IDs.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        # keep the last occurrence of each ID
+        keep = np.append(ids[1:] != ids[:-1], True) if len(ids) else np.zeros(0, dtype=bool)
+        order = order[keep]
+        return cls(
+            ids[keep],
+            np.asarray(lat, dtype=coord_dtype)[order],
+            np.asarray(lon, dtype=coord_dtype)[order],
+            np.asarray(ftype, dtype=np.uint8)[order],
+            np.asarray(country, dtype='S2')[order],
+            np.asarray(population, dtype=np.int64)[order],
+        )
+
+    @classmethod
+    def from_rows(cls, rows, coord_dtype=np.float32):
+        """
+        Build a table from (id, lat, lon, type, country, population) tuples.
+        """
+        columns = TableBuilder()
+        for row in rows:
+            columns.append(*row)
+        return columns.build(coord_dtype)
+
+    @classmethod
+    def from_dict(cls, metainfo, coord_dtype=np.float32):
+        """
+        Convert a metainfo dictionary (ID: list of values).
+        """
+        return cls.from_rows(((key,) + tuple(values) for key, values in metainfo.items()), coord_dtype)
+
+    def index(self, key):
+        """
+        Return the row number of a Geonames ID or raise a KeyError.
+        """
+        try:
+            number = int(key)
+        except (TypeError, ValueError):
+            raise KeyError(key)
+        row = int(self.ids.searchsorted(number))
+        if row == len(self.ids) or self.ids.item(row) != number:
+            raise KeyError(key)
+        return row
+
+    def __getitem__(self, key):
+        row = self.index(key)
+        ftype = self.ftype.item(row)
+        return (
+            round(self.lat.item(row), self.precision),
+            round(self.lon.item(row), self.precision),
+            chr(ftype) if ftype else '',
+            self.country.item(row).decode('ascii'),
+            self.population.item(row),
+        )
+
+    def __contains__(self, key):
+        try:
+            self.index(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for number in self.ids.tolist():
+            yield str(number)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the arrays.
+        """
+        return sum(column.nbytes for column in (self.ids, self.lat, self.lon, self.ftype, self.country, self.population))
+
+
+class TableBuilder(object):
+    """
+    Accumulate metainfo rows in typed buffers before building a MetaInfoTable.
+    """
+    def __init__(self):
+        self.ids = array('q')
+        self.lat = array('d')
+        self.lon = array('d')
+        self.ftype = array('B')
+        self.country = bytearray()
+        self.population = array('q')
+
+    def append(self, nameid, lat, lon, ftype, country, population):
+        """
+        Add a row, values can be strings as in the Geonames files.
+        """
+        self.ids.append(int(nameid))
+        self.lat.append(float(lat))
+        self.lon.append(float(lon))
+        self.ftype.append(ord(ftype[0]) if ftype else 0)
+        self.country.extend(country.encode('ascii', 'replace')[:2].ljust(2, b'\0'))
+        self.population.append(int(population))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def build(self, coord_dtype=np.float32):
+        """
+        Convert the buffers to a table.
+        """
+        return MetaInfoTable.from_columns(
+            np.frombuffer(self.ids, dtype=np.int64),
+            np.frombuffer(self.lat, dtype=np.float64),
+            np.frombuffer(self.lon, dtype=np.float64),
+            np.frombuffer(self.ftype, dtype=np.uint8),
+            np.frombuffer(bytes(self.country), dtype='S2'),
+            np.frombuffer(self.population, dtype=np.int64),
+            coord_dtype,
+        )
+
+
+class CodesTable(Mapping):
+    """
+    Read-only postings for Geonames codes: a sorted table of UTF-8 names with
+    offsets into one array of integer IDs. Values are lists of string IDs as in
+    the dictionary version (name: [id1, id2, ...]).
+    """
+    def __init__(self, names, name_offsets, post_offsets, postings):
+        # names: concatenated UTF-8 strings sorted bytewise, any buffer which gives bytes when sliced
+        self.names = names
+        self.name_offsets = name_offsets
+        self.post_offsets = post_offsets
+        self.postings = postings
+        # optional hash index: sorted CRC32 values of the names and corresponding rows
+        self.hashes = None
+        self.rows = None
+
+    @classmethod
+    def from_dict(cls, codesdict):
+        """
+        Convert a codes dictionary (name: list or set of IDs), the order of the IDs is kept.
+        """
+        builder = PostingsBuilder()
+        for name, ids in codesdict.items():
+            for nameid in ids:
+                builder.add(name, nameid)
+        return builder.build()
+
+    def name(self, row):
+        """
+        Return the encoded name stored at a given row.
+        """
+        return self.names[self.name_offsets.item(row):self.name_offsets.item(row + 1)]
+
+    def build_index(self):
+        """
+        Compute the hash index used for faster lookups (4 bytes per name and the row numbers).
+        """
+        hashes = np.fromiter((crc32(self.name(row)) for row in range(len(self))), dtype=np.uint32, count=len(self))
+        order = np.argsort(hashes, kind='stable')
+        self.hashes = array('I', hashes[order].tobytes())
+        self.rows = array('I', order.astype(np.uint32).tobytes())
+
+    def index(self, key):
+        """
+        Return the row number of a name or raise a KeyError (hash index or binary search).
+        """
+        try:
+            encoded = key.encode('utf-8')
+        except AttributeError:
+            raise KeyError(key)
+        if self.hashes is not None:
+            value = crc32(encoded)
+            position = bisect_left(self.hashes, value)
+            while position < len(self.hashes) and self.hashes[position] == value:
+                if self.name(self.rows[position]) == encoded:
+                    return self.rows[position]
+                position += 1
+            raise KeyError(key)
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.name(middle) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(self) or self.name(low) != encoded:
+            raise KeyError(key)
+        return low
+
+    def ids(self, row):
+        """
+        Return the integer IDs stored at a given row.
+        """
+        return self.postings[self.post_offsets.item(row):self.post_offsets.item(row + 1)]
+
+    def __getitem__(self, key):
+        return [str(nameid) for nameid in self.ids(self.index(key)).tolist()]
+
+    def __contains__(self, key):
+        try:
+            self.index(key)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.name(row).decode('utf-8')
+
+    def __len__(self):
+        return len(self.name_offsets) - 1
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the arrays.
+        """
+        index = len(self.hashes) * 8 if self.hashes is not None else 0
+        return len(self.names) + self.name_offsets.nbytes + self.post_offsets.nbytes + self.postings.nbytes + index
+
+
+class PostingsBuilder(object):
+    """
+    Accumulate names and integer IDs before building a CodesTable:
+    each name is stored once, the pairs are kept in typed buffers.
+    """
+    def __init__(self):
+        self.numbers = dict()
+        self.pairs = array('q')
+        self.ids = array('q')
+
+    def add(self, name, nameid):
+        """
+        Add an ID to the postings of a name, duplicates are removed when the table is built.
+        """
+        number = self.numbers.get(name)
+        if number is None:
+            number = self.numbers[name] = len(self.numbers)
+        self.pairs.append(number)
+        self.ids.append(int(nameid))
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def build(self):
+        """
+        Sort the names and group the IDs, which stay in the order they were added.
+        """
+        names = sorted(name.encode('utf-8') for name in self.numbers)
+        # rank of each name number in the sorted table
+        ranks = np.empty(len(names), dtype=np.int64)
+        ranks[[self.numbers[name.decode('utf-8')] for name in names]] = np.arange(len(names))
+        rows = ranks[np.frombuffer(self.pairs, dtype=np.int64)] if self.pairs else np.zeros(0, dtype=np.int64)
+        ids = np.frombuffer(self.ids, dtype=np.int64) if self.ids else np.zeros(0, dtype=np.int64)
+        positions = np.arange(len(ids))
+        # first occurrence of each pair, then order of addition within each name
+        order = np.lexsort((positions, ids, rows))
+        keep = np.ones(len(order), dtype=bool)
+        keep[1:] = (rows[order][1:] != rows[order][:-1]) | (ids[order][1:] != ids[order][:-1])
+        kept = np.sort(order[keep])
+        kept = kept[np.argsort(rows[kept], kind='stable')]
+        name_offsets = np.zeros(len(names) + 1, dtype=np.uint64)
+        name_offsets[1:] = np.cumsum([len(name) for name in names], dtype=np.uint64)
+        post_offsets = np.zeros(len(names) + 1, dtype=np.uint64)
+        post_offsets[1:] = np.cumsum(np.bincount(rows[kept], minlength=len(names)), dtype=np.uint64)
+        table = CodesTable(b''.join(names), name_offsets, post_offsets, ids[kept])
+        table.build_index()
+        return table
+
+
+class PatternRegister(Mapping):
+    """
+    Custom register whose regex entries are not expanded: the patterns are compiled
+    into one expression matched against the names at lookup time, plain names are
+    stored in a dictionary. Values are the entries of the dictionary version
+    ({'values': (lat, lon, canonical), 'level': level}), the last entry added wins.
+    Only the plain names are listed when iterating over the register.
+    """
+    def __init__(self):
+        self.literals = dict()
+        self.patterns = list()
+        self.counter = 0
+        self.regex = None
+
+    def add(self, name, entry):
+        """
+        Store a plain name.
+        """
+        self.literals[name] = (self.counter, entry)
+        self.counter += 1
+
+    def add_pattern(self, expression, entry):
+        """
+        Store a regular expression, invalid expressions are discarded.
+        """
+        try:
+            re.compile(expression)
+        except re.error as err:
+            logger.warning('invalid expression %s: %s', expression, err)
+            return
+        self.patterns.append((self.counter, expression, entry))
+        self.counter += 1
+        self.regex = None
+
+    def compile(self):
+        """
+        Combine the patterns in one expression, the most recent ones first.
+        """
+        alternatives = ('(?P<_pattern%s>%s)' % (number, expression) for number, (_, expression, _) in reversed(list(enumerate(self.patterns))))
+        self.regex = re.compile('|'.join(alternatives))
+
+    def lookup(self, name):
+        """
+        Return the order and the entry of a name or None.
+        """
+        literal = self.literals.get(name)
+        if not self.patterns or validators.check_entry(name) is False:
+            return literal
+        if self.regex is None:
+            self.compile()
+        match = self.regex.fullmatch(name)
+        if match is None:
+            return literal
+        counter, _, entry = self.patterns[int(match.lastgroup[8:])]
+        if literal is not None and literal[0] > counter:
+            return literal
+        return counter, entry
+
+    def __getitem__(self, key):
+        result = self.lookup(key)
+        if result is None:
+            raise KeyError(key)
+        return result[1]
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+    def __iter__(self):
+        return iter(self.literals)
+
+    def __len__(self):
+        return len(self.literals)
+
+    def __bool__(self):
+        return bool(self.literals or self.patterns)
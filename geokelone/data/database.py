@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite backend for gazetteers larger than memory.
+"""
+
+# compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# standard
+import logging
+import os
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from collections.abc import Mapping
+
+# own
+from .. import settings
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS codes (name TEXT NOT NULL, id INTEGER NOT NULL, UNIQUE (name, id))',
+    'CREATE INDEX IF NOT EXISTS codes_name ON codes (name)',
+    'CREATE INDEX IF NOT EXISTS codes_id ON codes (id)',
+    'CREATE TABLE IF NOT EXISTS metainfo (id INTEGER PRIMARY KEY, lat REAL, lon REAL, type TEXT, country TEXT, population INTEGER)',
+)
+
+
+class LRUCache(object):
+    """
+    Small front cache which discards the least recently used entries (thread-safe).
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __getstate__(self):
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+
+class ConnectionPool(object):
+    """
+    One connection to the database file per thread and per process: SQLite connections
+    cannot be shared between threads and must not be used in a child process after a fork.
+    Pickled pools only keep the filename (e.g. for worker processes).
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = list()
+
+    def get(self):
+        """
+        Return the connection of the current thread, opened if necessary.
+        """
+        local = self.local
+        if getattr(local, 'pid', None) != os.getpid():
+            # first use in this thread, in this process or since close()
+            local.connection = sqlite3.connect(self.filename, check_same_thread=False)
+            local.pid = os.getpid()
+            with self.lock:
+                self.opened.append((local.pid, local.connection))
+        return local.connection
+
+    def close(self):
+        """
+        Close the connections opened by this process.
+        """
+        pid = os.getpid()
+        with self.lock:
+            for owner, connection in self.opened:
+                if owner == pid:
+                    connection.close()
+            self.opened = list()
+        self.local = threading.local()
+
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+
+# marks names and IDs which are not in the database
+MISSING = ()
+
+
+class SqliteGazetteer(object):
+    """
+    Store Geonames codes and metainfo in indexed SQLite tables, the registers
+    are available as read-only mappings (codesdict and metainfo attributes)
+    which can be used in place of the dictionaries.
+    Each thread and process reads through its own connection (see ConnectionPool):
+    the registers can be used by concurrent geocoders and worker processes,
+    entries are only visible to them once flushed. Writes are meant for one thread,
+    which checks duplicates against the IDs it owns (seen attribute, see StoredIDs).
+    """
+    def __init__(self, filename, cache_size=10000, batch_size=10000):
+        self.filename = filename
+        self.connections = ConnectionPool(filename)
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+        self.batch_size = batch_size
+        self.pending_codes = list()
+        # queued metainfo rows by ID, the last one wins
+        self.pending_meta = dict()
+        self.seen = StoredIDs(self)
+        self.codesdict = SqliteCodes(self.connections, cache_size)
+        self.metainfo = SqliteMeta(self.connections, cache_size)
+
+    @property
+    def connection(self):
+        """
+        Connection of the current thread.
+        """
+        return self.connections.get()
+
+    def store(self, nameid, canonical, alternatives, infotuple):
+        """
+        Queue a filtered Geonames entry (see geonames.quality_control), inserts are made in batches.
+        """
+        nameid = int(nameid)
+        self.pending_codes.append((canonical, nameid))
+        self.pending_codes.extend((alt, nameid) for alt in alternatives)
+        # same rounding as geonames.store_metainfo()
+        lat, lon = round(float(infotuple[1]), settings.ROUNDING), round(float(infotuple[2]), settings.ROUNDING)
+        self.pending_meta[nameid] = (nameid, lat, lon, infotuple[3], infotuple[4], int(infotuple[5]))
+        self.seen.add(nameid)
+        if len(self.pending_meta) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Insert the queued entries and commit.
+        """
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO codes VALUES (?, ?)', self.pending_codes)
+            self.connection.executemany('INSERT OR REPLACE INTO metainfo VALUES (?, ?, ?, ?, ?, ?)', self.pending_meta.values())
+        logger.debug('inserted: %s codes, %s entries', len(self.pending_codes), len(self.pending_meta))
+        self.pending_codes = list()
+        self.pending_meta = dict()
+        self.codesdict.cache.clear()
+        self.metainfo.cache.clear()
+
+    def remove(self, ids):
+        """
+        Delete entries and their names.
+        """
+        self.flush()
+        rows = [(int(nameid),) for nameid in ids]
+        with self.connection:
+            self.connection.executemany('DELETE FROM codes WHERE id = ?', rows)
+            self.connection.executemany('DELETE FROM metainfo WHERE id = ?', rows)
+        for row in rows:
+            self.seen.discard(row[0])
+        self.codesdict.cache.clear()
+        self.metainfo.cache.clear()
+
+    def update(self, codesdict, metainfo):
+        """
+        Copy existing registers (e.g. loaded from files) to the database.
+        """
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO codes VALUES (?, ?)', ((name, int(nameid)) for name in codesdict for nameid in codesdict[name]))
+            self.connection.executemany('INSERT OR REPLACE INTO metainfo VALUES (?, ?, ?, ?, ?, ?)', ((int(nameid),) + tuple(values[:5]) for nameid, values in metainfo.items()))
+        for nameid in metainfo:
+            self.seen.add(int(nameid))
+        self.codesdict.cache.clear()
+        self.metainfo.cache.clear()
+
+    def close(self):
+        self.flush()
+        self.connections.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StoredIDs(Mapping):
+    """
+    IDs stored by the writer with their metainfo, used for duplicate checks during ingestion
+    (see geonames.is_duplicate): queued entries are included and the read caches are bypassed.
+    The IDs already in the database are read once, on first use.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.ids = None
+
+    def _load(self):
+        if self.ids is None:
+            self.ids = set(row[0] for row in self.backend.connection.execute('SELECT id FROM metainfo'))
+
+    def add(self, nameid):
+        self._load()
+        self.ids.add(nameid)
+
+    def discard(self, nameid):
+        if self.ids is not None:
+            self.ids.discard(nameid)
+
+    def __contains__(self, nameid):
+        self._load()
+        try:
+            return int(nameid) in self.ids
+        except (TypeError, ValueError):
+            return False
+
+    def __getitem__(self, nameid):
+        if nameid not in self:
+            raise KeyError(nameid)
+        pending = self.backend.pending_meta.get(int(nameid))
+        if pending is not None:
+            return pending[1:]
+        row = self.backend.connection.execute('SELECT lat, lon, type, country, population FROM metainfo WHERE id = ?', (int(nameid),)).fetchone()
+        if row is None:
+            raise KeyError(nameid)
+        return row
+
+    def __iter__(self):
+        self._load()
+        return (str(nameid) for nameid in self.ids)
+
+    def __len__(self):
+        self._load()
+        return len(self.ids)
+
+
+class SqliteCodes(Mapping):
+    """
+    Codes register: name -> list of Geonames IDs.
+    """
+    def __init__(self, connections, cache_size):
+        self.connections = connections
+        self.cache = LRUCache(cache_size)
+
+    @property
+    def connection(self):
+        return self.connections.get()
+
+    def _fetch(self, name):
+        value = self.cache.get(name)
+        if value is None:
+            rows = self.connection.execute('SELECT id FROM codes WHERE name = ? ORDER BY rowid', (name,)).fetchall()
+            value = tuple(str(row[0]) for row in rows) or MISSING
+            self.cache.put(name, value)
+        return value
+
+    def __getitem__(self, name):
+        value = self._fetch(name)
+        if value is MISSING:
+            raise KeyError(name)
+        return list(value)
+
+    def __contains__(self, name):
+        return self._fetch(name) is not MISSING
+
+    def __iter__(self):
+        for row in self.connection.execute('SELECT DISTINCT name FROM codes ORDER BY name'):
+            yield row[0]
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(DISTINCT name) FROM codes').fetchone()[0]
+
+
+class SqliteMeta(Mapping):
+    """
+    Metainfo register: Geonames ID -> (latitude, longitude, type, country, population).
+    """
+    def __init__(self, connections, cache_size):
+        self.connections = connections
+        self.cache = LRUCache(cache_size)
+
+    @property
+    def connection(self):
+        return self.connections.get()
+
+    def _fetch(self, nameid):
+        value = self.cache.get(nameid)
+        if value is None:
+            try:
+                row = self.connection.execute('SELECT lat, lon, type, country, population FROM metainfo WHERE id = ?', (int(nameid),)).fetchone()
+            except (TypeError, ValueError):
+                row = None
+            value = row or MISSING
+            self.cache.put(nameid, value)
+        return value
+
+    def __getitem__(self, nameid):
+        value = self._fetch(nameid)
+        if value is MISSING:
+            raise KeyError(nameid)
+        return value
+
+    def __contains__(self, nameid):
+        return self._fetch(nameid) is not MISSING
+
+    def __iter__(self):
+        for row in self.connection.execute('SELECT id FROM metainfo ORDER BY id'):
+            yield str(row[0])
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM metainfo').fetchone()[0]
@@ -6,17 +6,16 @@ Helpers to import data from geonames.
 # compatibility
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import codecs
 import logging
 import re
 import sys
-from io import BytesIO
+import tempfile
 from zipfile import ZipFile
 
 import numpy as np
 import requests
 
-# from sqlitedict import SqliteDict
-
 from .. import settings
 from . import utils, validators
 
@@ -32,26 +31,32 @@ logger = logging.getLogger(__name__)
 # vars
 codesdict = dict()
 metainfo = dict()
-# DBPATH = './metainfo.sqlite'
 
 # banks, buildings, hotels, railway stations, road stops, towers, energy (power plats, wind turbines), mountain huts, post offices, golf courses, sections of harbors, former inlet, maneuver area, artillery range, 
 refused_types = ('BANK', 'BLDG', 'GRAZ', 'HBRX', 'HTL', 'HUT', 'INLTQ', 'MLWND', 'MVA', 'PLDR', 'PO', 'PS', 'RECG', 'RNGA', 'RSTN', 'RSTP', 'SWT', 'TOWR', 'VIN')
 # may be refined with http://www.geonames.org/export/codes.html
 # further filtering: farms, forests, ruined bridges
 # 'FRM', 'FRST', 'BDGQ'
+REFUSED_TYPES = frozenset(refused_types)
+# feature classes at filter level MAXIMUM: admin, stream/lake, park, city/village, mountain, forest
+MAXIMUM_CLASSES = frozenset(('A', 'H', 'L', 'P', 'T', 'V'))
 
 
-# TODO: 
-# compact dict structure
-# https://github.com/RaRe-Technologies/sqlitedict ?
+# TODO:
 # https://docs.python.org/3/library/csv.html ?
-# https://docs.python.org/3/library/shelve.html
-# https://docs.python.org/3/library/sqlite3.html
+
+# worldwide dumps: all entries, cities above a number of inhabitants
+DUMPS = ('allCountries', 'cities500', 'cities1000', 'cities5000', 'cities15000')
+
+# bytes read and decoded at once
+BLOCK_SIZE = 2**20
+# downloads larger than this are written to disk instead of memory
+SPOOL_SIZE = 2**25
 
 
 def generate_urls(countrycodes):
     """
-    generate download URLs
+    generate download URLs for country codes or worldwide dumps (see DUMPS)
     """
     urls = list()
     filenames = list()
@@ -63,7 +68,8 @@ def generate_urls(countrycodes):
     # iterate through countrycodes
     for countrycode in countrycodes:
         # i = 0
-        countrycode = countrycode.upper()
+        if countrycode not in DUMPS:
+            countrycode = countrycode.upper()
         url = 'http://download.geonames.org/export/dump/' + countrycode + '.zip'
         filename = countrycode + '.txt'
         urls.append(url)
@@ -72,17 +78,20 @@ def generate_urls(countrycodes):
     return urls, filenames
 
 
-def quality_control(line, ccode=None):
+def quality_control(line, ccode=None, seen=None, stats=None):
     """
     Only store a geonames entry if it satisfies formal criteria (type, validity, etc.)
+    Entries are checked against a metainfo register (default: the module register),
+    rejections are counted in the statistics (default: validators.rejections).
     """
-    # global codesdict, metainfo
+    if seen is None:
+        seen = metainfo
     columns = re.split('\t', line)
     alternatives = set()
 
     # basic filters
     if len(columns) != 19:
-        logger.debug('malformed: %s', line)
+        validators.reject(stats, 'malformed', line)
         return None, None, None
 
     ## TODO: extend filtering
@@ -92,60 +101,53 @@ def quality_control(line, ccode=None):
     if settings.FILTER_LEVEL == 'MAXIMUM':
         # admin, stream/lake, park, city/village, mountain, forest
         if columns[6] not in ('A', 'H', 'L', 'P', 'T', 'V'):
-            logger.debug('not a suitable for filter level %s: %s', settings.FILTER_LEVEL, columns[6])
+            validators.reject(stats, 'filter level', columns[0])
             return None, None, None
     else:
         if columns[7] in refused_types:
-            logger.debug('not a suitable type: %s', columns[7])
+            validators.reject(stats, 'refused type', columns[0])
             return None, None, None
 
     # name
     if len(columns[0]) < 1 or len(columns[1]) < 1:
-        logger.debug('malformed: %s', line)
+        validators.reject(stats, 'malformed', line)
         return None, None, None
-    elif validators.validate_entry(columns[1]) is False:
-        logger.debug('no suitable name for entry: %s', columns[1])
+    elif validators.validate_entry(columns[1], stats) is False:
         return None, None, None
 
     # coordinates
-    if validators.validate_latlon(columns[4], columns[5]) is False:
-        logger.debug('no suitable coordinates: %s %s', columns[4], columns[5])
+    if validators.validate_latlon(columns[4], columns[5], stats) is False:
         return None, None, None
 
     # country code
     if len(columns[8]) != 2:
-        logger.debug('no suitable country code: %s', columns[8])
+        validators.reject(stats, 'country code', columns[0])
         return None, None, None
     if ccode is not None and columns[8] != ccode:
-        logger.debug('wrong country code: %s', columns[8])
+        validators.reject(stats, 'other country', columns[0])
         return None, None, None
 
     # population
     try:
         int(columns[14])
     except ValueError:
-        logger.debug('no suitable population value: %s', columns[14])
+        validators.reject(stats, 'population', columns[0])
         return None, None, None
 
     # check if exists in db
     # TODO: latest entry in geonames?
-    ##with SqliteDict(DBPATH) as metainfo:
-    if columns[0] in metainfo:
-        # check population
-        if metainfo[columns[0]][-1] <= columns[14]:
-            logger.warning('code already seen: %s', line)
-            return None, None, None
-        #else:
-        #    alternatives = ...
+    if is_duplicate(columns[0], columns[14], seen):
+        validators.reject(stats, 'duplicate', columns[0])
+        return None, None, None
 
     # examine alternatives
     if ',' in columns[3]:
         for alternative in re.split(',', columns[3]):
             # store
-            if validators.validate_entry(alternative) is True:
+            if validators.validate_entry(alternative, stats) is True:
                 alternatives.add(alternative)
-    else:
-        if validators.validate_entry(columns[3]) is True:
+    elif columns[3]:
+        if validators.validate_entry(columns[3], stats) is True:
             alternatives.add(columns[3])
 
     # store selected information
@@ -155,88 +157,202 @@ def quality_control(line, ccode=None):
     return alternatives, columns[1], (columns[0], columns[4], columns[5], columns[6], columns[8], columns[14])
 
 
-def store_codesdata(nameid, canonical, alternatives):
+def filter_lines(lines, ccode=None, seen=None, stats=None):
     """
-    Store codes data in register.
+    Batch version of quality_control for a block of raw lines, with the same decisions:
+    returns the (alternatives, canonical, infotuple) triples of the accepted lines.
     """
-    global codesdict
+    if seen is None:
+        seen = metainfo
+    if stats is None:
+        stats = validators.rejections
+    # settings and patterns are looked up once per batch
+    maximum = settings.FILTER_LEVEL == 'MAXIMUM'
+    minlength = settings.MINLENGTH
+    unsuitable = validators.UNSUITABLE_CHARS.search
+    reject = stats.add
+    accepted = list()
+    append = accepted.append
+    for line in lines:
+        columns = line.split('\t')
+        if len(columns) != 19:
+            reject('malformed', line)
+            continue
+        # type
+        if maximum:
+            if columns[6] not in MAXIMUM_CLASSES:
+                reject('filter level', columns[0])
+                continue
+        elif columns[7] in REFUSED_TYPES:
+            reject('refused type', columns[0])
+            continue
+        # name
+        name = columns[1]
+        if not columns[0] or len(name) < minlength or name.count(' ') >= 3 or unsuitable(name) is not None:
+            # reason of the rejection
+            if not columns[0] or not name:
+                reject('malformed', line)
+            else:
+                validators.validate_entry(name, stats)
+            continue
+        # coordinates, parsed once
+        try:
+            lat, lon = float(columns[4]), float(columns[5])
+        except ValueError:
+            reject('coordinates', (columns[4], columns[5]))
+            continue
+        if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+            reject('coordinates', (columns[4], columns[5]))
+            continue
+        # country code
+        if len(columns[8]) != 2:
+            reject('country code', columns[0])
+            continue
+        if ccode is not None and columns[8] != ccode:
+            reject('other country', columns[0])
+            continue
+        # population
+        try:
+            int(columns[14])
+        except ValueError:
+            reject('population', columns[0])
+            continue
+        if is_duplicate(columns[0], columns[14], seen):
+            reject('duplicate', columns[0])
+            continue
+        alternatives = set()
+        if columns[3]:
+            for alternative in columns[3].split(','):
+                if len(alternative) >= minlength and alternative.count(' ') < 3 and unsuitable(alternative) is None:
+                    alternatives.add(alternative)
+                else:
+                    # reason of the rejection
+                    validators.validate_entry(alternative, stats)
+        append((alternatives, name, (columns[0], columns[4], columns[5], columns[6], columns[8], columns[14])))
+    logger.debug('lines accepted: %s', len(accepted))
+    return accepted
+
+
+def is_duplicate(nameid, population, seen):
+    """
+    Test if an entry has already been stored with a population which is not larger,
+    the values are compared as numbers (strings in files, integers in databases).
+    """
+    return nameid in seen and int(seen[nameid][-1]) <= int(population)
+
+
+def store_codesdata(nameid, canonical, alternatives, register=None):
+    """
+    Store codes data in register (default: the module register).
+    """
+    if register is None:
+        register = codesdict
     logger.debug('storing: %s %s %s', nameid, canonical, alternatives)
     # canonical
-    if canonical not in codesdict:
-        codesdict[canonical] = set()
-    codesdict[canonical].add(nameid)
+    if canonical not in register:
+        register[canonical] = set()
+    register[canonical].add(nameid)
     # alternatives
     for alt in alternatives:
-        if alt not in codesdict:
-            codesdict[alt] = set()
-        codesdict[alt].add(nameid)
+        if alt not in register:
+            register[alt] = set()
+        register[alt].add(nameid)
 
 
-def store_metainfo(infotuple):
+def store_metainfo(infotuple, precompute=False, register=None):
     """
-    Store metainfo data in register.
+    Store metainfo data in register (default: the module register).
+    Optionally compute the distance to the reference point in advance (see geocoding.ReferenceCache).
     """
-    global metainfo
-    #with SqliteDict(DBPATH) as metainfo:
+    if register is None:
+        register = metainfo
     # control
-    if infotuple[0] in metainfo:
+    if infotuple[0] in register:
         logger.warning('item already in register: %s', infotuple[0])
     # round
     lat, lon = round(float(infotuple[1]), settings.ROUNDING), round(float(infotuple[2]), settings.ROUNDING)
     # store
-    metainfo[infotuple[0]] = (lat, lon, infotuple[3], infotuple[4], infotuple[5])
-    # metainfo.commit()
+    register[infotuple[0]] = (lat, lon, infotuple[3], infotuple[4], infotuple[5])
+    if precompute is True:
+        # deferred import, the geo package depends on the data package
+        from ..geo import geocoding
+        geocoding.reference_cache.add(infotuple[0], register[infotuple[0]])
 
 
-def filter_zipfile(filename, subfilename, countrycode):
+def iterbatches(myfile, blocksize=BLOCK_SIZE):
+    """
+    Read a binary stream in blocks and yield lists of decoded lines, characters
+    split between two blocks are handled by an incremental UTF-8 decoder.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    while True:
+        block = myfile.read(blocksize)
+        lines = (pending + decoder.decode(block, final=not block)).split('\n')
+        # the last line may continue in the next block
+        pending = lines.pop()
+        if lines:
+            yield lines
+        if not block:
+            break
+    if pending:
+        yield [pending]
+
+
+def filter_zipfile(filename, subfilename, countrycode, backend=None, blocksize=BLOCK_SIZE, stats=None):
     """
-    Filter information contained in a Geonames ZIP-file.
+    Filter information contained in a Geonames ZIP-file (path or file object).
+    The data file is read as a stream and filtered in batches of lines (see filter_lines).
+    Entries are stored in the module registers or in a database backend (see database.SqliteGazetteer).
+    Rejected lines are counted in the statistics given, by default
+    in new ones added to validators.rejections at the end (see validators.source_stats).
     """
     j = 0
     k = 0
+    stats = validators.source_stats(stats)
+    seen = backend.seen if backend is not None else metainfo
     with ZipFile(filename) as myzip:
         with myzip.open(subfilename) as myfile:
-            for line in myfile:
-                print(line)
-                alternatives, canonical, infotuple = quality_control(line.decode(), countrycode)
-                if canonical is not None:
+            for lines in iterbatches(myfile, blocksize):
+                j += len(lines)
+                for alternatives, canonical, infotuple in filter_lines(lines, countrycode, seen, stats):
+                    # entries of the same batch are not known to the filter
+                    if is_duplicate(infotuple[0], infotuple[5], seen):
+                        stats.add('duplicate', infotuple[0])
+                        continue
                     # store
-                    store_codesdata(infotuple[0], canonical, alternatives)
-                    store_metainfo(infotuple)
+                    if backend is not None:
+                        backend.store(infotuple[0], canonical, alternatives, infotuple)
+                    else:
+                        store_codesdata(infotuple[0], canonical, alternatives)
+                        store_metainfo(infotuple)
                     k += 1
-                j += 1
+    if backend is not None:
+        backend.flush()
+    stats.report(subfilename)
     logger.info('%s lines seen, %s filtered lines', j, k)
     # return codesdict, metainfo
 
 
-def fetchdata(countrycodes):
+def fetchdata(countrycodes, backend=None):
     """
     Retrieve data from geonames for the countries given.
+    The archives are downloaded to a spooled temporary file, kept in memory
+    up to SPOOL_SIZE bytes and written to disk beyond.
     """
     i = 0
     urls, filenames = generate_urls(countrycodes)
     for url in urls:
-        # start
-        j = 0
-        k = 0
         logger.info('download %s url: %s', i, url)
-        result = utils.send_request(url, returnbytes=True)
-        if result is not None:
-            filter_zipfile(BytesIO(request.content), filenames[i], countrycodes[i])
-            #with ZipFile(BytesIO(request.content)) as myzip:
-            #    with myzip.open(filenames[i]) as myfile:
-            #        for line in myfile:
-            #            # filter
-            #            alternatives, canonical, infotuple = quality_control(line.decode(), countrycodes[i])
-            #            if canonical is not None:
-            #                # store
-            #                store_codesdata(infotuple[0], canonical, alternatives)
-            #                store_metainfo(infotuple)
-            #                k += 1
-            #            j += 1
-            #logger.info('%s lines seen, %s filtered lines', j, k)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as tmpfile:
+            if utils.download(url, tmpfile) is True:
+                # upper-case code as in the file name, no code for worldwide dumps
+                countrycode = filenames[i][:-4] if filenames[i][:-4] not in DUMPS else None
+                tmpfile.seek(0)
+                filter_zipfile(tmpfile, filenames[i], countrycode, backend)
         i += 1
-        ## metainfo.commit()
+    if backend is not None:
+        return backend.codesdict, backend.metainfo
     return codesdict, metainfo
 
 
@@ -246,7 +362,7 @@ def writefile(dictname, filename):
     """
     logger.info('writing register to file %s', filename)
     i = 0
-    with open(filename, 'a', encoding='utf-8') as outfh:
+    with open(filename, 'w', encoding='utf-8') as outfh:
         for key in sorted(dictname):
             if len(key) > 1:
                 outfh.write(key)
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming and parallel ingestion of Geonames dumps stored locally.
+"""
+
+# compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# standard
+import heapq
+import logging
+import multiprocessing
+import tempfile
+import time
+
+from collections import deque
+from itertools import groupby
+from os import path
+from zipfile import ZipFile, is_zipfile
+
+# own
+from .. import settings
+from . import geonames, validators
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+# lines sent to a worker at once
+CHUNK_SIZE = 10000
+
+
+def find_member(filename):
+    """
+    Name of the data file in a Geonames ZIP archive: XX.zip contains XX.txt (and a readme).
+    """
+    with ZipFile(filename) as myzip:
+        members = myzip.namelist()
+    expected = path.splitext(path.basename(filename))[0] + '.txt'
+    if expected in members:
+        return expected
+    for member in members:
+        if member.endswith('.txt') and member != 'readme.txt':
+            return member
+    raise ValueError('no data file in archive: %s' % filename)
+
+
+def iterlines(filename, member=None):
+    """
+    Yield the raw lines of a Geonames dump, a ZIP archive or a text file, without loading it in memory.
+    """
+    if is_zipfile(filename):
+        if member is None:
+            member = find_member(filename)
+        with ZipFile(filename) as myzip:
+            with myzip.open(member) as myfile:
+                for line in myfile:
+                    yield line
+    else:
+        with open(filename, 'rb') as inputfh:
+            for line in inputfh:
+                yield line
+
+
+def iterchunks(lines, size=CHUNK_SIZE):
+    """
+    Group lines in lists of a given size.
+    """
+    chunk = list()
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def _init_worker(filter_level):
+    """
+    Apply the filter level of the parent process (settings are not shared if the processes are spawned).
+    """
+    settings.FILTER_LEVEL = filter_level
+
+
+class _Unseen(object):
+    """
+    Register which contains nothing.
+    """
+    def __contains__(self, key):
+        return False
+
+
+# no duplicate check in the workers
+UNSEEN = _Unseen()
+
+
+def filter_chunk(chunk, countrycode=None, stats=None):
+    """
+    Run the quality control on a list of raw lines and return the accepted entries.
+    Duplicates are not checked here but when the entries are merged.
+    """
+    return [(infotuple, canonical, alternatives) for alternatives, canonical, infotuple in geonames.filter_lines([line.decode('utf-8') for line in chunk], countrycode, UNSEEN, stats)]
+
+
+def _filter_chunk_counted(chunk, countrycode=None):
+    """
+    Worker version of filter_chunk, also returns the rejection statistics of the chunk.
+    """
+    stats = validators.RejectionStats()
+    return filter_chunk(chunk, countrycode, stats), stats
+
+
+def iterentries(filenames, countrycodes=None, workers=None, chunksize=CHUNK_SIZE, stats=None):
+    """
+    Stream the lines of Geonames dumps and filter them in chunks in a pool of processes
+    (default: one per CPU). Yields the accepted entries of each chunk in the order of the input.
+    Rejected lines are counted in the statistics given, by default
+    in new ones added to validators.rejections at the end (see validators.source_stats).
+    """
+    logged = stats is None
+    stats = validators.source_stats(stats)
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    if countrycodes is None:
+        countrycodes = [None] * len(filenames)
+    pool = None
+    if workers != 1:
+        workers = workers or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(settings.FILTER_LEVEL,))
+    # results waiting to be merged, bounded to keep the memory use low
+    maxpending = 2 * (workers or 1)
+    start = time.perf_counter()
+    j = 0
+    try:
+        for filename, countrycode in zip(filenames, countrycodes):
+            pending = deque()
+            for chunk in iterchunks(iterlines(filename), chunksize):
+                j += len(chunk)
+                if pool is None:
+                    yield filter_chunk(chunk, countrycode, stats)
+                    continue
+                pending.append(pool.apply_async(_filter_chunk_counted, (chunk, countrycode)))
+                if len(pending) >= maxpending:
+                    entries, chunkstats = pending.popleft().get()
+                    stats.merge(chunkstats)
+                    yield entries
+            while pending:
+                entries, chunkstats = pending.popleft().get()
+                stats.merge(chunkstats)
+                yield entries
+            logger.debug('file processed: %s', filename)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = time.perf_counter() - start
+    if logged is True:
+        stats.report(', '.join(filenames))
+    logger.info('%s lines seen, %.0f lines/s', j, j / elapsed if elapsed else 0)
+
+
+def ingest(filenames, countrycodes=None, codesdict=None, metainfo=None, backend=None, workers=None, chunksize=CHUNK_SIZE, stats=None):
+    """
+    Filter local Geonames dumps (ZIP archives like XX.zip or extracted text files)
+    and store the entries in the given registers, in new dictionaries or in a database
+    backend (see database.SqliteGazetteer). The lines are read as a stream and the
+    quality control runs on chunks in a pool of processes (default: one per CPU),
+    the results are merged in the order of the files.
+    Rejected lines are counted in the statistics given, by default
+    in new ones added to validators.rejections at the end (see validators.source_stats).
+    Returns the codes and metainfo registers.
+    """
+    stats = validators.source_stats(stats)
+    if codesdict is None:
+        codesdict = dict()
+    if metainfo is None:
+        metainfo = dict()
+    seen = backend.seen if backend is not None else metainfo
+    k = 0
+    for entries in iterentries(filenames, countrycodes, workers, chunksize, stats):
+        k += merge_entries(entries, codesdict, metainfo, seen, backend, stats)
+    if backend is not None:
+        backend.flush()
+    stats.report(', '.join([filenames] if isinstance(filenames, str) else filenames))
+    logger.info('%s filtered lines', k)
+    if backend is not None:
+        return backend.codesdict, backend.metainfo
+    return codesdict, metainfo
+
+
+def merge_entries(entries, codesdict, metainfo, seen, backend=None, stats=None):
+    """
+    Store filtered entries unless they have already been seen, returns the number of stored entries.
+    """
+    stored = 0
+    for infotuple, canonical, alternatives in entries:
+        if geonames.is_duplicate(infotuple[0], infotuple[5], seen):
+            validators.reject(stats, 'duplicate', infotuple[0])
+            continue
+        if backend is not None:
+            backend.store(infotuple[0], canonical, alternatives, infotuple)
+        else:
+            geonames.store_codesdata(infotuple[0], canonical, alternatives, codesdict)
+            geonames.store_metainfo(infotuple, register=metainfo)
+        stored += 1
+    return stored
+
+
+# estimated memory used by a buffered row besides the length of its strings
+ROW_OVERHEAD = 160
+
+
+def ingest_files(filenames, codesfile, metafile, countrycodes=None, memory_limit=2**28, tempdir=None, workers=None, chunksize=CHUNK_SIZE, stats=None):
+    """
+    Filter Geonames dumps of any size (e.g. allCountries) into codes and metainfo files
+    as written by geonames.writefile. Filtered entries are buffered up to an estimated
+    memory limit (in bytes), sorted and spilled to temporary shards, which are merged
+    at the end (external sort): the memory use does not depend on the size of the input.
+    Rejected lines are counted as in ingest.
+    """
+    stats = validators.source_stats(stats)
+    codes, meta = list(), list()
+    size, seq, shards = 0, 0, 0
+    with tempfile.TemporaryDirectory(dir=tempdir) as shardir:
+        for entries in iterentries(filenames, countrycodes, workers, chunksize, stats):
+            for infotuple, canonical, alternatives in entries:
+                nameid = infotuple[0]
+                lat, lon = round(float(infotuple[1]), settings.ROUNDING), round(float(infotuple[2]), settings.ROUNDING)
+                meta.append((nameid, seq, str(lat), str(lon), infotuple[3], infotuple[4], infotuple[5]))
+                size += ROW_OVERHEAD + sum(len(item) for item in infotuple)
+                for name in [canonical] + sorted(alternatives):
+                    codes.append((name, seq, nameid))
+                    size += ROW_OVERHEAD + len(name)
+                seq += 1
+            if size >= memory_limit:
+                _spill(shardir, shards, codes, meta)
+                codes, meta = list(), list()
+                size, shards = 0, shards + 1
+        if codes or not shards:
+            _spill(shardir, shards, codes, meta)
+            shards += 1
+        codes, meta = None, None
+        logger.info('%s entries spilled to %s shards', seq, shards)
+        # metainfo first: duplicate entries are discarded with their names
+        rejected = _merge_meta(shardir, shards, metafile, stats)
+        _merge_codes(shardir, shards, codesfile, rejected)
+    stats.report(', '.join([filenames] if isinstance(filenames, str) else filenames))
+
+
+def _spill(shardir, number, codes, meta):
+    """
+    Sort buffered rows and write them to a pair of shard files.
+    """
+    codes.sort()
+    meta.sort()
+    for prefix, rows in (('codes', codes), ('meta', meta)):
+        with open(path.join(shardir, '%s-%05d.tsv' % (prefix, number)), 'w', encoding='utf-8') as outfh:
+            for row in rows:
+                outfh.write('\t'.join(str(item) for item in row) + '\n')
+    logger.debug('shard %s: %s names, %s entries', number, len(codes), len(meta))
+
+
+def _read_shard(filename):
+    """
+    Read the rows of a shard: key, sequence number, values.
+    """
+    with open(filename, 'r', encoding='utf-8') as inputfh:
+        for line in inputfh:
+            columns = line.rstrip('\n').split('\t')
+            yield columns[0], int(columns[1]), columns[2:]
+
+
+def _merge_shards(shardir, prefix, shards):
+    """
+    Merge sorted shards into one sorted stream of rows.
+    """
+    streams = [_read_shard(path.join(shardir, '%s-%05d.tsv' % (prefix, number))) for number in range(shards)]
+    return heapq.merge(*streams, key=lambda row: (row[0], row[1]))
+
+
+def _merge_meta(shardir, shards, metafile, stats=None):
+    """
+    Write the metainfo file, returns the sequence numbers of the discarded duplicates.
+    """
+    rejected = set()
+    i = 0
+    with open(metafile, 'w', encoding='utf-8') as outfh:
+        for nameid, rows in groupby(_merge_shards(shardir, 'meta', shards), key=lambda row: row[0]):
+            current = next(rows)[2]
+            # same rule as for the entries filtered in memory
+            for _, seq, values in rows:
+                if geonames.is_duplicate(nameid, values[-1], {nameid: current}):
+                    validators.reject(stats, 'duplicate', nameid)
+                    rejected.add(seq)
+                else:
+                    current = values
+            if len(nameid) > 1:
+                outfh.write(nameid + '\t' + '\t'.join(current) + '\n')
+                i += 1
+    logger.info('%s lines written to %s', i, metafile)
+    return rejected
+
+
+def _merge_codes(shardir, shards, codesfile, rejected):
+    """
+    Write the codes file: each name followed by its IDs.
+    """
+    i = 0
+    with open(codesfile, 'w', encoding='utf-8') as outfh:
+        for name, rows in groupby(_merge_shards(shardir, 'codes', shards), key=lambda row: row[0]):
+            ids, seen = list(), set()
+            for _, seq, values in rows:
+                if seq not in rejected and values[0] not in seen:
+                    ids.append(values[0])
+                    seen.add(values[0])
+            if len(name) > 1 and ids:
+                outfh.write(name + '\t' + '\t'.join(ids) + '\n')
+                i += 1
+    logger.info('%s lines written to %s', i, codesfile)
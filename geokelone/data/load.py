@@ -8,65 +8,96 @@ Fixed settings for extraction and projection of toponyms (as is: European places
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 # standard
+import hashlib
 import logging
+import os
+import pickle
 import re
 import sys
+import tempfile
+
+from itertools import islice
 
 # external
 import exrex
-# from sqlitedict import SqliteDict
 
 # own
 from .. import settings
+from .compact import PatternRegister, PostingsBuilder, TableBuilder
 from . import validators
 
 # logging
 logger = logging.getLogger(__name__)
 
-# DB
-# DBPATH = './metainfo.sqlite'
+# version of the compiled registers, to be changed with the processing
+CACHE_VERSION = 1
 
 
-def expand(expression):
+def iterexpand(expression):
     """
-    Use regex entry expansion to populate the register.
+    Generate the variants of a regex entry one by one.
     """
-    expresults = list(exrex.generate(expression))
     # no regex
-    if len(expresults) == 1:
-        results = list()
-        results.append(expression)
+    if exrex.count(expression) == 1:
+        yield expression
         if settings.LANGUAGE == 'DE':
             # German genitive form: if no s at the end of one component
             if not re.search(r's$', expression) and not re.search(r'\s', expression):
-                temp = expression + 's'
-                results.append(temp)
-        return results
-    # serialize
+                yield expression + 's'
     else:
-        return expresults
+        for variant in exrex.generate(expression):
+            yield variant
 
 
-def store_variants(expanded, columns, level):
+def expand(expression, limit=None):
     """
-    Stores variants and metadata in a dictionary.
+    Use regex entry expansion to populate the register.
+    The number of variants is capped (default: settings.EXPANSION_LIMIT).
+    """
+    if limit is None:
+        limit = settings.EXPANSION_LIMIT
+    count = exrex.count(expression)
+    if count > limit:
+        logger.warning('%s variants for %s, only the first %s are kept', count, expression, limit)
+    return list(islice(iterexpand(expression), limit))
+
+
+def store_patterns(register, expressions, columns, level, stats=None):
+    """
+    Store entries in a pattern register without enumerating the regex variants.
+    """
+    # same canonical form as with the expansion
+    canonical = next(iterexpand(expressions[0]))
+    entry = {'values': (columns[-2], columns[-1], canonical), 'level': level}
+    for expression in expressions:
+        if exrex.count(expression) == 1:
+            for variant in iterexpand(expression):
+                if validators.validate_entry(variant, stats) is False:
+                    continue
+                register.add(variant, entry)
+        else:
+            register.add_pattern(expression, entry)
+
+
+def store_variants(expanded, columns, level, dic=None, stats=None):
+    """
+    Stores variants and metadata in a dictionary (default: a new one).
+    Refused variants are counted in the rejection statistics (see validators.RejectionStats).
     """
     # init
-    dic = dict()
+    if dic is None:
+        dic = dict()
     canonical = expanded[0]
     lat, lon = columns[-2], columns[-1]
     # logger.debug('%s %s %s %s', canonical, expanded, columns, level)
     # loop
     for variant in expanded:
-        # verbosity
-        logger.debug('seen variant of %s : %s', canonical, variant) # , dic[variant]
         # control and store
-        if validators.validate_entry(variant) is False:
-            logger.debug('refused: %s', variant)
+        if validators.validate_entry(variant, stats) is False:
             continue
         if variant in dic:
             if dic[variant]['level'] > level:
-                logger.warning('key discarded: %s %s', variant, level)
+                validators.reject(stats, 'lower level', variant)
             #elif dic[variant]['level'] == level:
             #    logger.warning('duplicate entry: %s %s', variant, level)
             #    dic[variant]['values'] = (lat, lon, canonical)
@@ -77,26 +108,37 @@ def store_variants(expanded, columns, level):
             dic[variant]['values'] = (lat, lon, canonical)
             dic[variant]['level'] = level
     # finish
-    logger.debug('%s', dic)
     return dic
 
 
-def load_tsv(filename, level=0):
+def load_tsv(filename, level=0, expand_variants=True, cachedir=None, stats=None):
     """
     Open a TSV file and load its content into memory. Requires a level.
+    Regex entries are expanded or kept as patterns matched at lookup time (see compact.PatternRegister).
+    The result can be compiled once and loaded from a cache directory (see cached_register).
+    Rejected lines and variants are counted in the statistics given, by default
+    in new ones added to validators.rejections at the end (see validators.source_stats).
     """
+    if cachedir is not None:
+        return cached_register(load_tsv, filename, level, expand_variants, cachedir, stats)
     # init
     dic = dict()
+    stats = validators.source_stats(stats)
     if not isinstance(level, int):
         logger.error('level is not an int: %s', level)
         return dic
+    if expand_variants is False:
+        dic = PatternRegister()
     # read
     with open(filename, 'r', encoding='utf-8') as inputfh:
         for line in inputfh:
             line = line.strip()
-            columns = re.split('\t', line)
+            columns = line.split('\t')
             # sanity check
-            if validators.validate_tsv_registry(columns) is False:
+            if validators.validate_tsv_registry(columns, stats) is False:
+                continue
+            if expand_variants is False:
+                store_patterns(dic, columns[0].split(';'), columns, level, stats)
                 continue
             # process
             expansions = list()
@@ -115,27 +157,40 @@ def load_tsv(filename, level=0):
             # canonical form?
             canonical = expansions[0]
             # process variants
-            dic.update(store_variants(expansions, columns, level))
+            store_variants(expansions, columns, level, dic, stats)
 
+    stats.report(filename)
     logger.info('%s entries found in registry %s', len(dic), filename)
     return dic
 
 
-def load_csv(filename, level=0):
+def load_csv(filename, level=0, expand_variants=True, cachedir=None, stats=None):
     """
     Open a CSV file and load its content into memory.
+    Regex entries are expanded or kept as patterns matched at lookup time (see compact.PatternRegister).
+    The result can be compiled once and loaded from a cache directory (see cached_register).
+    Rejected lines and variants are counted in the statistics given, by default
+    in new ones added to validators.rejections at the end (see validators.source_stats).
     """
+    if cachedir is not None:
+        return cached_register(load_csv, filename, level, expand_variants, cachedir, stats)
     # init
     dic = dict()
+    stats = validators.source_stats(stats)
     if not isinstance(level, int):
         logger.error('level is not an int: %s', level)
         return dic
+    if expand_variants is False:
+        dic = PatternRegister()
     with open(filename, 'r', encoding='utf-8') as inputfh:
         for line in inputfh:
             line = line.strip()
-            columns = re.split(',', line)
+            columns = line.split(',')
             # sanity check
-            if validators.validate_csv_registry(columns) is False:
+            if validators.validate_csv_registry(columns, stats) is False:
+                continue
+            if expand_variants is False:
+                store_patterns(dic, columns[0].split(';') + columns[1].split(';'), columns, level, stats)
                 continue
             # process
             expansions = list()
@@ -157,38 +212,93 @@ def load_csv(filename, level=0):
             else:
                 expansions.extend(expand(columns[1]))
             # process variants
-            dic.update(store_variants(expansions, columns, level))
+            store_variants(expansions, columns, level, dic, stats)
 
+    stats.report(filename)
     logger.info('%s entries found in registry %s', len(dic), filename)
     return dic
 
 
+def register_key(filename, *params):
+    """
+    Identify a register by the content of its source file, the settings used to
+    process it and further parameters.
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as inputfh:
+        for block in iter(lambda: inputfh.read(2**20), b''):
+            digest.update(block)
+    digest.update(repr((CACHE_VERSION, settings.LANGUAGE, settings.MINLENGTH, settings.EXPANSION_LIMIT) + params).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def cached_register(loader, filename, level, expand_variants, cachedir, stats=None):
+    """
+    Load a compiled register from the cache directory or build it with the given
+    function (load_tsv or load_csv) and store it for later runs.
+    Rejections are only counted when the register is built.
+    """
+    cachefile = os.path.join(cachedir, register_key(filename, loader.__name__, level, expand_variants) + '.pickle')
+    try:
+        with open(cachefile, 'rb') as inputfh:
+            dic = pickle.load(inputfh)
+    except IOError:
+        pass
+    # truncated file or classes changed since the register was compiled
+    except (EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, TypeError, ValueError) as err:
+        logger.warning('invalid cache file %s, rebuilding: %r', cachefile, err)
+    else:
+        logger.info('%s entries loaded from cache %s', len(dic), cachefile)
+        return dic
+    dic = loader(filename, level, expand_variants, stats=stats)
+    os.makedirs(cachedir, exist_ok=True)
+    # atomic replacement, concurrent runs may write the same file
+    with tempfile.NamedTemporaryFile(dir=cachedir, delete=False) as outfh:
+        pickle.dump(dic, outfh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(outfh.name, cachefile)
+    logger.info('register %s compiled to %s', filename, cachefile)
+    return dic
+
+
 # geonames
 ### FILE MUST EXIST, use the preprocessing script provided
-def geonames_meta(filename):
+def geonames_meta(filename, precompute=False, compact=False, stats=None):
     """
     Load metadata for a place name from Geonames.
+    Optionally compute distances to the reference point in advance (see geocoding.ReferenceCache)
+    and store the data in typed arrays instead of a dictionary (see compact.MetaInfoTable).
+    Rejected lines are counted in the statistics given, by default
+    in new ones added to validators.rejections at the end (see validators.source_stats).
     """
     metainfo = dict()
+    stats = validators.source_stats(stats)
+    if compact is True:
+        builder = TableBuilder()
     try:
-        with open(filename, 'r', encoding='utf-8') as inputfh: #, SqliteDict(DBPATH) as metainfo:
+        with open(filename, 'r', encoding='utf-8') as inputfh:
             for line in inputfh:
                 line = line.strip()
                 columns = re.split('\t', line)
-                if validators.validate_geonames_registry(columns) is False:
+                if validators.validate_geonames_registry(columns, stats) is False:
                     continue
                 # no empty places at filter levels 1 & 2
                 if settings.FILTER_LEVEL == 'MAXIMUM' or settings.FILTER_LEVEL == 'MEDIUM':
                     if columns[5] == '0':
+                        stats.add('no population', columns[0])
                         continue
                 # filter: skip elements
                 if settings.FILTER_LEVEL == 'MAXIMUM':
                     if columns[3] != 'A':
+                        stats.add('filter level', columns[0])
                         continue
                 elif settings.FILTER_LEVEL == 'MEDIUM':
                     if columns[3] != 'A' and columns[3] != 'P':
+                        stats.add('filter level', columns[0])
                         continue
                 # process
+                if compact is True:
+                    builder.append(*columns)
+                    continue
                 ##metainfo[columns[0]] = columns[1:]
                 metainfo[columns[0]] = list()
                 for item in columns[1:]:
@@ -196,25 +306,36 @@ def geonames_meta(filename):
     except IOError:
         logger.error('geonames data or empty dictionary object required at this stage')
         sys.exit(1)
+    if compact is True:
+        metainfo = builder.build()
+    stats.report(filename)
     logger.info('different names: %s', len(metainfo))
-    # metainfo.commit()
-    # logger.info('changes committed to DB: %s', len(metainfo))
+    if precompute is True:
+        # deferred import, the geo package depends on the data package
+        from ..geo import geocoding
+        geocoding.reference_cache.precompute(metainfo)
     return metainfo
 
 
 # load codes (while implementing filter)
 ### FILE MUST EXIST, use the preprocessing script provided
-def geonames_codes(filename, metainfo):
+def geonames_codes(filename, metainfo, compact=False, stats=None):
     """
     Load codes from Geonames for matching and disambiguation purposes.
+    Optionally store integer IDs in a read-only table instead of lists of strings (see compact.CodesTable).
+    Rejected lines are counted in the statistics given, by default
+    in new ones added to validators.rejections at the end (see validators.source_stats).
     """
     codesdict = dict()
+    stats = validators.source_stats(stats)
+    if compact is True:
+        builder = PostingsBuilder()
     try:
         with open(filename, 'r', encoding='utf-8') as inputfh:
             for line in inputfh:
                 line = line.strip()
                 columns = re.split('\t', line)
-                if validators.validate_geonames_codes(columns) is False:
+                if validators.validate_geonames_codes(columns, stats) is False:
                     continue
                 # add codes
                 if len(columns) > 2:
@@ -225,33 +346,45 @@ def geonames_codes(filename, metainfo):
                 # load
                 for item in ids:
                     # depends from filter level
-                    if item in metainfo:
-                        if columns[0] not in codesdict:
-                            codesdict[columns[0]] = list()
-                        codesdict[columns[0]].append(item)
+                    if item not in metainfo:
+                        stats.add('not in metainfo', item)
+                        continue
+                    if compact is True:
+                        builder.add(columns[0], item)
+                        continue
+                    if columns[0] not in codesdict:
+                        codesdict[columns[0]] = list()
+                    codesdict[columns[0]].append(item)
     except IOError:
         logger.error('geonames data or empty dictionary object required at this stage')
         sys.exit(1)
+    if compact is True:
+        codesdict = builder.build()
+    stats.report(filename)
     logger.info('different codes: %s', len(codesdict))
     return codesdict
 
 
-def results_tsv(filename):
+def results_tsv(filename, stats=None):
     """
     Open a TSV file containing geoparsing results and load its content into memory.
+    Rejected lines are counted in the statistics given, by default
+    in new ones added to validators.rejections at the end (see validators.source_stats).
     """
     # init
     results = dict()
+    stats = validators.source_stats(stats)
     # read
     with open(filename, 'r', encoding='utf-8') as inputfh:
         for line in inputfh:
             line = line.strip()
             columns = re.split('\t', line)
             # validate
-            if validators.validate_result(columns) is False:
+            if validators.validate_result(columns, stats) is False:
                 continue
             # store
             results[columns[0]] = columns[1:]
 
+    stats.report(filename)
     logger.info('%s entries found in results file %s', len(results), filename)
     return results
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Combination of several custom registers in one lookup structure.
+"""
+
+# compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# standard
+import logging
+import multiprocessing
+
+from collections import Counter
+from collections.abc import Mapping
+from os import path
+
+# own
+from . import load
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+# registers loaded in parallel beyond this total size (in bytes)
+PARALLEL_SIZE = 2**22
+
+
+def load_register(source, cachedir=None):
+    """
+    Load a register given as a filename or a (filename, level) tuple,
+    CSV files are recognized by their extension.
+    """
+    if isinstance(source, str):
+        source = (source, 0)
+    filename, level = source
+    if filename.lower().endswith('.csv'):
+        return load.load_csv(filename, level, cachedir=cachedir)
+    return load.load_tsv(filename, level, cachedir=cachedir)
+
+
+def _load_source(args):
+    """
+    Load a register in a worker process.
+    """
+    return load_register(*args)
+
+
+class RegisterSet(Mapping):
+    """
+    Read-only merge of custom registers, usable as custom_lists in geocoding.search.
+    Sources are files (see load_register) or registers already loaded, they are
+    merged in the given order: an entry with a higher level wins, the last one in
+    case of a tie. Conflicts are counted in the stats attribute.
+    The regex entries of pattern registers (see compact.PatternRegister) are matched
+    at lookup time, only the plain names are listed when iterating over the set.
+    """
+    def __init__(self, sources, workers=None, cachedir=None):
+        self.stats = Counter()
+        self.data = dict()
+        # pattern registers with their position, position of the plain names merged after the first one
+        self.sources = list()
+        self.ranks = dict()
+        for register in self.load(sources, workers, cachedir):
+            self.merge(register)
+        logger.info('%s entries from %s registers, %s conflicts (%s kept, %s replaced)', len(self.data), self.stats['registers'], self.stats['kept'] + self.stats['replaced'], self.stats['kept'], self.stats['replaced'])
+
+    @staticmethod
+    def load(sources, workers=None, cachedir=None):
+        """
+        Load the registers, in a pool of processes for large files (default: one per CPU).
+        """
+        files = [(index, source) for index, source in enumerate(sources) if not isinstance(source, Mapping)]
+        size = sum(path.getsize(source if isinstance(source, str) else source[0]) for _, source in files)
+        registers = list(sources)
+        if workers != 1 and len(files) > 1 and size >= PARALLEL_SIZE:
+            pool = multiprocessing.Pool(min(workers or multiprocessing.cpu_count(), len(files)))
+            try:
+                loaded = pool.map(_load_source, [(source, cachedir) for _, source in files])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            loaded = [load_register(source, cachedir) for _, source in files]
+        for (index, _), register in zip(files, loaded):
+            registers[index] = register
+        return registers
+
+    def merge(self, register):
+        """
+        Add the entries of a register according to their level.
+        """
+        data = self.data
+        number = self.stats['registers']
+        ranks = self.ranks if self.sources or getattr(register, 'patterns', None) else None
+        for name, entry in register.items():
+            current = data.get(name)
+            if current is not None:
+                if current['level'] > entry['level']:
+                    self.stats['kept'] += 1
+                    continue
+                if current != entry:
+                    self.stats['replaced'] += 1
+            data[name] = entry
+            if ranks is not None:
+                ranks[name] = number
+        if getattr(register, 'patterns', None):
+            self.sources.append((number, register))
+            self.stats['patterns'] += len(register.patterns)
+        self.stats['registers'] += 1
+
+    @property
+    def patterns(self):
+        """
+        Regex entries of the pattern registers.
+        """
+        return [pattern for _, register in self.sources for pattern in register.patterns]
+
+    def lookup(self, name):
+        """
+        Return the entry of a name or None, plain names and patterns follow the same precedence rules.
+        """
+        entry = self.data.get(name)
+        if not self.sources:
+            return entry
+        rank = self.ranks.get(name, -1) if entry is not None else -1
+        for number, register in self.sources:
+            result = register.lookup(name)
+            if result is None:
+                continue
+            if entry is None or result[1]['level'] > entry['level'] or (result[1]['level'] == entry['level'] and number > rank):
+                entry, rank = result[1], number
+        return entry
+
+    def __getitem__(self, key):
+        entry = self.lookup(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bool__(self):
+        return bool(self.data or self.sources)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental updates of Geonames registers with the daily modification and deletion files.
+"""
+
+# compatibility
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# standard
+import logging
+import os
+
+from collections import deque
+from os import path
+
+# own
+from .. import settings
+from . import geonames, ingest
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+def read_changes(modifications=None, deletes=None, countrycode=None):
+    """
+    Read local delta files (modifications-YYYY-MM-DD.txt, deletes-YYYY-MM-DD.txt).
+    Modified entries go through the quality control, rejected ones are removed.
+    Returns a dictionary ID: (infotuple, canonical, alternatives) or None for a removal.
+    Several files are applied in the given order, deletions last: use one call per day.
+    """
+    changes = dict()
+    for filename in _aslist(modifications):
+        for line in ingest.iterlines(filename):
+            line = line.decode('utf-8')
+            alternatives, canonical, infotuple = geonames.quality_control(line, countrycode, ingest.UNSEEN)
+            if canonical is not None:
+                changes[infotuple[0]] = (infotuple, canonical, alternatives)
+            else:
+                _remove(changes, line)
+    for filename in _aslist(deletes):
+        for line in ingest.iterlines(filename):
+            _remove(changes, line.decode('utf-8'))
+    logger.info('changes read: %s', len(changes))
+    return changes
+
+
+def _aslist(filenames):
+    """
+    Accept a single filename or a list.
+    """
+    if filenames is None:
+        return list()
+    if isinstance(filenames, str):
+        return [filenames]
+    return filenames
+
+
+def _remove(changes, line):
+    """
+    Mark the entry of a line for removal (Geonames ID in the first column).
+    """
+    nameid = line.split('\t', 1)[0].strip()
+    if nameid.isdigit():
+        changes[nameid] = None
+    else:
+        logger.debug('malformed: %s', line)
+
+
+def reverse_index(codesdict):
+    """
+    Map the IDs to the names they are registered under (one pass over the codes register).
+    """
+    index = dict()
+    for name, ids in codesdict.items():
+        for nameid in ids:
+            index.setdefault(nameid, list()).append(name)
+    return index
+
+
+def apply_changes(changes, codesdict=None, metainfo=None, backend=None, index=None):
+    """
+    Update codes and metainfo registers in place (default: the module registers of geonames)
+    or a database backend (see database.SqliteGazetteer). Returns the IDs which changed.
+    The names of the changed IDs are found in a reverse index (see reverse_index), which is
+    updated as well: pass the same index to successive calls so that their cost only depends
+    on the number of changes.
+    """
+    if backend is not None:
+        backend.remove(changes)
+        for nameid, entry in changes.items():
+            if entry is not None:
+                infotuple, canonical, alternatives = entry
+                backend.store(nameid, canonical, alternatives, infotuple)
+        backend.flush()
+        return set(changes)
+    if codesdict is None:
+        codesdict = geonames.codesdict
+    if metainfo is None:
+        metainfo = geonames.metainfo
+    if index is None:
+        index = reverse_index(codesdict)
+    affected = set(nameid for nameid in changes if nameid in metainfo or changes[nameid] is not None)
+    # remove the old postings
+    for nameid in affected:
+        for name in index.pop(nameid, list()):
+            ids = codesdict.get(name)
+            if ids is None:
+                continue
+            if isinstance(ids, set):
+                ids.discard(nameid)
+            elif nameid in ids:
+                ids.remove(nameid)
+            if not ids:
+                del codesdict[name]
+    # store the new entries
+    for nameid in affected:
+        metainfo.pop(nameid, None)
+        if changes[nameid] is None:
+            continue
+        infotuple, canonical, alternatives = changes[nameid]
+        names = [canonical] + sorted(alternatives)
+        index[nameid] = names
+        for name in names:
+            if name not in codesdict:
+                codesdict[name] = set()
+            if isinstance(codesdict[name], set):
+                codesdict[name].add(nameid)
+            elif nameid not in codesdict[name]:
+                codesdict[name].append(nameid)
+        geonames.store_metainfo(infotuple, register=metainfo)
+    logger.info('entries updated: %s', len(affected))
+    return affected
+
+
+def update_files(codesfile, metafile, changes):
+    """
+    Apply changes to register files written by geonames.writefile (sorted by key).
+    The files are read as a stream, lines which are not concerned are copied as they are.
+    Both files are written anew: the lines vary in length, so a change shifts the rest of
+    the file, and the files are replaced atomically. Changed IDs are spread over the whole
+    files anyway, in the codes file under names which only a full pass can find.
+    """
+    # new metainfo lines and postings
+    newmeta = list()
+    newcodes = dict()
+    for nameid, entry in changes.items():
+        if entry is None:
+            continue
+        infotuple, canonical, alternatives = entry
+        lat, lon = round(float(infotuple[1]), settings.ROUNDING), round(float(infotuple[2]), settings.ROUNDING)
+        newmeta.append((nameid, '\t'.join((nameid, str(lat), str(lon), infotuple[3], infotuple[4], infotuple[5])) + '\n'))
+        for name in [canonical] + sorted(alternatives):
+            newcodes.setdefault(name, list()).append(nameid)
+    newmeta = deque(sorted(newmeta))
+
+    # metainfo: replace, remove and insert lines
+    with _Rewriter(metafile) as (inputfh, outfh):
+        for line in inputfh:
+            key = line.split('\t', 1)[0]
+            while newmeta and newmeta[0][0] < key:
+                outfh.write(newmeta.popleft()[1])
+            if key not in changes:
+                outfh.write(line)
+        for _, newline in newmeta:
+            outfh.write(newline)
+
+    # codes: remove changed IDs, add the new postings
+    pending = deque(sorted(newcodes))
+    with _Rewriter(codesfile) as (inputfh, outfh):
+        for line in inputfh:
+            columns = line.rstrip('\n').split('\t')
+            name = columns[0]
+            while pending and pending[0] < name:
+                added = pending.popleft()
+                if len(added) > 1:
+                    outfh.write(added + '\t' + '\t'.join(newcodes[added]) + '\n')
+            ids = [nameid for nameid in columns[1:] if nameid not in changes]
+            if pending and pending[0] == name:
+                ids.extend(nameid for nameid in newcodes[pending.popleft()] if nameid not in ids)
+            elif len(ids) == len(columns) - 1:
+                outfh.write(line)
+                continue
+            if ids:
+                outfh.write(name + '\t' + '\t'.join(ids) + '\n')
+        for added in pending:
+            if len(added) > 1:
+                outfh.write(added + '\t' + '\t'.join(newcodes[added]) + '\n')
+    logger.info('files updated: %s %s', codesfile, metafile)
+
+
+class _Rewriter(object):
+    """
+    Read a file and write its new version next to it, the original is replaced on success.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.tempname = path.join(path.dirname(path.abspath(filename)), '.' + path.basename(filename) + '.tmp')
+
+    def __enter__(self):
+        self.inputfh = open(self.filename, 'r', encoding='utf-8')
+        self.outfh = open(self.tempname, 'w', encoding='utf-8')
+        return self.inputfh, self.outfh
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.inputfh.close()
+        self.outfh.close()
+        if exc_type is None:
+            os.replace(self.tempname, self.filename)
+        else:
+            os.remove(self.tempname)
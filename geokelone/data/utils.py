@@ -7,14 +7,23 @@ External tools for data manipulation.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 # standard
+import hashlib
+import json
 import logging
-import ssl
+import os
+import shutil
+import tempfile
+import threading
+import time
 import urllib3
 
+from collections import Counter
+from io import BytesIO
+
 # extra
 import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.poolmanager import PoolManager
+
+from .. import settings
 
 
 # logging
@@ -24,20 +33,276 @@ logger = logging.getLogger(__name__)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
-# download pool manager
-class MyAdapter(HTTPAdapter):
-    """Customize HTTPS support for requests (may not be necessary anymore)"""
-    def init_poolmanager(self, connections, maxsize, block=False):
-        self.poolmanager = PoolManager(num_pools=connections, maxsize=maxsize, block=block, ssl_version=ssl.PROTOCOL_TLSv1, timeout=10.0)
-
+# shared connection pool, the TLS version is negotiated
 session = requests.Session()
-session.mount('https://', MyAdapter())
+
+# optional on-disk cache of the responses (see ResponseCache)
+cache = None
+
+
+class ResponseCache(object):
+    """
+    Persistent cache of HTTP responses: the bodies are stored once under their SHA-256
+    digest and the URLs point to them along with the ETag and Last-Modified headers.
+    Entries older than the TTL (in seconds) are revalidated with a conditional request,
+    the least recently used ones are discarded beyond a total size (in bytes).
+    In offline mode the responses are only served from the cache.
+    The sizes and last uses are kept in an index read once from the directory,
+    the last use of an entry is written to disk at most once per USE_RESOLUTION seconds.
+    """
+    USE_RESOLUTION = 3600
+
+    def __init__(self, directory, ttl=86400, max_size=2**32, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.lock = threading.RLock()
+        # entry file name: (last use, size, digest), with the number of entries per body
+        self.index = None
+        self.refs = Counter()
+        self.total = 0
+        for subdirectory in ('entries', 'objects'):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+    def entry_path(self, url):
+        """
+        Path of the file describing a URL.
+        """
+        return os.path.join(self.directory, 'entries', hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+    def object_path(self, digest):
+        """
+        Path of a stored response body.
+        """
+        return os.path.join(self.directory, 'objects', digest)
+
+    def lookup(self, url):
+        """
+        Return the entry of a URL or None if it is not cached.
+        """
+        try:
+            with open(self.entry_path(url), 'r', encoding='utf-8') as inputfh:
+                entry = json.load(inputfh)
+        except (IOError, ValueError):
+            return None
+        if entry.get('url') != url or not os.path.exists(self.object_path(entry['digest'])):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        """
+        Test if an entry has been validated within the TTL.
+        """
+        return time.time() - entry['validated'] < self.ttl
+
+    @staticmethod
+    def conditional_headers(entry):
+        """
+        Headers used to revalidate an entry.
+        """
+        headers = dict()
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def copy(self, entry, outputfh):
+        """
+        Write a cached body to a file object.
+        """
+        with open(self.object_path(entry['digest']), 'rb') as inputfh:
+            shutil.copyfileobj(inputfh, outputfh)
+
+    def touch(self, entry):
+        """
+        Mark an entry as used, the entry file is only rewritten if its last use is old.
+        """
+        now = time.time()
+        with self.lock:
+            if now - entry['used'] >= self.USE_RESOLUTION:
+                entry['used'] = now
+                self.write_entry(entry)
+            elif self.index is not None:
+                self.track(os.path.basename(self.entry_path(entry['url'])), dict(entry, used=now))
+
+    def write_entry(self, entry):
+        """
+        Write the description of a URL (atomic replacement), returns the body which is not used anymore if any.
+        """
+        filename = self.entry_path(entry['url'])
+        with self.lock:
+            with open(filename + '.tmp%s' % threading.get_ident(), 'w', encoding='utf-8') as outfh:
+                json.dump(entry, outfh)
+            os.replace(outfh.name, filename)
+            if self.index is not None:
+                return self.track(os.path.basename(filename), entry)
+        return None
+
+    def load_index(self):
+        """
+        Read the entries once, the index is then updated along with the cache.
+        """
+        with self.lock:
+            self.index, self.refs, self.total = dict(), Counter(), 0
+            for filename in os.listdir(os.path.join(self.directory, 'entries')):
+                if not filename.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(self.directory, 'entries', filename), 'r', encoding='utf-8') as inputfh:
+                        self.track(filename, json.load(inputfh))
+                except (IOError, KeyError, ValueError):
+                    continue
+
+    def track(self, filename, entry):
+        """
+        Update the index entry of a file, returns the body which is not used anymore if any.
+        """
+        released = None
+        if filename in self.index:
+            released = self.untrack(filename)
+        self.index[filename] = (entry['used'], entry['size'], entry['digest'])
+        if self.refs[entry['digest']] == 0:
+            self.total += entry['size']
+        self.refs[entry['digest']] += 1
+        return released if released != entry['digest'] else None
+
+    def untrack(self, filename):
+        """
+        Remove a file from the index, returns the body which is not used anymore if any.
+        """
+        _, size, digest = self.index.pop(filename)
+        self.refs[digest] -= 1
+        if self.refs[digest] > 0:
+            return None
+        del self.refs[digest]
+        self.total -= size
+        return digest
+
+    def store(self, url, response, outputfh, chunksize=2**20):
+        """
+        Stream a response to a file object and to the cache, returns the new entry.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        complete = False
+        tmpfile = tempfile.NamedTemporaryFile(dir=os.path.join(self.directory, 'objects'), delete=False)
+        try:
+            with tmpfile:
+                for chunk in response.iter_content(chunk_size=chunksize):
+                    outputfh.write(chunk)
+                    tmpfile.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            complete = True
+        finally:
+            # interrupted download
+            if complete is False:
+                os.remove(tmpfile.name)
+        now = time.time()
+        entry = {
+            'url': url,
+            'digest': digest.hexdigest(),
+            'size': size,
+            'encoding': response.encoding,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'validated': now,
+            'used': now,
+        }
+        with self.lock:
+            if self.index is None:
+                self.load_index()
+            # identical bodies are stored once
+            os.replace(tmpfile.name, self.object_path(entry['digest']))
+            released = self.write_entry(entry)
+            if released is not None:
+                self.remove_object(released)
+        self.evict()
+        return entry
+
+    def remove_object(self, digest):
+        """
+        Delete a body which is not used anymore.
+        """
+        try:
+            os.remove(self.object_path(digest))
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Discard the least recently used entries and their bodies if the maximum size is exceeded.
+        """
+        with self.lock:
+            if self.index is None:
+                self.load_index()
+            if self.total <= self.max_size:
+                return
+            for filename in sorted(self.index, key=lambda name: self.index[name][0]):
+                if self.total <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, 'entries', filename))
+                except OSError:
+                    pass
+                released = self.untrack(filename)
+                if released is not None:
+                    self.remove_object(released)
+                logger.debug('removed from cache: %s', filename)
+
+    def fetch(self, url, outputfh):
+        """
+        Write the body of a response to a file object, from the cache if possible.
+        Returns the entry or None if the request failed.
+        """
+        entry = self.lookup(url)
+        if entry is not None and (self.offline or self.is_fresh(entry)):
+            logger.debug('served from cache: %s', url)
+            self.copy(entry, outputfh)
+            self.touch(entry)
+            return entry
+        if self.offline:
+            logger.error('offline mode, not in cache: %s', url)
+            return None
+        headers = self.conditional_headers(entry) if entry is not None else dict()
+        try:
+            response = session.get(url, verify=False, stream=True, headers=headers, timeout=settings.TIMEOUT)
+        except requests.exceptions.RequestException as err:
+            logger.error('request failed for url %s: %s', url, err)
+            return None
+        try:
+            if entry is not None and response.status_code == requests.codes.not_modified:
+                logger.debug('revalidated: %s', url)
+                entry['validated'] = entry['used'] = time.time()
+                self.copy(entry, outputfh)
+                self.write_entry(entry)
+                return entry
+            if response.status_code != requests.codes.ok:
+                logger.error('problem with response (%s) for url %s', response.status_code, url)
+                return None
+            return self.store(url, response, outputfh)
+        finally:
+            response.close()
 
 
 def send_request(query_url, returnbytes=False):
-    """Send a request over the network."""
+    """Send a request over the network (or read the response from the cache)."""
     logger.debug('sending request %s', query_url)
-    request = session.get(query_url, verify=False)
+    if cache is not None:
+        outputfh = BytesIO()
+        entry = cache.fetch(query_url, outputfh)
+        if entry is None:
+            return None
+        if returnbytes is True:
+            return outputfh.getvalue()
+        return outputfh.getvalue().decode(entry['encoding'] or 'utf-8', errors='replace')
+    try:
+        request = session.get(query_url, verify=False, timeout=settings.TIMEOUT)
+    except requests.exceptions.RequestException as err:
+        logger.error('request failed for url %s: %s', query_url, err)
+        return None
     if request.status_code != requests.codes.ok:
         logger.error('problem with response (%s) for url %s', request.status_code, query_url)
         return None
@@ -45,3 +310,23 @@ def send_request(query_url, returnbytes=False):
         return request.content
     else:
         return request.text
+
+
+def download(query_url, outputfh, chunksize=2**20):
+    """Write the content of a response to a binary file object without holding it in memory."""
+    logger.debug('downloading %s', query_url)
+    if cache is not None:
+        return cache.fetch(query_url, outputfh) is not None
+    try:
+        request = session.get(query_url, verify=False, stream=True, timeout=settings.TIMEOUT)
+    except requests.exceptions.RequestException as err:
+        logger.error('request failed for url %s: %s', query_url, err)
+        return False
+    if request.status_code != requests.codes.ok:
+        logger.error('problem with response (%s) for url %s', request.status_code, query_url)
+        request.close()
+        return False
+    for chunk in request.iter_content(chunk_size=chunksize):
+        outputfh.write(chunk)
+    request.close()
+    return True
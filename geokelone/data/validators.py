@@ -12,6 +12,8 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import logging
 import re
 
+from collections import Counter
+
 # own
 from .. import settings
 
@@ -21,6 +23,104 @@ logger = logging.getLogger(__name__)
 # locale
 # locale.setlocale(locale.LC_ALL, settings.LOCALE)
 
+# non-word characters (and out of Unicode charset)
+UNSUITABLE_CHARS = re.compile(r'[^\w .&-]')
+# input formats
+TOKEN = re.compile(r'[^ \t\n\r\f\v]{1,200}$')
+TAGGED = re.compile(r'[^\t]+?\t[A-Z$,().-]+') # ?\t.+$
+NUMBER = re.compile(r'[0-9.-]+$')
+WORD = re.compile(r'\w')
+
+
+class RejectionStats(Counter):
+    """
+    Rejected input counted by reason, with the first samples of each reason.
+    Per-line log messages are only written in verbose mode.
+    Statistics with a parent add their counts to it when they are reported.
+    """
+    def __init__(self, samples=5, verbose=False, parent=None):
+        super(RejectionStats, self).__init__()
+        self.maxsamples = samples
+        self.verbose = verbose
+        self.parent = parent
+        self.samples = dict()
+
+    def add(self, reason, sample=None):
+        """
+        Count a rejection and keep the sample if there are not enough yet.
+        """
+        self[reason] += 1
+        if self.verbose is True:
+            logger.warning('%s: %s', reason, sample)
+        samples = self.samples.setdefault(reason, list())
+        if len(samples) < self.maxsamples:
+            samples.append(sample)
+
+    def extend(self, reason, samples):
+        """
+        Count a list of rejections for the same reason.
+        """
+        for sample in samples:
+            self.add(reason, sample)
+
+    def merge(self, other):
+        """
+        Add the counts and samples of other statistics (e.g. from a worker process).
+        """
+        self.update(other)
+        for reason, samples in other.samples.items():
+            mine = self.samples.setdefault(reason, list())
+            mine.extend(samples[:self.maxsamples - len(mine)])
+
+    def clear(self):
+        super(RejectionStats, self).clear()
+        self.samples.clear()
+
+    def summary(self):
+        """
+        Counts and samples by reason.
+        """
+        return dict((reason, {'count': count, 'samples': list(self.samples.get(reason, list()))}) for reason, count in self.most_common())
+
+    def log(self, source):
+        """
+        Write one message with the counts.
+        """
+        if self:
+            logger.info('%s: %s rejected (%s)', source, sum(self.values()), ', '.join('%s: %s' % item for item in self.most_common()))
+
+    def report(self, source):
+        """
+        Log the counts of a processed source and add them to the parent statistics.
+        """
+        self.log(source)
+        if self.parent is not None:
+            self.parent.merge(self)
+
+    def __reduce__(self):
+        return (self.__class__, (self.maxsamples, self.verbose), {'samples': self.samples}, None, iter(self.items()))
+
+
+# rejected input by reason when no other statistics are given, instead of a log message per line
+rejections = RejectionStats()
+
+
+def reject(stats, reason, sample=None):
+    """
+    Record a rejection in the given statistics or in the module ones.
+    """
+    (rejections if stats is None else stats).add(reason, sample)
+
+
+def source_stats(stats=None):
+    """
+    Statistics for a single source (e.g. a file): the given ones or new ones which are
+    added to the module statistics (validators.rejections) once the source is reported.
+    """
+    if stats is None:
+        return RejectionStats(parent=rejections)
+    return stats
+
 
 def validate_text(text):
     """
@@ -30,140 +130,220 @@ def validate_text(text):
     return True
 
 
-def validate_tok(line):
+def validate_tok(line, stats=None):
     """
     Validate tokenized input format.
     """
-    if re.match(r'[^ \t\n\r\f\v]{1,200}$', line):
+    if TOKEN.match(line):
         return True
+    reject(stats, 'token', line)
     return False
 
 
-def validate_tagged(line):
+def validate_tagged(line, stats=None):
     """
     Validate tokenized and tagged input format: two or three columns.
     """
-    if re.match(r'[^\t]+?\t[A-Z$,().-]+', line): # ?\t.+$
+    if TAGGED.match(line):
         return True
+    reject(stats, 'tagged', line)
     return False
 
 
-def validate_csv_registry(columns):
+def validate_csv_registry(columns, stats=None):
     """
     Validate CSV registry data.
     """
     # four columns expected
     if len(columns) != 4:
-        logger.warning('csv registry line not conform: %s', columns)
+        reject(stats, 'registry', columns)
         return False
     # coordinates
-    if validate_latlon(columns[2], columns[3]) is False:
-        logger.warning('coordinates not conform: %s %s', columns[2], columns[3])
-        return False
-    
-    return True
+    return validate_latlon(columns[2], columns[3], stats)
 
 
-def validate_tsv_registry(columns):
+def validate_tsv_registry(columns, stats=None):
     """
     Validate TSV registry data.
     """
     # three columns expected
     if len(columns) != 3:
-        logger.warning('tsv registry line not conform: %s', columns)
+        reject(stats, 'registry', columns)
         return False
     # coordinates
-    if validate_latlon(columns[1], columns[2]) is False:
-        logger.warning('coordinates not conform: %s %s', columns[1], columns[2])
-        return False
-    return True
+    return validate_latlon(columns[1], columns[2], stats)
+
 
+def check_entry(name):
+    """
+    Test if a name is suitable as a register entry without recording anything (e.g. at lookup time).
+    """
+    return len(name) >= settings.MINLENGTH and name.count(' ') < 3 and UNSUITABLE_CHARS.search(name) is None
 
-def validate_entry(name):
+
+def validate_entry(name, stats=None):
     # length filter
     if len(name) < settings.MINLENGTH:
-        logger.debug('entry too short: %s', name)
+        reject(stats, 'entry too short', name)
         return False
     # too many spaces
     elif name.count(' ') >= 3:
-        logger.debug('too many spaces: %s', name)
+        reject(stats, 'too many spaces', name)
         return False
     # refuse non-word characters (and out of Unicode charset)
-    elif re.search(r'[^\w .&-]', name): # , re.LOCALE Python 3.6 locale error
-        logger.debug('contains unsuitable characters: %s', name)
+    elif UNSUITABLE_CHARS.search(name): # , re.LOCALE Python 3.6 locale error
+        reject(stats, 'unsuitable characters', name)
         return False
     # catchall
     return True
 
 
-def validate_geonames_registry(columns):
+def mask_entries(names, stats=None):
+    """
+    Batch version of validate_entry: list of booleans for a list of names.
+    """
+    minlength = settings.MINLENGTH
+    unsuitable = UNSUITABLE_CHARS.search
+    mask = [len(name) >= minlength and name.count(' ') < 3 and unsuitable(name) is None for name in names]
+    if False in mask:
+        # reasons of the rejections
+        for name, valid in zip(names, mask):
+            if not valid:
+                validate_entry(name, stats)
+    return mask
+
+
+def mask_tok(lines, stats=None):
+    """
+    Batch version of validate_tok.
+    """
+    match = TOKEN.match
+    mask = [match(line) is not None for line in lines]
+    if False in mask:
+        (rejections if stats is None else stats).extend('token', [line for line, valid in zip(lines, mask) if not valid])
+    return mask
+
+
+def mask_tagged(lines, stats=None):
+    """
+    Batch version of validate_tagged.
+    """
+    match = TAGGED.match
+    mask = [match(line) is not None for line in lines]
+    if False in mask:
+        (rejections if stats is None else stats).extend('tagged', [line for line, valid in zip(lines, mask) if not valid])
+    return mask
+
+
+def validate_geonames_registry(columns, stats=None):
     """
     Validate geonames registry data.
     """
     # formal validation
     if len(columns) != 6:
-        logger.warning('geonames metainfo line not conform: %s', ' '.join(columns))
+        reject(stats, 'geonames', columns)
         return False
     # metadata
-    if not columns[0].isdigit() or not re.match(r'[0-9.-]+$', columns[1]) or not re.match(r'[0-9.-]+$', columns[2]):
-        logger.warning('geonames metainfo line not conform: %s %s %s', columns[0], columns[1], columns[2])
+    if not columns[0].isdigit() or not NUMBER.match(columns[1]) or not NUMBER.match(columns[2]):
+        reject(stats, 'geonames', columns)
         return False
-    if not columns[5].isdigit() or int(columns[5]) < 0:
-        logger.warning('value error for population: %s', columns[5])
+    if not columns[5].isdigit():
+        reject(stats, 'population', columns)
         return False
-    return validate_latlon(columns[1], columns[2])
+    return validate_latlon(columns[1], columns[2], stats)
     # default
     # return True
 
 
-def validate_geonames_codes(columns):
+def mask_geonames_registry(rows, stats=None):
+    """
+    Batch version of validate_geonames_registry for lists of columns.
+    """
+    if stats is None:
+        stats = rejections
+    match = NUMBER.match
+    mask = list()
+    append = mask.append
+    for columns in rows:
+        if len(columns) != 6 or not columns[0].isdigit() or not match(columns[1]) or not match(columns[2]):
+            stats.add('geonames', columns)
+            append(False)
+        elif not columns[5].isdigit():
+            stats.add('population', columns)
+            append(False)
+        else:
+            # the pattern only lets through numbers or strings like '1-2'
+            try:
+                lat, lon = float(columns[1]), float(columns[2])
+            except ValueError:
+                stats.add('coordinates', (columns[1], columns[2]))
+                append(False)
+                continue
+            valid = -90 <= lat <= 90 and -180 <= lon <= 180
+            if not valid:
+                stats.add('coordinates', (columns[1], columns[2]))
+            append(valid)
+    return mask
+
+
+def validate_geonames_codes(columns, stats=None):
     """
     Validate geonames code data.
     """
     # formal validation
     # TODO: add column by column validation for multiple columns
     if len(columns) < 2 or not columns[-1].isdigit():
-        logger.warning('geonames code line not conform: %s', columns)
+        reject(stats, 'codes', columns)
         return False
     # form filter
-    if validate_entry(columns[0]) is False:
-        logger.debug('entry refused: %s', columns[0])
-        return False
-    return True
+    return validate_entry(columns[0], stats)
 
 
-def validate_latlon(lat, lon):
+def validate_latlon(lat, lon, stats=None):
     """
     Validate coordinates (latitude and longitude).
     """
     try:
-        # latitude
-        if float(lat) > 90 or float(lat) < -90:
-            logger.warning('latitude out of bounds: %s', lat)
-            return False
-        # longitude
-        if float(lon) > 180 or float(lon) < -180:
-            logger.warning('longitude out of bounds: %s', lon)
-            return False
-        return True
-    except ValueError:
-        logger.warning('problem with coordinates: %s %s', lat, lon)
+        latitude, longitude = float(lat), float(lon)
+    except (TypeError, ValueError):
+        reject(stats, 'coordinates', (lat, lon))
+        return False
+    # latitude and longitude (also excludes NaN)
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        reject(stats, 'coordinates', (lat, lon))
         return False
+    return True
 
 
-def validate_mapdata(dicentry, map_boundaries=[settings.WESTMOST, settings.EASTMOST, settings.SOUTHMOST, settings.NORTHMOST]):
+def mask_latlon(lats, lons, stats=None):
+    """
+    Batch version of validate_latlon for two lists of values.
+    """
+    mask = list()
+    append = mask.append
+    for lat, lon in zip(lats, lons):
+        try:
+            append(-90 <= float(lat) <= 90 and -180 <= float(lon) <= 180)
+        except (TypeError, ValueError):
+            append(False)
+    if False in mask:
+        (rejections if stats is None else stats).extend('coordinates', [pair for pair, valid in zip(zip(lats, lons), mask) if not valid])
+    return mask
+
+
+def validate_mapdata(dicentry, map_boundaries=[settings.WESTMOST, settings.EASTMOST, settings.SOUTHMOST, settings.NORTHMOST], stats=None):
     """
     Validate metadata imported from registries.
     """
     if len(dicentry) < 8:
-        logger.warning('malformed result line: %s', dicentry)
+        reject(stats, 'mapdata', dicentry)
         return False
     # toponym
     #if 'place' not in dicentry:
     #    logger.warning('empty key in dict: %s', dicentry)
     #    return False
-    if not re.search(r'\w', dicentry[5]):
-        logger.warning('malformed entry name: %s', dicentry[6])
+    if not WORD.search(dicentry[5]):
+        reject(stats, 'mapdata', dicentry)
         return False
     # coordinates
     #if 'lat' not in dicentry or 'lon' not in dicentry:
@@ -173,44 +353,37 @@ def validate_mapdata(dicentry, map_boundaries=[settings.WESTMOST, settings.EASTM
         lat = float(dicentry[0])
         lon = float(dicentry[1])
     except ValueError:
-        logger.warning('malformed coordinates: %s %s', dicentry[1], dicentry[2])
+        reject(stats, 'coordinates', (dicentry[0], dicentry[1]))
         return False
     # return validate_latlon(dicentry['lat'], dicentry['lon'])
-    if validate_latlon(lat, lon) is False:
-        logger.warning('problem with coordinates: %s %s', dicentry[1], dicentry[2])
+    if validate_latlon(lat, lon, stats) is False:
         return False
     if not map_boundaries[0] < lon < map_boundaries[1] or not map_boundaries[2] < lat < map_boundaries[3]:
-        logger.warning('off map, discarding entry: %s %s %s', dicentry[0], dicentry[1], dicentry[2])
+        reject(stats, 'off map', dicentry)
         return False
     return True
     
 
 
-def validate_result(columns):
+def validate_result(columns, stats=None):
     """
     Validate result from geoparsing.
     """
     # columns
     if len(columns) != 9:
-        logger.debug('malformed entry: %s', columns)
+        reject(stats, 'result', columns)
         return False
     # numeric id
     #if not columns[0].isdigit():
     #    logger.debug('malformed id: %s', columns[0])
     #    return False
     # name
-    if validate_entry(columns[6]) is False:
-        logger.debug('malformed place name: %s', columns[6])
+    if validate_entry(columns[6], stats) is False:
         return False
     # coordinates
-    if validate_latlon(columns[1], columns[2]) is False:
-        logger.debug('malformed coordinates: %s %s', columns[1], columns[2])
-        return False
+    return validate_latlon(columns[1], columns[2], stats)
     # TODO: type?
 
-    # catchall
-    return True
-
 
 ## TODO:
 # def validate_WKT():
@@ -7,12 +7,17 @@ Tools for data collection from Wikipedia and Wikidata.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 # standard
+import json
 import logging
 import re
 import ssl
+import threading
+import time
 import urllib3
 
-from time import sleep
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
 
 # extra
 import requests
@@ -35,77 +40,161 @@ from .. import settings
 logger = logging.getLogger(__name__)
 
 
+# API endpoint, the language code is inserted
+API_URL = 'https://{}.wikipedia.org/w/api.php'
+# maximum number of titles per query allowed by the API
+BATCH_SIZE = 50
+# namespace of the categories
+CATEGORY_NAMESPACE = 14
+# lists of entries
+LISTS = re.compile(r'Liste? ')
+
+
+class RateLimiter(object):
+    """Spread requests over time for all threads (default rate: settings.REQUESTS_PER_SECOND)"""
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next = 0.0
+
+    def wait(self):
+        """Block until the next request is allowed"""
+        rate = self.rate if self.rate is not None else settings.REQUESTS_PER_SECOND
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next)
+            self.next = start + (1 / rate if rate else 0)
+        if start > now:
+            time.sleep(start - now)
+
+
+# shared by all queries of the module
+limiter = RateLimiter()
+
+
+def parse_category_members(jsonresponse):
+    """Extract the members (title and namespace) and the continuation code in the API response"""
+    try:
+        response = json.loads(jsonresponse)
+        members = response['query']['categorymembers']
+    except (KeyError, TypeError, ValueError):
+        logger.warning('Unexpected response: %s', jsonresponse[:100])
+        return None, list()
+    newmembers = list()
+    for member in members:
+        # filter: parentheses and lists
+        if '(' not in member['title'] and not LISTS.match(member['title']):
+            newmembers.append(member)
+    return response.get('continue', dict()).get('cmcontinue'), newmembers
+
+
 def parse_json_response(jsonresponse):
     """Extract crucial elements in the API response"""
-    newmembers = list()
-    # extract
-    for match in re.finditer(r'"title":"(.+?)"', jsonresponse):
-        try:
-            title = match.group(1)
-        except AttributeError:
-            logger.warning('Unexpected response for query %s', query_url)
-        else:
-            # filter: parentheses and lists
-            if not re.search(r'\(', title) and not re.match(r'Liste? ', title):
-                newmembers.append(title) #.decode('unicode-escape'))
-                # outputfh.write(line + '\t' + title.decode('unicode-escape') + '\n')
-    if 'cmcontinue' in jsonresponse:
-        continuecode = re.search(r'"cmcontinue":"(.+?)"', jsonresponse).group(1)
-    else:
-        continuecode = None
-    return continuecode, newmembers
-
-
-def navigate_category(name, language='en'):
+    continuecode, newmembers = parse_category_members(jsonresponse)
+    return continuecode, [member['title'] for member in newmembers]
+
+
+def iter_category(name, language='en', depth=0, api_url=API_URL, visited=None):
+    """Yield the members of a category as the result pages arrive, subcategories are explored
+       breadth-first up to a given depth and returned as members beyond it. Each title
+       is only seen once (visited set, can be shared between calls)."""
+    if visited is None:
+        visited = set()
+    visited.add(name)
+    queue = deque([(name, 0)])
+    while queue:
+        category, level = queue.popleft()
+        logger.info('processing category %s with language code %s', category, language)
+        params = {'action': 'query', 'list': 'categorymembers', 'format': 'json', 'cmlimit': 500, 'cmtitle': category}
+        while True:
+            # send request
+            limiter.wait()
+            result = utils.send_request(api_url.format(language) + '?' + urlencode(params))
+            if result is None:
+                break
+            # parse response
+            continuecode, newmembers = parse_category_members(result)
+            for member in newmembers:
+                if member['title'] in visited:
+                    continue
+                visited.add(member['title'])
+                if member.get('ns') == CATEGORY_NAMESPACE and level < depth:
+                    queue.append((member['title'], level + 1))
+                else:
+                    yield member['title']
+            if continuecode is None:
+                break
+            params['cmcontinue'] = continuecode
+
+
+def navigate_category(name, language='en', depth=0):
     """Takes a category name as input and returns all category members"""
-    # init
-    flag = 1
-    members = list()
-    logger.info('processing category %s with language code %s', name, language)
-    # loop
-    while flag > 0:
-        # determine URL structure
-        if flag == 1:
-            query_url = 'https://' + language + '.wikipedia.org/w/api.php?action=query&list=categorymembers&format=json&cmlimit=500&cmtitle=' + name
-        elif flag == 2:
-            query_url = 'https://' + language + '.wikipedia.org/w/api.php?action=query&list=categorymembers&format=json&cmlimit=500&cmtitle=' + name + '&cmcontinue=' + continuecode
-        # send request
-        result = utils.send_request(query_url)
-        if result is None:
-            return list()
-        # parse response
-        continuecode, newmembers = parse_json_response(result)
-        if continuecode is not None:
-            flag = 2
-        else:
-            flag = 0
-        members = members + newmembers
-        # throttle
-        sleep(0.5)
-    return members
+    return list(iter_category(name, language, depth))
 
 
 def find_coordinates(name, language='en'):
     """Find coordinates for given wikipedia entry"""
-    # init
-    query_url = 'https://' + language + '.wikipedia.org/w/api.php?action=query&format=json&prop=coordinates&titles=' + name
+    return find_coordinates_batch([name], language)[name]
+
+
+def find_coordinates_batch(names, language='en', api_url=API_URL):
+    """Find coordinates for up to 50 wikipedia entries in a single query, returns a dictionary name: (lat, lon)"""
+    results = dict((name, (None, None)) for name in names)
+    query_url = api_url.format(language) + '?' + urlencode({'action': 'query', 'format': 'json', 'prop': 'coordinates', 'titles': '|'.join(names)})
     # send request
+    limiter.wait()
     result = utils.send_request(query_url)
-    if result is not None:
-        try:
-            latitude = re.search(r'"lat":(-?[0-9\.]+?),', result).group(1)
-            longitude = re.search(r'"lon":(-?[0-9\.]+?),', result).group(1)
-        except AttributeError:
-            logger.warning('Unexpected response for query %s', query_url)
-            # outputfh.write(line + '\t' + '' + '\t' + '' + '\n')
-        else:
-            if validators.validate_latlon(latitude, longitude) is True:
-                 # round
-                return round(float(latitude), settings.ROUNDING), round(float(longitude), settings.ROUNDING)
-            # sleep(0.25)
-            # outputfh.write(line + '\t' + latitude + '\t' + longitude + '\n')
-    # catchall
-    return None, None
+    if result is None:
+        return results
+    try:
+        query = json.loads(result)['query']
+    except (KeyError, ValueError):
+        logger.warning('Unexpected response for query %s', query_url)
+        return results
+    # titles as given in the query
+    original = dict((item['to'], item['from']) for item in query.get('normalized', list()))
+    for page in query.get('pages', dict()).values():
+        if 'coordinates' not in page:
+            continue
+        latitude, longitude = page['coordinates'][0]['lat'], page['coordinates'][0]['lon']
+        if validators.validate_latlon(latitude, longitude) is True:
+            # round
+            results[original.get(page['title'], page['title'])] = round(float(latitude), settings.ROUNDING), round(float(longitude), settings.ROUNDING)
+    return results
+
+
+def iter_coordinates(names, language='en', workers=4, batchsize=BATCH_SIZE, api_url=API_URL):
+    """Find coordinates for entries with concurrent batched queries, the input is
+       consumed as it comes (e.g. from iter_category) and (name, lat, lon) tuples
+       are yielded in its order"""
+    pending = deque()
+    batch = list()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for name in names:
+            batch.append(name)
+            if len(batch) < batchsize:
+                continue
+            pending.append((batch, executor.submit(find_coordinates_batch, batch, language, api_url)))
+            batch = list()
+            # bounded number of queries in progress
+            while len(pending) > workers or (pending and pending[0][1].done()):
+                done, future = pending.popleft()
+                coordinates = future.result()
+                for item in done:
+                    yield (item,) + coordinates[item]
+        if batch:
+            pending.append((batch, executor.submit(find_coordinates_batch, batch, language, api_url)))
+        while pending:
+            done, future = pending.popleft()
+            coordinates = future.result()
+            for item in done:
+                yield (item,) + coordinates[item]
+
+
+def harvest_coordinates(names, language='en', workers=4, batchsize=BATCH_SIZE, api_url=API_URL):
+    """Find coordinates for a list of entries with concurrent batched queries,
+       returns (name, lat, lon) tuples in the order of the input"""
+    return list(iter_coordinates(names, language, workers, batchsize, api_url))
 
 
 #def process_categories(categories):
@@ -117,27 +206,24 @@ def find_coordinates(name, language='en'):
 #    return
 
 
-def process_todolist(filename, outputfile=None, categories=False): # , language='en'
-    """Processes a list of entries (one entry per line)"""
+def process_todolist(filename, outputfile=None, categories=False, workers=4, depth=0): # , language='en'
+    """Processes a list of entries (one entry per line), with categories: their members
+       (subcategories up to a given depth), looked up while the categories are read"""
     # init
     if outputfile is None:
         outputfile = filename + '_output.tsv'
     logger.info('reading from input file %s and appending to output file %s', filename, outputfile)
     # process
     with open(filename, 'r', encoding='utf-8') as inputfh, open(outputfile, 'a', encoding='utf-8') as outputfh:
-        for line in inputfh:
-            line = line.strip()
-            if categories is True:
-                for member in navigate_category(line):
-                    lat, lon = find_coordinates(member)
-                    if lat is not None:
-                        outputfh.write(member + '\t' + str(lat) + '\t' + str(lon) + '\n')
-                    else:
-                        logger.warning('no coordinates found for entry %s', member)
+        lines = (line.strip() for line in inputfh)
+        if categories is True:
+            visited = set()
+            entries = (member for line in lines for member in iter_category(line, depth=depth, visited=visited))
+        else:
+            entries = lines
+        for entry, lat, lon in iter_coordinates(entries, workers=workers):
+            if lat is not None:
+                outputfh.write(entry + '\t' + str(lat) + '\t' + str(lon) + '\n')
             else:
-                lat, lon = find_coordinates(line)
-                if lat is not None:
-                    outputfh.write(line + '\t' + str(lat) + '\t' + str(lon) + '\n')
-                else:
-                    logger.warning('no coordinates found for entry %s', line)
+                logger.warning('no coordinates found for entry %s', entry)
     return
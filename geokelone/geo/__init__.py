@@ -6,9 +6,11 @@ Collection of geographical information extraction and mapping functions
 
 from . import geocoding
 from . import mapping
+from . import matching
 
 __all__ = [
     'geocoding',
     'mapping',
+    'matching',
 ]
 
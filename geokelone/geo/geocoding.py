@@ -4,15 +4,21 @@ Geocoding and disambiguation functions needed to extract and resolve place names
 """
 
 
+import json
 import logging
+import multiprocessing
 import re
 import sys
+import threading
 
+from collections import OrderedDict
 from heapq import nlargest
 from math import asin, atan, atan2, cos, radians, sin, sqrt, tan
-# from sqlitedict import SqliteDict
+
+import numpy as np
 
 from .. import settings
+from ..text import readfile
 
 
 # logging
@@ -29,11 +35,15 @@ lines = list()
 lastcountry = ''
 pair = list()
 pair_counter = 0
+# optional memory of disambiguation results (see DisambiguationMemo)
+memo = None
 
-# logger.info('settings: %s', settings.MINLENGTH)
+# longest chain of tokens examined
+WINDOW_SIZE = 3
+# tokens which reset the multi-word scan
+BOUNDARY = re.compile(r'[.!?…,;:–]')
 
-# DB
-# DBPATH = './metainfo.sqlite'
+# logger.info('settings: %s', settings.MINLENGTH)
 
 
 def haversine(point1, point2):
@@ -41,7 +51,7 @@ def haversine(point1, point2):
     Calculate the great circle distance between two points on the Earth (specified in decimal degrees) using spherical geometry with a mean radius.
     """
     # short-circuit coincident points
-    if point1[0] == point1[1] and point2[0] == point2[1]:
+    if point1[0] == point2[0] and point1[1] == point2[1]:
         return 0.0
     # http://stackoverflow.com/questions/4913349/haversine-formula-in-python-bearing-and-distance-between-two-gps-points#4913653
     # https://github.com/mapado/haversine/
@@ -124,185 +134,733 @@ def vincenty(point1, point2, max_iter=200):
     return round(s, 5)
 
 
-def disambiguate(candidates, step, metainfo):
+def _coordinates(points1, points2):
     """
-    Determine the most probable entry among candidates.
+    Convert two sets of points to arrays of latitudes and longitudes of equal length.
     """
-    # test if list
-    if not isinstance(candidates, list):
-        logger.error('type, not a list: %s, %s', type(candidates), candidates)
-        return candidates
-    # avoid single items
-    if len(candidates) == 1:
-        return candidates[0]
-
-    # decisive argument: population
-    headcounts = list()
-    popdict = dict()
-    for candidate in candidates:
-        headcounts.append(metainfo[candidate][4])
-        popdict[metainfo[candidate][4]] = candidate
-    largest = nlargest(2, headcounts)
-    # all null but one
-    if largest[0] != 0 and largest[1] == 0:
-        return popdict[largest[0]]
-    # second-largest smaller by a factor of 1000
-    if largest[0] > 1000*largest[1]:
-        return popdict[largest[0]]
-
-    # points: distance, population, vicinity, last country seen
-    scores = dict()
-    distances = dict()
-    # step 2: filter places with no population
-    if step == 2:
-        for candidate in candidates:
-            if int(metainfo[candidate][4]) == 0:
-                candidates.remove(candidate)
-    # double entries: place + administrative region
-    if len(candidates) == 2:
-        if metainfo[candidates[0]][2] == 'A' and metainfo[candidates[1]][2] == 'P':
-            return candidates[1]
-        elif metainfo[candidates[0]][2] == 'P' and metainfo[candidates[1]][2] == 'A':
-            return candidates[0]
-    # last country code seen
-    #if lastcountry is not None:
-    #    if metainfo[item][3] == lastcountry:
-    #        scores[item] += 1
+    points1 = np.atleast_2d(np.asarray(points1, dtype=np.float64))
+    points2 = np.atleast_2d(np.asarray(points2, dtype=np.float64))
+    points1, points2 = np.broadcast_arrays(points1, points2)
+    return points1[:, 0], points1[:, 1], points2[:, 0], points2[:, 1]
 
-    # tests
-    for candidate in candidates:
-        # init
-        scores[candidate] = 0
-        # distance: lat1, lon1, lat2, lon2
-        # use more precise calculation
-        if settings.FILTER_LEVEL == 'MAXIMUM':
-            dist = vincenty((REFERENCE[0], REFERENCE[1]), (float(metainfo[candidate][0]), float(metainfo[candidate][1])))
-            # fails to converge for nearly antipodal points
-            if dist is None:
-                dist = haversine((REFERENCE[0], REFERENCE[1]), (float(metainfo[candidate][0]), float(metainfo[candidate][1])))
-        # use faster approximation
-        else:
-            dist = haversine((REFERENCE[0], REFERENCE[1]), (float(metainfo[candidate][0]), float(metainfo[candidate][1])))
-        distances[candidate] = dist
-        # population
-        if int(metainfo[candidate][4]) > 1000:
-            scores[candidate] += 1
-        # vicinity
-        if metainfo[candidate][3] in VICINITY:
-            scores[candidate] += 1
-    # best distance
-    smallest_distance = min(distances.values())
-    for number in [k for k, v in distances.items() if v == smallest_distance]:
-        scores[number] += 1
-    # best score
-    best_score = max(scores.values())
-    best_ones = [k for k, v in scores.items() if v == best_score]
-    # analyze
-    if len(best_ones) == 1:
-        #if isinstance(best_ones, list):
-        return best_ones[0]
-        #else:
-        #    lastcountry = metainfo[best_ones][3]
-    if len(best_ones) == 2:
-        # double entries: place + administrative region
-        if metainfo[best_ones[0]][2] == 'A' and metainfo[best_ones[1]][2] == 'P':
-            return best_ones[1]
-        elif metainfo[best_ones[0]][2] == 'P' and metainfo[best_ones[1]][2] == 'A':
-            return best_ones[0]
 
+def haversine_many(points1, points2):
+    """
+    Vectorized version of haversine(): points are N×2 arrays of decimal degrees,
+    a single point on either side is compared to all points on the other side.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, _coordinates(points1, points2))
+    # haversine formula
+    a = np.sin((lat2 - lat1)/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1)/2)**2
+    # clip rounding errors
+    c = 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return np.round(6371.0088 * c, 5)
 
-def geofind(name, codesdict, metainfo, custom_lists=None, stoplist=None):
+
+def vincenty_many(points1, points2, max_iter=200):
     """
-    Find the token(s) in the gazzetteer(s)
+    Vectorized version of vincenty() with the same input as haversine_many(),
+    points for which the iteration fails to converge are measured with the haversine formula.
     """
-    # condition to examine
-    if len(name) <= settings.MINLENGTH or not name[0].isupper() or name in stoplist:
-        return False
+    lat1, lon1, lat2, lon2 = _coordinates(points1, points2)
+    # WGS 84
+    a = 6378137  # meters
+    f = 1 / 298.257223563
+    b = 6356752.314245  # meters; b = (1 - f)a
+    convergence_threshold = 1e-12
 
-    # selected lists first
-    if custom_lists is not None:
-        stop_search = selected_lists(name, custom_lists)
-        if stop_search is True:
-            # return "found"
-            # store_result() # already performed above
-            return True
+    # process
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    L = np.radians(lon2 - lon1)
+    Lambda = L.copy()
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+    # values of the last iteration for each pair
+    sinSigma = np.zeros(L.shape)
+    cosSigma = np.zeros(L.shape)
+    sigma = np.zeros(L.shape)
+    cosSqAlpha = np.zeros(L.shape)
+    cos2SigmaM = np.zeros(L.shape)
+    active = np.ones(L.shape, dtype=bool)
+
+    # iterate on the pairs which have not converged yet
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for iteration in range(max_iter):
+            idx = np.flatnonzero(active)
+            if idx.size == 0:
+                break
+            sinLambda = np.sin(Lambda[idx])
+            cosLambda = np.cos(Lambda[idx])
+            sS = np.sqrt((cosU2[idx] * sinLambda) ** 2 + (cosU1[idx] * sinU2[idx] - sinU1[idx] * cosU2[idx] * cosLambda) ** 2)
+            cS = sinU1[idx] * sinU2[idx] + cosU1[idx] * cosU2[idx] * cosLambda
+            sg = np.arctan2(sS, cS)
+            sinAlpha = cosU1[idx] * cosU2[idx] * sinLambda / sS
+            cSqA = 1 - sinAlpha ** 2
+            c2SM = np.where(cSqA != 0, cS - 2 * sinU1[idx] * sinU2[idx] / cSqA, 0)
+            C = f / 16 * cSqA * (4 + f * (4 - 3 * cSqA))
+            newLambda = L[idx] + (1 - C) * f * sinAlpha * (sg + C * sS * (c2SM + C * cS * (-1 + 2 * c2SM ** 2)))
+            # store and update masks
+            sinSigma[idx], cosSigma[idx], sigma[idx] = sS, cS, sg
+            cosSqAlpha[idx], cos2SigmaM[idx] = cSqA, c2SM
+            done = (np.abs(newLambda - Lambda[idx]) < convergence_threshold) | (sS == 0)
+            Lambda[idx] = newLambda
+            active[idx[done]] = False
 
-    # check
-    if name not in codesdict:
-        # not found
-        # print('ERROR, not found:', name)
-        return False
-    # else
-    winning_id = ''
-    # single winner
-    if not isinstance(codesdict[name], list) or len(codesdict[name]) == 1:
-        winning_id = codesdict[name][0]
-        logger.debug('winner: %s', codesdict[name])
-    # hopefully find the right one
+    uSq = cosSqAlpha * (a ** 2 - b ** 2) / (b ** 2)
+    A = 1 + uSq / 16384 * (4096 + uSq * (-768 + uSq * (320 - 175 * uSq)))
+    B = uSq / 1024 * (256 + uSq * (-128 + uSq * (74 - 47 * uSq)))
+    deltaSigma = B * sinSigma * (cos2SigmaM + B / 4 * (cosSigma *
+                 (-1 + 2 * cos2SigmaM ** 2) - B / 6 * cos2SigmaM *
+                 (-3 + 4 * sinSigma ** 2) * (-3 + 4 * cos2SigmaM ** 2)))
+    s = np.round(b * A * (sigma - deltaSigma) / 1000, 5)
+    # coincident points
+    s[sinSigma == 0] = 0.0
+    # failure to converge for nearly antipodal points
+    if active.any():
+        logger.debug('vincenty: %s pairs did not converge', np.count_nonzero(active))
+        s[active] = haversine_many(np.column_stack((lat1[active], lon1[active])), np.column_stack((lat2[active], lon2[active])))
+    return s
+
+
+def reference_distance(lat, lon, reference=None, filter_level=None):
+    """
+    Calculate the distance between a place and the reference point according to the filter level.
+    """
+    if reference is None:
+        reference = REFERENCE
+    if filter_level is None:
+        filter_level = settings.FILTER_LEVEL
+    # distance: lat1, lon1, lat2, lon2
+    # use more precise calculation
+    if filter_level == 'MAXIMUM':
+        dist = vincenty((reference[0], reference[1]), (float(lat), float(lon)))
+        # fails to converge for nearly antipodal points
+        if dist is None:
+            dist = haversine((reference[0], reference[1]), (float(lat), float(lon)))
+    # use faster approximation
     else:
-        winning_id = disambiguating_rounds(name, codesdict, metainfo)
-        if winning_id is None:
-            return False
+        dist = haversine((reference[0], reference[1]), (float(lat), float(lon)))
+    return dist
 
-    store_result(winning_id, name, metainfo)
 
-    return True
+def _context(reference=None, vicinity=None, filter_level=None):
+    """
+    Complete a disambiguation context with the module-level values.
+    """
+    if reference is None:
+        reference = REFERENCE
+    if vicinity is None:
+        vicinity = VICINITY
+    if filter_level is None:
+        filter_level = settings.FILTER_LEVEL
+    return tuple(reference), frozenset(vicinity), filter_level
 
 
-def disambiguating_rounds(name, codesdict, metainfo):
+class ReferenceCache(object):
     """
-    Disambiguate between several candidates for the same toponym, in up to three rounds.
+    Distances to the reference point and vicinity flags of gazetteer entries, computed in advance.
+    Values are only valid for a given reference, vicinity and filter level
+    (default: the module-level values).
     """
-    # discard if too many
-    if len(codesdict[name]) >= MAX_CANDIDATES:
-        try:
-            logger.warning('discarded: %s %s', name, codesdict[name])
-        except UnicodeEncodeError:
-            logger.warning('discarded + unicode error: %s', codesdict[name])
+    def __init__(self):
+        self.entries = dict()
+        self.reference = None
+        self.vicinity = None
+        self.filter_level = None
+
+    def is_current(self, reference=None, vicinity=None, filter_level=None):
+        """
+        Test if the values have been computed with the current settings.
+        """
+        return (self.reference, self.vicinity, self.filter_level) == _context(reference, vicinity, filter_level)
+
+    def clear(self, reference=None, vicinity=None, filter_level=None):
+        """
+        Discard all values and adopt the current settings.
+        """
+        self.entries = dict()
+        self.reference, self.vicinity, self.filter_level = _context(reference, vicinity, filter_level)
+
+    def add(self, nameid, info):
+        """
+        Compute and store the values for a single entry.
+        """
+        if not self.is_current():
+            self.clear()
+        self.entries[nameid] = (info[0], info[1], info[3], reference_distance(info[0], info[1], self.reference, self.filter_level), info[3] in self.vicinity)
+
+    def precompute(self, metainfo, ids=None, reference=None, vicinity=None, filter_level=None):
+        """
+        Compute and store the values for all entries of a register (or the given ones) at once.
+        """
+        if not self.is_current(reference, vicinity, filter_level):
+            self.clear(reference, vicinity, filter_level)
+        if ids is None:
+            ids = list(metainfo)
+        if not ids:
+            return
+        points = np.array([(float(metainfo[nameid][0]), float(metainfo[nameid][1])) for nameid in ids])
+        if self.filter_level == 'MAXIMUM':
+            distances = vincenty_many(self.reference, points)
+        else:
+            distances = haversine_many(self.reference, points)
+        for nameid, dist in zip(ids, distances.tolist()):
+            info = metainfo[nameid]
+            self.entries[nameid] = (info[0], info[1], info[3], dist, info[3] in self.vicinity)
+        logger.info('reference distances computed: %s', len(ids))
+
+    def lookup(self, nameid, info):
+        """
+        Return distance and vicinity flag of an entry if they match its current coordinates and country.
+        """
+        entry = self.entries.get(nameid)
+        if entry is not None and entry[0] == info[0] and entry[1] == info[1] and entry[2] == info[3]:
+            return entry[3], entry[4]
         return None
-    # init
-    global i
-    # 3-step filter
-    step = 1
-    while step <= 3:
-        # launch function
-        if step == 1:
-            # print(codesdict[name], step, metainfo)
-            winners = disambiguate(codesdict[name], step, metainfo)
+
+
+# shared by the loaders and the disambiguation
+reference_cache = ReferenceCache()
+
+
+# returned by the memo for unknown names
+UNKNOWN = object()
+
+
+class DisambiguationMemo(object):
+    """
+    Bounded memory of disambiguation results: the winning ID (or None) for a name,
+    its candidates and the disambiguation context (reference, vicinity, filter level).
+    Least recently used entries are discarded, an entry is only valid for the same
+    candidates. The fingerprint identifies the gazetteer the results come from.
+    """
+    def __init__(self, maxsize=100000, fingerprint=None):
+        self.maxsize = maxsize
+        self.fingerprint = fingerprint
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name, reference, vicinity, filter_level):
+        """
+        Build the key of a name in a given context.
+        """
+        return (name, tuple(reference), tuple(sorted(vicinity)), filter_level)
+
+    def get(self, key, candidates):
+        """
+        Return the winning ID stored for a key and the same candidates, or UNKNOWN.
+        """
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[0] != tuple(candidates):
+                self.misses += 1
+                return UNKNOWN
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, candidates, winning_id):
+        """
+        Store the result of a disambiguation.
+        """
+        with self.lock:
+            self.data[key] = (tuple(candidates), winning_id)
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self, fingerprint=None):
+        """
+        Discard all results, e.g. when the gazetteer changes.
+        """
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = 0
+            self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.data)
+
+    def save(self, filename):
+        """
+        Write the results to a JSON file, from least to most recently used.
+        """
+        with self.lock:
+            entries = [list(key) + [list(candidates), winning_id] for key, (candidates, winning_id) in self.data.items()]
+        with open(filename, 'w', encoding='utf-8') as outfh:
+            json.dump({'fingerprint': self.fingerprint, 'entries': entries}, outfh, ensure_ascii=False)
+        logger.info('memo: %s results written to %s', len(entries), filename)
+
+    @classmethod
+    def load(cls, filename, fingerprint=None, maxsize=100000):
+        """
+        Read results from a JSON file, they are discarded if the fingerprint does not match.
+        """
+        memo = cls(maxsize, fingerprint)
+        with open(filename, 'r', encoding='utf-8') as inputfh:
+            content = json.load(inputfh)
+        if content['fingerprint'] != fingerprint:
+            logger.warning('memo: gazetteer changed, results discarded: %s', filename)
+            return memo
+        for name, reference, vicinity, filter_level, candidates, winning_id in content['entries']:
+            memo.put(cls.key(name, reference, vicinity, filter_level), candidates, winning_id)
+        logger.info('memo: %s results read from %s', len(memo), filename)
+        return memo
+
+
+class Geocoder(object):
+    """
+    Geocoding job holding its registers, a snapshot of the settings and its own results.
+    Instances do not share any state and can be used concurrently (one search at a time
+    per instance), a geocoder can be reused for several texts.
+    """
+    def __init__(self, codesdict, metainfo, custom_lists=None, stoplist=None, matcher=None, mode='sliding', setting=None, reference=None, vicinity=None, cache=None, memo=None):
+        # registers
+        self.codesdict = codesdict
+        self.metainfo = metainfo
+        self.custom_lists = custom_lists if custom_lists is not None else dict()
+        self.stoplist = stoplist if stoplist is not None else dict()
+        self.matcher = matcher
+        if mode not in ('sliding', 'longest'):
+            raise ValueError('search mode not correctly set: %s' % mode)
+        self.mode = mode
+        # settings snapshot
+        if setting is None:
+            setting = settings.STANDARD_SETTING
+        if reference is None:
+            reference = settings.DISAMBIGUATION_SETTING[setting]['reference']
+        if vicinity is None:
+            vicinity = settings.DISAMBIGUATION_SETTING[setting]['vicinity']
+        self.reference = tuple(reference)
+        self.vicinity = frozenset(vicinity)
+        self.filter_level = settings.FILTER_LEVEL
+        if self.filter_level == 'MAXIMUM':
+            self.max_candidates = 5
+        elif self.filter_level == 'MEDIUM' or self.filter_level == 'MINIMUM':
+            self.max_candidates = 10
+        else:
+            raise ValueError('filter level not correctly set: %s' % self.filter_level)
+        self.minlength = settings.MINLENGTH
+        self.linesbool = settings.LINESBOOL
+        self.context_threshold = settings.CONTEXT_THRESHOLD
+        # precomputed distances, used if they match the snapshot
+        self.cache = cache if cache is not None else reference_cache
+        # results of previous disambiguations, can be shared between geocoders
+        self.memo = memo
+        # accumulators
+        self.reset()
+
+    def reset(self):
+        """
+        Discard results, lines and counters.
+        """
+        self.results = dict()
+        self.lines = list()
+        self.pair = list()
+        self.pair_counter = 0
+        self.lastcountry = ''
+        # failed disambiguations
+        self.failures = 0
+
+    def search(self, searchlist):
+        """
+        Geocoding: search if valid place name and assign coordinates.
+        The optional matcher (see matching.TokenTrie) skips lookups of token chains which are not in the registers.
+        The 'sliding' mode tests the chains ending at each token (longest chain first),
+        the 'longest' mode emits leftmost-longest matches.
+        """
+        # init
+        self.results = dict()
+        self.pair_counter = 0
+        # current chain of tokens, reset on punctuation
+        window = list()
+
+        # search for places
+        for token in searchlist:
+            if token == ' ':
+                continue
+            # skip and reinitialize:
+            # TODO: quotation marks? brackets?
+            if token == 'XXX' or BOUNDARY.match(token): # St–?
+                if self.mode == 'longest':
+                    while window:
+                        self.longest_match(window)
+                window = list()
+                continue
+            window.append(token)
+
+            if self.mode == 'longest':
+                # consume the first tokens once a chain of maximal length is available
+                if len(window) >= WINDOW_SIZE:
+                    self.longest_match(window)
+                continue
+
+            ## grow or limit (delete first word)
+            if len(window) > WINDOW_SIZE:
+                del window[0]
+            # control
+            logger.debug('%s %s', token, window)
+            ## analyze sliding window first, then token if necessary
+            if self.sliding_match(window) is True:
+                # final check whether to keep the multi-word scan running
+                window = list()
+            self.pair_counter += 1
+
+        # flush the remaining tokens
+        while window and self.mode == 'longest':
+            self.longest_match(window)
+        # return something
+        return self.results
+
+    def sliding_match(self, window):
+        """
+        Look for the chains ending with the last token of the window, longest chain first.
+        """
+        for size in range(len(window), 0, -1):
+            chain = window[-size:]
+            # skip chains which cannot be found
+            if self.matcher is not None and chain not in self.matcher:
+                continue
+            # just one token: dict check before
+            if size == 1 and (chain[0] in common_names or chain[0].lower() in common_names):
+                continue
+            # TODO: frequency threshold? (tokens[token]/numtokens) < threshold
+            if self.geofind(' '.join(chain)) is True:
+                return True
+        return False
+
+    def longest_match(self, window):
+        """
+        Find the longest chain starting with the first token of the window and remove the tokens it covers.
+        """
+        if self.matcher is not None:
+            sizes = self.matcher.prefixes(window[:WINDOW_SIZE])
+        else:
+            sizes = range(min(len(window), WINDOW_SIZE), 0, -1)
+        consumed = 1
+        for size in sizes:
+            # just one token: dict check before
+            if size == 1 and (window[0] in common_names or window[0].lower() in common_names):
+                continue
+            if self.geofind(' '.join(window[:size])) is True:
+                consumed = size
+                break
+        del window[:consumed]
+        self.pair_counter += consumed
+
+    def geofind(self, name):
+        """
+        Find the token(s) in the gazzetteer(s)
+        """
+        # condition to examine
+        if len(name) <= self.minlength or not name[0].isupper() or name in self.stoplist:
+            return False
+
+        # selected lists first
+        if self.custom_lists:
+            stop_search = self.selected_lists(name)
+            if stop_search is True:
+                # return "found"
+                # store_result() # already performed above
+                return True
+
+        # check
+        if name not in self.codesdict:
+            # not found
+            return False
+        # else
+        winning_id = ''
+        # single winner
+        if not isinstance(self.codesdict[name], list) or len(self.codesdict[name]) == 1:
+            winning_id = self.codesdict[name][0]
+            logger.debug('winner: %s', self.codesdict[name])
+        # hopefully find the right one
         else:
-            winners = disambiguate(winners, step, metainfo)
-        # nothing found
-        if winners is None:
+            winning_id = self.disambiguating_rounds(name)
+            if winning_id is None:
+                return False
+
+        self.store_result(winning_id, name)
+
+        return True
+
+    def disambiguating_rounds(self, name):
+        """
+        Disambiguate between several candidates for the same toponym, in up to three rounds.
+        """
+        candidates = self.codesdict[name]
+        # discard if too many
+        if len(candidates) >= self.max_candidates:
             try:
-                logger.warning('out of winners: %s %s', name, codesdict[name])
+                logger.warning('discarded: %s %s', name, candidates)
             except UnicodeEncodeError:
-                logger.warning('out of winners + unicode error: %s', codesdict[name])
-            i += 1
+                logger.warning('discarded + unicode error: %s', candidates)
+            return None
+        if self.memo is None:
+            return self.rounds(name, candidates)
+        key = self.memo.key(name, self.reference, self.vicinity, self.filter_level)
+        winning_id = self.memo.get(key, candidates)
+        if winning_id is UNKNOWN:
+            # copy, the rounds can remove candidates
+            winning_id = self.rounds(name, list(candidates))
+            self.memo.put(key, candidates, winning_id)
+        elif winning_id is None:
+            self.failures += 1
+        return winning_id
+
+    def rounds(self, name, candidates):
+        """
+        Run up to three disambiguation rounds on the candidates.
+        """
+        # 3-step filter
+        winning_id = None
+        step = 1
+        while step <= 3:
+            # launch function
+            if step == 1:
+                winners = self.disambiguate(candidates, step)
+            else:
+                winners = self.disambiguate(winners, step)
+            # nothing found
+            if winners is None:
+                try:
+                    logger.warning('out of winners: %s %s', name, candidates)
+                except UnicodeEncodeError:
+                    logger.warning('out of winners + unicode error: %s', candidates)
+                self.failures += 1
+                return None
+            # found
+            if not isinstance(winners, list):
+                winning_id = winners
+                break
+            elif len(winners) == 1:
+                winning_id = winners[0]
+                break
+        ## TODO: NEVER HAPPENS??
+        if winning_id is None:
+            try:
+                logger.warning('too many winners: %s %s', name, winners)
+            except UnicodeEncodeError:
+                logger.warning('too many winners + unicode error: %s', winners)
+            self.failures += 1
             return None
-        # found
-        if not isinstance(winners, list):
-            winning_id = winners
-            break
-        elif len(winners) == 1:
-            winning_id = winners[0]
-            break
-    ## TODO: NEVER HAPPENS??
-    if winning_id is None:
-        try:
-            logger.warning('too many winners: %s %s', name, winners)
-        except UnicodeEncodeError:
-            logger.warning('too many winners + unicode error: %s', winners)
-        i += 1
-        return None
 
-        # throw dice and record
-        #if len(winning_id) == 0:
-        #    for element in best_ones:
-        #        print(name, element, scores[element], distances[element], str(metainfo[element]), sep='\t')
-        #        i += 1
-            # random choice to store...
-        #    winning_id = choice(best_ones)
+        return winning_id
+
+    def disambiguate(self, candidates, step):
+        """
+        Determine the most probable entry among candidates.
+        """
+        metainfo = self.metainfo
+        # test if list
+        if not isinstance(candidates, list):
+            logger.error('type, not a list: %s, %s', type(candidates), candidates)
+            return candidates
+        # avoid single items
+        if len(candidates) == 1:
+            return candidates[0]
 
+        # decisive argument: population
+        headcounts = list()
+        popdict = dict()
+        for candidate in candidates:
+            headcounts.append(metainfo[candidate][4])
+            popdict[metainfo[candidate][4]] = candidate
+        largest = nlargest(2, headcounts)
+        # all null but one
+        if largest[0] != 0 and largest[1] == 0:
+            return popdict[largest[0]]
+        # second-largest smaller by a factor of 1000
+        if largest[0] > 1000*largest[1]:
+            return popdict[largest[0]]
+
+        # points: distance, population, vicinity, last country seen
+        scores = dict()
+        distances = dict()
+        # step 2: filter places with no population
+        if step == 2:
+            for candidate in candidates:
+                if int(metainfo[candidate][4]) == 0:
+                    candidates.remove(candidate)
+        # double entries: place + administrative region
+        if len(candidates) == 2:
+            if metainfo[candidates[0]][2] == 'A' and metainfo[candidates[1]][2] == 'P':
+                return candidates[1]
+            elif metainfo[candidates[0]][2] == 'P' and metainfo[candidates[1]][2] == 'A':
+                return candidates[0]
+
+        # tests
+        use_cache = self.cache.is_current(self.reference, self.vicinity, self.filter_level)
+        for candidate in candidates:
+            # init
+            scores[candidate] = 0
+            # distance and vicinity computed in advance
+            cached = use_cache and self.cache.lookup(candidate, metainfo[candidate])
+            if cached:
+                distances[candidate], nearby = cached
+            else:
+                distances[candidate] = reference_distance(metainfo[candidate][0], metainfo[candidate][1], self.reference, self.filter_level)
+                nearby = metainfo[candidate][3] in self.vicinity
+            # population
+            if int(metainfo[candidate][4]) > 1000:
+                scores[candidate] += 1
+            # vicinity
+            if nearby is True:
+                scores[candidate] += 1
+        # best distance
+        smallest_distance = min(distances.values())
+        for number in [k for k, v in distances.items() if v == smallest_distance]:
+            scores[number] += 1
+        # best score
+        best_score = max(scores.values())
+        best_ones = [k for k, v in scores.items() if v == best_score]
+        # analyze
+        if len(best_ones) == 1:
+            return best_ones[0]
+        if len(best_ones) == 2:
+            # double entries: place + administrative region
+            if metainfo[best_ones[0]][2] == 'A' and metainfo[best_ones[1]][2] == 'P':
+                return best_ones[1]
+            elif metainfo[best_ones[0]][2] == 'P' and metainfo[best_ones[1]][2] == 'A':
+                return best_ones[0]
+
+    def store_result(self, winning_id, name, metainfo=None):
+        """
+        Store result along with context information.
+        """
+        if metainfo is None:
+            metainfo = self.metainfo
+        results = self.results
+        # TODO: frequency counts
+        freq = 'NULL'
+
+        # store new result
+        if winning_id not in results:
+            results[winning_id] = list()
+            try:
+                for element in metainfo[winning_id]:
+                    results[winning_id].append(element)
+            except KeyError:
+                logger.error('key not found: %s', winning_id)
+                return True
+            results[winning_id].append(name)
+            results[winning_id].append(freq)
+            results[winning_id].append(1)
+        # increment last element
+        else:
+            results[winning_id][-1] += 1
+
+        # store context info
+        self.lastcountry = metainfo[winning_id][3]
+
+        # lines flag
+        if self.linesbool is True:
+            self.draw_line(results[winning_id][0], results[winning_id][1])
+
+        logger.debug('stored item %s with info %s', winning_id, results[winning_id])
+        return
+
+    def selected_lists(self, name, dic=None):
+        """
+        Bypass general search by looking into specified registers.
+        """
+        if dic is None:
+            dic = self.custom_lists
+        # search + canonicalize
+        if name in dic:
+            templist = [dic[name]['values'][0], dic[name]['values'][1], dic[name]['level'], 'NULL', 'NULL', dic[name]['values'][2]]
+            canonname = dic[name]['values'][2]
+            tempdic = {canonname: [dic[name]['values'][0], dic[name]['values'][1], dic[name]['level'], 'NULL', 'NULL']} # canonname
+            self.store_result(canonname, name, tempdic)
+
+            # lines flag
+            if self.linesbool is True:
+                self.draw_line(templist[0], templist[1])
+
+            # store flag
+            return True
+        # else
+        return False
+
+    # draw lines
+    ## TODO: test and evaluate
+    def draw_line(self, lat, lon):
+        """
+        Draw lines between points on the map.
+        """
+        logger.debug('line drawing check: %s %s %s %s', self.pair, self.pair_counter, lat, lon)
+        if self.pair_counter <= self.context_threshold:
+            if len(self.pair) == 1:
+                self.pair.append((lat, lon))
+                self.lines.append((self.pair[0], self.pair[1]))
+                logger.debug('line drawn: %s', (self.pair[0], self.pair[1]))
+                del self.pair[0]
+            else:
+                self.pair.append((lat, lon))
+                logger.debug('line component added: %s', (lat, lon))
+        else:
+            logger.debug('context size exceeded (%s), pair reset', self.pair_counter)
+            self.pair = [(lat, lon)]
+            logger.debug('line component added: %s', (lat, lon))
+        self.pair_counter = 0
+
+
+## module-level interface: a geocoder sharing the module variables
+
+def _module_geocoder(codesdict=None, metainfo=None, custom_lists=None, stoplist=None, matcher=None, mode='sliding'):
+    """
+    Build a geocoder working on the module-level settings, results and counters.
+    """
+    geocoder = Geocoder(codesdict, metainfo, custom_lists, stoplist, matcher, mode, reference=REFERENCE, vicinity=VICINITY, memo=memo)
+    geocoder.results = results
+    geocoder.lines = lines
+    geocoder.pair = pair
+    geocoder.pair_counter = pair_counter
+    geocoder.lastcountry = lastcountry
+    return geocoder
+
+
+def _sync(geocoder):
+    """
+    Copy the state of a geocoder back to the module variables.
+    """
+    global i, results, lines, pair, pair_counter, lastcountry
+    i += geocoder.failures
+    results = geocoder.results
+    lines = geocoder.lines
+    pair = geocoder.pair
+    pair_counter = geocoder.pair_counter
+    lastcountry = geocoder.lastcountry
+
+
+def disambiguate(candidates, step, metainfo):
+    """
+    Determine the most probable entry among candidates.
+    """
+    return _module_geocoder(metainfo=metainfo).disambiguate(candidates, step)
+
+
+def geofind(name, codesdict, metainfo, custom_lists=None, stoplist=None):
+    """
+    Find the token(s) in the gazzetteer(s)
+    """
+    geocoder = _module_geocoder(codesdict, metainfo, custom_lists, stoplist)
+    found = geocoder.geofind(name)
+    _sync(geocoder)
+    return found
+
+
+def disambiguating_rounds(name, codesdict, metainfo):
+    """
+    Disambiguate between several candidates for the same toponym, in up to three rounds.
+    """
+    geocoder = _module_geocoder(codesdict, metainfo)
+    winning_id = geocoder.disambiguating_rounds(name)
+    _sync(geocoder)
     return winning_id
 
 
@@ -310,171 +868,97 @@ def store_result(winning_id, name, metainfo):
     """
     Store result along with context information.
     """
-    # init
-    global i, lastcountry, results
-
-    # TODO: frequency counts
-    # disable frequency count if multi-word on
-    #if multiflag is False:
-    #    freq = '{0:.4f}'.format(tokens[name]/numtokens)
-    #else:
-    #    freq = '0'
-    freq = 'NULL'
-
-    # store new result
-    if winning_id not in results:
-        results[winning_id] = list()
-        try:
-            for element in metainfo[winning_id]:
-                results[winning_id].append(element)
-        except KeyError:
-            logger.error('key not found: %s', winning_id)
-            return True
-        results[winning_id].append(name)
-        results[winning_id].append(freq)
-        results[winning_id].append(1)
-    # increment last element
-    else:
-        results[winning_id][-1] += 1
+    geocoder = _module_geocoder(metainfo=metainfo)
+    geocoder.store_result(winning_id, name)
+    _sync(geocoder)
 
-    # store context info
-    lastcountry = metainfo[winning_id][3]
 
-    # lines flag
-    if settings.LINESBOOL is True:
-        draw_line(results[winning_id][0], results[winning_id][1])
+def selected_lists(name, dic):
+    """
+    Bypass general search by looking into specified registers.
+    """
+    geocoder = _module_geocoder(custom_lists=dic)
+    found = geocoder.selected_lists(name)
+    _sync(geocoder)
+    return found
 
-    logger.debug('stored item %s with info %s', winning_id, results[winning_id])
-    return
 
+def search(searchlist, codesdict, metainfo, custom_lists=dict(), stoplist=dict(), matcher=None, mode='sliding'):
+    """
+    Geocoding: search if valid place name and assign coordinates (see Geocoder.search).
+    Results and counters are stored in the module variables, use a Geocoder instance
+    for concurrent searches.
+    """
+    try:
+        geocoder = _module_geocoder(codesdict, metainfo, custom_lists, stoplist, matcher, mode)
+    except ValueError as err:
+        logger.error('%s', err)
+        sys.exit(1)
+    searchresults = geocoder.search(searchlist)
+    _sync(geocoder)
+    return searchresults
 
-def selected_lists(name, dic):
+
+def draw_line(lat, lon):
     """
-    Bypass general search by looking into specified registers.
+    Draw lines between points on the map.
     """
-    # init
-    global results
+    geocoder = _module_geocoder()
+    geocoder.draw_line(lat, lon)
+    _sync(geocoder)
 
-    # search + canonicalize
-    if name in dic:
-        templist = [dic[name]['values'][0], dic[name]['values'][1], dic[name]['level'], 'NULL', 'NULL', dic[name]['values'][2]]
-        canonname = dic[name]['values'][2]
-        tempdic = {canonname: [dic[name]['values'][0], dic[name]['values'][1], dic[name]['level'], 'NULL', 'NULL']} # canonname
-        store_result(canonname, name, tempdic)
 
-        # lines flag
-        if settings.LINESBOOL is True:
-            draw_line(templist[0], templist[1])
+def merge_results(partials):
+    """
+    Merge search results in the given order: the first entry is kept for each ID and the occurrences are summed.
+    """
+    merged = dict()
+    for partial in partials:
+        for key, values in partial.items():
+            if key not in merged:
+                merged[key] = list(values)
+            else:
+                merged[key][-1] += values[-1]
+    return merged
 
-        # store flag
-        return True
-    # else
-    return False
 
+# geocoder used by the worker processes
+_worker_geocoder = None
+_worker_reader = None
 
-def search(searchlist, codesdict, metainfo, custom_lists=dict(), stoplist=dict()): # dbpath=DBPATH
+
+def _init_worker(codesdict, metainfo, custom_lists, stoplist, matcher, mode, reader):
     """
-    Geocoding: search if valid place name and assign coordinates.
+    Keep the registers in the worker process (copy-on-write if the processes are forked).
     """
-    # safety check
-    global MAX_CANDIDATES
-    if settings.FILTER_LEVEL == 'MAXIMUM':
-        MAX_CANDIDATES = 5
-    elif settings.FILTER_LEVEL == 'MEDIUM' or settings.FILTER_LEVEL == 'MINIMUM':
-        MAX_CANDIDATES = 10
-    else:
-        logger.error('filter level not correctly set: %s', settings.FILTER_LEVEL)
-        sys.exit(1)
-    # init
-    global pair_counter
-    global results
-    # metainfo = SqliteDict('./metainfo.sqlite')
-    results = dict()
-    slide2 = ''
-    slide3 = ''
-    pair_counter = 0
-
-    # search for places
-    for token in searchlist:
-        stop_search = False
-        if token == ' ':
-            continue
-        # skip and reinitialize:
-        # TODO: quotation marks? brackets?
-        if token == 'XXX' or re.match(r'[.!?…,;:–]', token): # St–?
-            slide2 = ''
-            slide3 = ''
-            continue
-        ## grow or limit (delete first word)
-        # 2-gram
-        if len(slide2) == 0:
-            slide2 = token
-        elif slide2.count(' ') == 0:
-            slide2 = slide2 + ' ' + token
-        else:
-            slide2 = re.sub(r'^.+? ', '', slide2)
-            slide2 = slide2 + ' ' + token
-        # 3-gram
-        if len(slide3) == 0:
-            slide3 = token
-        #elif slide3.count(' ') < 1:
-        #   slide3 = slide3 + ' ' + token
-        elif slide3.count(' ') < 2:
-            slide3 = slide3 + ' ' + token
-        else:
-            slide3 = re.sub(r'^.+? ', '', slide3)
-            slide3 = slide3 + ' ' + token
-
-        # control
-        # if settings.VERBOSITY == 'V':
-        logger.debug('%s %s %s', token, slide2, slide3)
-
-        ## analyze sliding window first, then token if necessary
-        # longest chain first
-        if slide3.count(' ') == 2:
-            stop_search = geofind(slide3, codesdict, metainfo, custom_lists, stoplist)
-        # longest chain first
-        if stop_search is False and slide2.count(' ') == 1:
-            stop_search = geofind(slide2, codesdict, metainfo, custom_lists, stoplist)
-        # just one token, if nothing has been found
-        if stop_search is False:
-             # dict check before
-            if token not in common_names and token.lower() not in common_names:
-                stop_search = geofind(token, codesdict, metainfo, custom_lists, stoplist)
-            # TODO: frequency threshold? (tokens[token]/numtokens) < threshold
+    global _worker_geocoder, _worker_reader
+    _worker_geocoder = Geocoder(codesdict, metainfo, custom_lists, stoplist, matcher, mode, reference=REFERENCE, vicinity=VICINITY)
+    _worker_reader = reader
 
-        # final check whether to keep the multi-word scan running
-        if stop_search is True:
-            slide2 = ''
-            slide3 = ''
 
-        pair_counter += 1
-    # db
-    # metainfo.close()
-    # return something
-    return results
+def _search_document(path):
+    """
+    Read and geocode a single document in a worker process.
+    """
+    return _worker_geocoder.search(_worker_reader(path))
 
 
-# draw lines
-## TODO: test and evaluate
-def draw_line(lat, lon):
+def search_corpus(paths, codesdict, metainfo, custom_lists=dict(), stoplist=dict(), matcher=None, mode='sliding', reader=None, workers=None):
     """
-    Draw lines between points on the map.
+    Geocode several documents in parallel: documents are spread across a pool of
+    processes (default: one per CPU) and the results are merged in document order,
+    as if the documents had been searched one after the other.
     """
-    global pair, lines, pair_counter
-    logger.debug('line drawing check: %s %s %s %s', pair, pair_counter, lat, lon)
-    if pair_counter <= settings.CONTEXT_THRESHOLD:
-        if len(pair) == 1:
-            pair.append((lat, lon))
-            lines.append((pair[0], pair[1]))
-            logger.debug('line drawn: %s', (pair[0], pair[1]))
-            del pair[0]
-        else:
-            pair.append((lat, lon))
-            logger.debug('line component added: %s', (lat, lon))
+    if reader is None:
+        reader = readfile.itertok
+    args = (codesdict, metainfo, custom_lists, stoplist, matcher, mode, reader)
+    paths = list(paths)
+    if workers == 1 or len(paths) < 2:
+        # local geocoder, the worker globals are not set in the calling process
+        geocoder = Geocoder(codesdict, metainfo, custom_lists, stoplist, matcher, mode, reference=REFERENCE, vicinity=VICINITY)
+        partials = [geocoder.search(reader(path)) for path in paths]
     else:
-        logger.debug('context size exceeded (%s), pair reset', pair_counter)
-        pair = []
-        pair.append((lat, lon))
-        logger.debug('line component added: %s', (lat, lon))
-    pair_counter = 0
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=args) as pool:
+            partials = pool.map(_search_document, paths, chunksize=1)
+    logger.info('%s documents searched', len(paths))
+    return merge_results(partials)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Token-level trie to find single and multi-word place names in one pass over the text.
+"""
+
+
+import logging
+
+
+# logging
+logger = logging.getLogger(__name__)
+
+
+class TokenTrie(object):
+    """
+    Compile the keys of one or several registers (Geonames codes, custom lists) into a trie over tokens.
+    Registers with regex entries (see compact.PatternRegister) are also queried at lookup time.
+    """
+    def __init__(self, *registers):
+        # nested dicts, None marks the end of an entry
+        self.root = dict()
+        self.depth = 0
+        self.size = 0
+        # registers whose patterns cannot be listed
+        self.fallbacks = list()
+        for register in registers:
+            self.update(register)
+
+    def add(self, name):
+        """
+        Add a place name to the trie, multi-word names are split on spaces.
+        """
+        tokens = name.split(' ')
+        node = self.root
+        for token in tokens:
+            if token not in node:
+                node[token] = dict()
+            node = node[token]
+        if None not in node:
+            node[None] = True
+            self.size += 1
+        if len(tokens) > self.depth:
+            self.depth = len(tokens)
+
+    def update(self, names):
+        """
+        Add all keys of a register to the trie.
+        """
+        if getattr(names, 'patterns', None):
+            self.fallbacks.append(names)
+        for name in names:
+            self.add(name)
+        logger.debug('trie: %s entries, depth %s', self.size, self.depth)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, tokens):
+        """
+        Test if a sequence of tokens is an entry.
+        """
+        node = self.root
+        for token in tokens:
+            if token not in node:
+                node = None
+                break
+            node = node[token]
+        if node is not None and None in node:
+            return True
+        return self._fallback(tokens)
+
+    def _fallback(self, tokens):
+        """
+        Test if a sequence of tokens matches an entry of the pattern registers.
+        """
+        if not self.fallbacks:
+            return False
+        name = ' '.join(tokens)
+        return any(name in register for register in self.fallbacks)
+
+    def prefixes(self, tokens):
+        """
+        Return the lengths of all entries starting at the first token, longest first.
+        """
+        lengths = list()
+        node = self.root
+        for length, token in enumerate(tokens, 1):
+            if token not in node:
+                break
+            node = node[token]
+            if None in node:
+                lengths.append(length)
+        # patterns can match chains of any length
+        if self.fallbacks:
+            lengths.extend(length for length in range(1, len(tokens) + 1) if length not in lengths and self._fallback(tokens[:length]))
+            lengths.sort()
+        lengths.reverse()
+        return lengths
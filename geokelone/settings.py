@@ -20,6 +20,16 @@ LINESBOOL = False
 DATEBOOL = False
 
 
+## data collection: queries per second sent to Wikipedia/Wikidata
+REQUESTS_PER_SECOND = 2
+## seconds to wait for a server (connection and response)
+TIMEOUT = 30
+
+
+## maximum number of variants of a regex entry in custom registers
+EXPANSION_LIMIT = 10000
+
+
 ## registers provided or not
 # CUSTOM_REGISTERS = True
 
@@ -4,7 +4,10 @@ Read input texts in various formats.
 """
 
 # standard
+import bz2
+import gzip
 import logging
+import lzma
 import re
 
 # own
@@ -14,37 +17,62 @@ from ..data import validators
 logger = logging.getLogger(__name__)
 
 
-# load all tokens
-def readplain(filename, datesbool=False, datestok=None):
-    """
-    Read raw text from file and tokenize in a crude way.
-    """
-    with open(filename, 'r', encoding='utf-8') as inputfh:
-        # splitted = inputfh.read().replace('\n', ' ').split()
-        text = inputfh.read().replace('\n', ' ')
-        ## validate: if text
-        if validators.validate_text(text) is False:
-            logger.warning('text format not valid')
-            return None
+# very basic regex-tokenizer
+TOKENIZER = re.compile(r'([^\w-]+)', flags=re.UNICODE)
+SPACES = re.compile(r'^$|\s+')
 
-        # very basic regex-tokenizer
-        splitted = list()
-        for item in re.split(r'([^\w-]+)', text, flags=re.UNICODE):
-            if not re.match(r'^$|\s+', item):
-                splitted.append(item.strip())
+# NE tags (common tags)
+NE_TAGS = ('I-LOC', 'NE', 'NPROP', 'PROPN')
 
-        # print ('types:', numtokens)
-        logger.info('%s tokens found', len(splitted))
-        return splitted
 
-
-def readtok(filename, datesbool=False, datestok=None):
+def open_file(filename):
     """
-    Read tokenized text from file (one token per line).
+    Open a text file for reading, gzip, bzip2 and xz compression is detected automatically.
+    """
+    with open(filename, 'rb') as inputfh:
+        magic = inputfh.read(6)
+    if magic.startswith(b'\x1f\x8b'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    if magic.startswith(b'BZh'):
+        return bz2.open(filename, 'rt', encoding='utf-8')
+    if magic.startswith(b'\xfd7zXZ\x00'):
+        return lzma.open(filename, 'rt', encoding='utf-8')
+    return open(filename, 'r', encoding='utf-8')
+
+
+def iterplain(filename, blocksize=1048576):
     """
-    with open(filename, 'r', encoding='utf-8') as inputfh:
+    Read raw text from file block by block and tokenize in a crude way (generator).
+    """
+    with open_file(filename) as inputfh:
+        pending = ''
+        while True:
+            block = inputfh.read(blocksize)
+            ## validate: if text
+            if validators.validate_text(block) is False:
+                logger.warning('text format not valid')
+                return
+            parts = TOKENIZER.split(pending + block.replace('\n', ' '))
+            # last separator and word may continue in the next block
+            if block:
+                pending = ''.join(parts[-2:])
+                del parts[-2:]
+            for item in parts:
+                if not SPACES.match(item):
+                    yield item.strip()
+            if not block:
+                break
+
+
+def itertok(filename, datesbool=False, datestok=None, stats=None):
+    """
+    Read tokenized text from file (one token per line), generator.
+    Invalid lines are counted in the statistics given, by default
+    in new ones added to validators.rejections at the end (see validators.source_stats).
+    """
+    stats = validators.source_stats(stats)
+    with open_file(filename) as inputfh:
         i = 0
-        splitted = list()
         for line in inputfh:
             if len(line.strip()) < 1:
                 continue
@@ -52,8 +80,7 @@ def readtok(filename, datesbool=False, datestok=None):
             if i % 10000000 == 0:
                 logger.info('tokens seen: %s', i)
             # control
-            if validators.validate_tok(line) is False:
-                logger.warning('line not valid: %s', line)
+            if validators.validate_tok(line, stats) is False:
                 continue
 
             # consider dates
@@ -69,21 +96,19 @@ def readtok(filename, datesbool=False, datestok=None):
             #    token = re.split(r'[ \t\n\r\f\v]', line)[0]
             #else:
             #    token = line.strip()
-            token = line.strip()
-            splitted.append(token)
+            yield line.strip()
+    stats.report(filename)
 
-        # build frequency dict
-        logger.info('%s tokens read', len(splitted))
-        return splitted
 
-
-def readtagged(filename, datesbool=False, datestok=None):
+def itertagged(filename, datesbool=False, datestok=None, stats=None):
     """
-    Read tokenized and tagged text from file (one token per line, tab-separated values).
+    Read tokenized and tagged text from file (one token per line, tab-separated values), generator.
+    Invalid lines are counted in the statistics given, by default
+    in new ones added to validators.rejections at the end (see validators.source_stats).
     """
-    with open(filename, 'r', encoding='utf-8') as inputfh:
+    stats = validators.source_stats(stats)
+    with open_file(filename) as inputfh:
         i = 0
-        splitted = list()
         for line in inputfh:
             if len(line.strip()) < 1:
                 continue
@@ -91,12 +116,11 @@ def readtagged(filename, datesbool=False, datestok=None):
             if i % 10000000 == 0:
                 logger.info('tokens seen: %s', i)
             # control
-            if validators.validate_tagged(line) is False:
-                logger.warning('line not valid: %s', line)
+            if validators.validate_tagged(line, stats) is False:
                 continue
 
             # split
-            columns = re.split('\t', line.strip())
+            columns = line.strip().split('\t')
 
             # consider dates
             #if datesbool is True:
@@ -105,16 +129,44 @@ def readtagged(filename, datesbool=False, datestok=None):
             #    datestok[columns[0]].add(columns[1])
 
             # take only NEs (common tags)
-            if columns[1] in ('I-LOC', 'NE', 'NPROP', 'PROPN'):
+            if columns[1] in NE_TAGS:
                 # take column 3 (lemmata) is there is one
                 if len(columns) == 3:
-                    splitted.append(columns[2])
+                    yield columns[2]
                 else:
-                    splitted.append(columns[0])
+                    yield columns[0]
+    stats.report(filename)
+
+
+# load all tokens
+def readplain(filename, datesbool=False, datestok=None):
+    """
+    Read raw text from file and tokenize in a crude way.
+    """
+    splitted = list(iterplain(filename))
+    # print ('types:', numtokens)
+    logger.info('%s tokens found', len(splitted))
+    return splitted
+
+
+def readtok(filename, datesbool=False, datestok=None):
+    """
+    Read tokenized text from file (one token per line).
+    """
+    splitted = list(itertok(filename, datesbool, datestok))
+    # build frequency dict
+    logger.info('%s tokens read', len(splitted))
+    return splitted
 
-        # print ('types:', numtokens)
-        logger.info('%s tokens read', len(splitted))
-        return splitted
+
+def readtagged(filename, datesbool=False, datestok=None):
+    """
+    Read tokenized and tagged text from file (one token per line, tab-separated values).
+    """
+    splitted = list(itertagged(filename, datesbool, datestok))
+    # print ('types:', numtokens)
+    logger.info('%s tokens read', len(splitted))
+    return splitted
 
 
 # def frequency_dict(splitted):
@@ -66,6 +66,7 @@ setup(
         'cairocffi',
         'exrex',
         'matplotlib >= 2.1.0',
+        'numpy',
         'requests',
         'pyproj',
         'shapely',
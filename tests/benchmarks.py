@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the library, run from the root directory with: python -m tests.benchmarks [name ...]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import numpy as np
+
+from geokelone import data, geo, settings
+
+
+def timed(function, *args, **kwargs):
+    """Return the result of a function call and the time it took."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def traced(function, *args, **kwargs):
+    """Return the result of a function call and the peak memory it allocated."""
+    tracemalloc.start()
+    result = function(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, peak
+
+
+def write_metainfo(filename, size, seed=1):
+    """Write a synthetic Geonames metainfo file."""
+    rng = random.Random(seed)
+    with open(filename, 'w', encoding='utf-8') as outfh:
+        for nameid in rng.sample(range(1, 20000000), size):
+            outfh.write('{}\t{:.5f}\t{:.5f}\t{}\t{}\t{}\n'.format(
+                nameid, rng.uniform(-90, 90), rng.uniform(-180, 180), rng.choice('AHLPTV'),
+                rng.choice(('AT', 'CH', 'DE', 'FR')), rng.choice((0, rng.randint(1, 1000000)))))
+
+
+def write_codes(filename, metafile, seed=1):
+    """Write a synthetic Geonames codes file matching the IDs of a metainfo file."""
+    rng = random.Random(seed)
+    with open(metafile, encoding='utf-8') as inputfh:
+        ids = [line.split('\t', 1)[0] for line in inputfh]
+    names = dict()
+    for nameid in ids:
+        # a few names with several candidates
+        name = 'Ort' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 6)))
+        names.setdefault(name, list()).append(nameid)
+    with open(filename, 'w', encoding='utf-8') as outfh:
+        for name in sorted(names):
+            outfh.write(name + '\t' + '\t'.join(names[name]) + '\n')
+    return sorted(names)
+
+
+def write_dump(filename, size, seed=1):
+    """Write a synthetic Geonames dump (19 columns) in a ZIP archive, the data file is named after the archive."""
+    rng = random.Random(seed)
+    member = os.path.splitext(os.path.basename(filename))[0] + '.txt'
+    with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as myzip:
+        with myzip.open(member, 'w') as outfh:
+            for nameid in range(1, size + 1):
+                name = 'Ort' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 8)))
+                alternatives = ','.join(name + suffix for suffix in rng.sample(('dorf', 'heim', 'hausen', 'stadt'), rng.randint(0, 3)))
+                columns = (str(nameid), name, name, alternatives, '{:.5f}'.format(rng.uniform(45, 55)),
+                           '{:.5f}'.format(rng.uniform(5, 15)), rng.choice('AHLPSTV'), rng.choice(('PPL', 'ADM4', 'HTL', 'STM')),
+                           'DE', '', '01', '', '', '', str(rng.choice((0, rng.randint(1, 100000)))), '', '100',
+                           'Europe/Berlin', '2018-01-01')
+                outfh.write(('\t'.join(columns) + '\n').encode('utf-8'))
+
+
+def random_points(size, seed=1):
+    """Draw random points on the Earth (decimal degrees)."""
+    rng = np.random.RandomState(seed)
+    return np.column_stack((rng.uniform(-90, 90, size), rng.uniform(-180, 180, size)))
+
+
+def bench_distances(size=1000000):
+    """Compare scalar and vectorized distance calculations on random pairs."""
+    points1, points2 = random_points(size, seed=1), random_points(size, seed=2)
+    pairs1, pairs2 = points1.tolist(), points2.tolist()
+    for scalar, vectorized in ((geo.geocoding.haversine, geo.geocoding.haversine_many),
+                               (geo.geocoding.vincenty, geo.geocoding.vincenty_many)):
+        expected, scalar_time = timed(lambda: [scalar(p1, p2) for p1, p2 in zip(pairs1, pairs2)])
+        if scalar is geo.geocoding.vincenty:
+            # same fallback as in disambiguation
+            expected = [geo.geocoding.haversine(p1, p2) if e is None else e for p1, p2, e in zip(pairs1, pairs2, expected)]
+        result, vector_time = timed(vectorized, points1, points2)
+        print('{}: {} pairs, scalar {:.3f}s, vectorized {:.3f}s ({:.1f}x), max. difference {:.5f} km'.format(
+            scalar.__name__, size, scalar_time, vector_time, scalar_time/vector_time,
+            np.max(np.abs(result - np.array(expected)))))
+    # one-to-many form
+    reference = (51.86666667, 12.64333333)
+    _, vector_time = timed(geo.geocoding.vincenty_many, reference, points2)
+    print('vincenty, one reference to {} points: {:.3f}s'.format(size, vector_time))
+
+
+def bench_metainfo(size=1000000):
+    """Compare memory use and lookup time of the dictionary and columnar metainfo stores."""
+    settings.FILTER_LEVEL = 'MINIMUM'
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, 'meta.dict')
+        write_metainfo(filename, size)
+        metainfo, dict_peak = traced(data.load.geonames_meta, filename)
+        table, table_peak = traced(data.load.geonames_meta, filename, compact=True)
+    keys = random.sample(list(metainfo), min(100000, len(metainfo)))
+    _, dict_time = timed(lambda: [metainfo[key][4] for key in keys])
+    _, table_time = timed(lambda: [table[key][4] for key in keys])
+    print('metainfo, {} entries: dict {:.1f} MB, table {:.1f} MB ({:.1f} MB arrays)'.format(
+        len(metainfo), dict_peak/2**20, table_peak/2**20, table.nbytes/2**20))
+    print('metainfo, {} lookups: dict {:.3f}s, table {:.3f}s'.format(len(keys), dict_time, table_time))
+
+
+def bench_filter(size=1000000):
+    """Compare quality_control and the batch filter on a golden sample: synthetic lines and corrupted copies."""
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, 'DE.zip')
+        write_dump(filename, size)
+        lines = [line.decode('utf-8') for line in data.ingest.iterlines(filename)]
+    # corrupted columns: position, values
+    corruptions = ((1, ('Ort!', 'Ab', 'A B C D')), (3, ('Ort?,Ortheim', ',,')), (4, ('nan', 'inf', '91', 'x')),
+                   (5, ('-181', '')), (8, ('DEU', '')), (14, ('1.5', '-3', 'x')), (0, ('',)))
+    for number in range(0, len(lines), 10):
+        columns = lines[number].split('\t')
+        position, values = rng.choice(corruptions)
+        columns[position] = rng.choice(values)
+        lines[number] = '\t'.join(columns)
+    for level in ('MINIMUM', 'MAXIMUM'):
+        settings.FILTER_LEVEL = level
+        expected, serial_time = timed(lambda: [result for result in (data.geonames.quality_control(line, 'DE', dict()) for line in lines) if result[1] is not None])
+        result, batch_time = timed(data.geonames.filter_lines, lines, 'DE', dict())
+        assert result == expected
+        print('filter, {} lines, level {}: quality_control {:.0f} lines/s, filter_lines {:.0f} lines/s ({:.1f}x), {} accepted'.format(
+            len(lines), level, len(lines)/serial_time, len(lines)/batch_time, serial_time/batch_time, len(result)))
+
+
+def bench_gazetteer(size=1000000):
+    """Compare startup and lookup times of text registers and the binary gazetteer."""
+    settings.FILTER_LEVEL = 'MINIMUM'
+    with tempfile.TemporaryDirectory() as tempdir:
+        metafile, codesfile = os.path.join(tempdir, 'meta.dict'), os.path.join(tempdir, 'codes.dict')
+        write_metainfo(metafile, size)
+        names = write_codes(codesfile, metafile)
+        def load_text():
+            metainfo = data.load.geonames_meta(metafile)
+            return data.load.geonames_codes(codesfile, metainfo), metainfo
+        (codesdict, metainfo), text_time = timed(load_text)
+        binfile = os.path.join(tempdir, 'gazetteer.bin')
+        _, compile_time = timed(data.binary.write_gazetteer, binfile, codesdict, metainfo)
+        (mapped_codes, mapped_meta), binary_time = timed(data.binary.load_gazetteer, binfile)
+        keys = random.sample(names, min(100000, len(names)))
+        _, dict_time = timed(lambda: [metainfo[codesdict[key][0]] for key in keys])
+        _, mapped_time = timed(lambda: [mapped_meta[mapped_codes[key][0]] for key in keys])
+        print('gazetteer, {} entries: text files {:.3f}s, compilation {:.3f}s, binary file {:.6f}s ({:.1f} MB)'.format(
+            len(metainfo), text_time, compile_time, binary_time, os.path.getsize(binfile)/2**20))
+        print('gazetteer, {} lookups: dicts {:.3f}s, mapped {:.3f}s'.format(len(keys), dict_time, mapped_time))
+        del mapped_codes, mapped_meta
+
+
+def bench_postings(size=1000000):
+    """Compare memory use and lookup time of the dictionary and integer postings codes registers."""
+    settings.FILTER_LEVEL = 'MINIMUM'
+    with tempfile.TemporaryDirectory() as tempdir:
+        metafile, codesfile = os.path.join(tempdir, 'meta.dict'), os.path.join(tempdir, 'codes.dict')
+        write_metainfo(metafile, size)
+        names = write_codes(codesfile, metafile)
+        metainfo = data.load.geonames_meta(metafile, compact=True)
+        codesdict, dict_peak = traced(data.load.geonames_codes, codesfile, metainfo)
+        table, table_peak = traced(data.load.geonames_codes, codesfile, metainfo, compact=True)
+    keys = random.sample(names, min(100000, len(names)))
+    _, dict_time = timed(lambda: [codesdict[key] for key in keys])
+    _, table_time = timed(lambda: [table[key] for key in keys])
+    print('postings, {} names: dict {:.1f} MB, table {:.1f} MB ({:.1f} MB arrays)'.format(
+        len(codesdict), dict_peak/2**20, table_peak/2**20, table.nbytes/2**20))
+    print('postings, {} lookups: dict {:.3f}s, table {:.3f}s'.format(len(keys), dict_time, table_time))
+
+
+def bench_readers(size=1000000):
+    """Peak memory of the token readers for growing inputs (size in lines)."""
+    from geokelone import text
+    with tempfile.TemporaryDirectory() as tempdir:
+        for lines in (size // 100, size // 10, size):
+            filename = os.path.join(tempdir, 'tokens.tok')
+            with open(filename, 'w', encoding='utf-8') as outfh:
+                for number in range(lines):
+                    outfh.write('Token{}\n'.format(number % 1000))
+            count, stream_peak = traced(lambda: sum(1 for _ in text.readfile.itertok(filename)))
+            _, list_peak = traced(text.readfile.readtok, filename)
+            print('readers, {} tokens: generator {:.2f} MB, list {:.2f} MB'.format(count, stream_peak/2**20, list_peak/2**20))
+
+
+def bench_ingest(size=1000000):
+    """Throughput of the serial filter and of the streaming ingestion on a synthetic dump (size in lines)."""
+    settings.FILTER_LEVEL = 'MINIMUM'
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, 'DE.zip')
+        write_dump(filename, size)
+        _, serial_time = timed(data.geonames.filter_zipfile, filename, 'DE.txt', 'DE')
+        expected = dict(data.geonames.metainfo)
+        data.geonames.codesdict.clear()
+        data.geonames.metainfo.clear()
+        for workers in (1, None):
+            (_, metainfo), ingest_time = timed(data.ingest.ingest, filename, ['DE'], workers=workers)
+            assert metainfo == expected
+            print('ingest, {} lines: filter_zipfile {:.0f} lines/s, ingest ({} workers) {:.0f} lines/s'.format(
+                size, size/serial_time, workers or os.cpu_count(), size/ingest_time))
+
+
+def bench_validators(size=1000000):
+    """Compare the former per-line validators (patterns given as strings, warnings), the current ones and the batch versions."""
+    import re
+    rng = random.Random(1)
+    names = ['Ort' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz -!') for _ in range(rng.randint(1, 12))) for _ in range(size)]
+    rows = [[str(rng.randint(1, 10**7)), '{:.5f}'.format(rng.uniform(-100, 100)), '{:.5f}'.format(rng.uniform(-200, 200)), 'P', 'DE', rng.choice(('0', '120', '-5'))] for _ in range(size)]
+    def former_entry(name):
+        if len(name) < settings.MINLENGTH or name.count(' ') >= 3 or re.search(r'[^\w .&-]', name):
+            return False
+        return True
+    def former_latlon(lat, lon):
+        try:
+            if float(lat) > 90 or float(lat) < -90 or float(lon) > 180 or float(lon) < -180:
+                data.validators.logger.warning('out of bounds: %s %s', lat, lon)
+                return False
+            return True
+        except ValueError:
+            return False
+    def former_registry(columns):
+        if len(columns) != 6:
+            return False
+        if not columns[0].isdigit() or not re.match(r'[0-9.-]+$', columns[1]) or not re.match(r'[0-9.-]+$', columns[2]):
+            return False
+        if not columns[5].isdigit() or int(columns[5]) < 0:
+            data.validators.logger.warning('value error for population: %s', columns[5])
+            return False
+        return former_latlon(columns[1], columns[2])
+    for label, former, current, batch, items in (
+            ('entries', former_entry, data.validators.validate_entry, data.validators.mask_entries, names),
+            ('geonames rows', former_registry, data.validators.validate_geonames_registry, data.validators.mask_geonames_registry, rows)):
+        expected, former_time = timed(lambda: [former(item) for item in items])
+        result, current_time = timed(lambda: [current(item) for item in items])
+        mask, batch_time = timed(batch, items)
+        assert expected == result == mask
+        print('validators, {} {}: former {:.0f} lines/s, current {:.0f} lines/s ({:.1f}x), batch {:.0f} lines/s ({:.1f}x)'.format(
+            size, label, size/former_time, size/current_time, former_time/current_time, size/batch_time, former_time/batch_time))
+
+
+def bench_zipreader(size=1000000):
+    """Compare the former per-line reader on an in-memory archive and the block reader (size in lines, 10 million give about 1 GB)."""
+    import io
+    settings.FILTER_LEVEL = 'MINIMUM'
+    def former(filename):
+        # whole download in memory, one decoding and one quality control per line
+        with open(filename, 'rb') as inputfh:
+            result = inputfh.read()
+        accepted = 0
+        with zipfile.ZipFile(io.BytesIO(result)) as myzip:
+            with myzip.open('DE.txt') as myfile:
+                for line in myfile:
+                    accepted += data.geonames.quality_control(line.decode(), 'DE', dict())[1] is not None
+        return accepted
+    def current(filename):
+        accepted = 0
+        with zipfile.ZipFile(filename) as myzip:
+            with myzip.open('DE.txt') as myfile:
+                for lines in data.geonames.iterbatches(myfile):
+                    accepted += len(data.geonames.filter_lines(lines, 'DE', dict()))
+        return accepted
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, 'DE.zip')
+        write_dump(filename, size)
+        with zipfile.ZipFile(filename) as myzip:
+            uncompressed = myzip.getinfo('DE.txt').file_size
+        expected, former_peak = traced(former, filename)
+        result, current_peak = traced(current, filename)
+        assert result == expected
+        _, former_time = timed(former, filename)
+        _, current_time = timed(current, filename)
+    print('zipreader, {} lines ({:.0f} MB): BytesIO and lines {:.1f} MB peak {:.3f}s, blocks {:.1f} MB peak {:.3f}s'.format(
+        size, uncompressed/2**20, former_peak/2**20, former_time, current_peak/2**20, current_time))
+
+
+def bench_registers(size=20000):
+    """Compare loading a custom register with expansion and from the compiled cache (size in lines)."""
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = os.path.join(tempdir, 'register.tsv')
+        with open(filename, 'w', encoding='utf-8') as outfh:
+            for _ in range(size):
+                name = 'Ort' + ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 8)))
+                outfh.write('{}(en|heim)?;(Sankt|St\\.) {}\t{:.5f}\t{:.5f}\n'.format(name, name, rng.uniform(45, 55), rng.uniform(5, 15)))
+        cachedir = os.path.join(tempdir, 'cache')
+        expected, load_time = timed(data.load.load_tsv, filename)
+        _, compile_time = timed(data.load.load_tsv, filename, cachedir=cachedir)
+        result, cached_time = timed(data.load.load_tsv, filename, cachedir=cachedir)
+        assert result == expected
+    print('registers, {} lines, {} variants: expansion {:.3f}s, compilation {:.3f}s, cached {:.3f}s'.format(
+        size, len(expected), load_time, compile_time, cached_time))
+
+
+def bench_spill(size=1000000):
+    """Peak memory of the bounded ingestion into register files for growing dumps (size in lines)."""
+    settings.FILTER_LEVEL = 'MINIMUM'
+    with tempfile.TemporaryDirectory() as tempdir:
+        for lines in (size // 10, size):
+            filename = os.path.join(tempdir, 'allCountries.zip')
+            write_dump(filename, lines)
+            codesfile, metafile = os.path.join(tempdir, 'codes.dict'), os.path.join(tempdir, 'meta.dict')
+            _, peak = traced(data.ingest.ingest_files, filename, codesfile, metafile, workers=1, memory_limit=2**23)
+            _, elapsed = timed(data.ingest.ingest_files, filename, codesfile, metafile, workers=1, memory_limit=2**23)
+            _, dict_peak = traced(data.ingest.ingest, filename, workers=1)
+            print('spill, {} lines: ingest_files {:.1f} MB peak ({:.0f} lines/s), ingest to dicts {:.1f} MB peak'.format(
+                lines, peak/2**20, lines/elapsed, dict_peak/2**20))
+
+
+def bench_memo(size=1000000):
+    """Time a search on a text full of ambiguous names with and without disambiguation memo (size in tokens)."""
+    settings.FILTER_LEVEL = 'MINIMUM'
+    rng = random.Random(1)
+    metainfo, codesdict = dict(), dict()
+    for number in range(1000):
+        ids = [str(number * 10 + k) for k in range(rng.randint(2, 4))]
+        for nameid in ids:
+            metainfo[nameid] = [rng.uniform(40, 60), rng.uniform(0, 30), 'P', rng.choice(('AT', 'DE', 'FR')), rng.randint(0, 5000)]
+        codesdict['Ort{}'.format(number)] = ids
+    names = list(codesdict)
+    tokens = [rng.choice(names) if rng.random() < 0.1 else 'und' for _ in range(size)]
+    plain = geo.geocoding.Geocoder(codesdict, metainfo)
+    expected, plain_time = timed(plain.search, tokens)
+    memo = geo.geocoding.DisambiguationMemo()
+    cached = geo.geocoding.Geocoder(codesdict, metainfo, memo=memo)
+    result, memo_time = timed(cached.search, tokens)
+    assert result == expected
+    print('memo, {} tokens: without {:.3f}s, with {:.3f}s ({} hits, {} misses)'.format(
+        size, plain_time, memo_time, memo.hits, memo.misses))
+
+
+BENCHMARKS = {
+    'distances': bench_distances,
+    'filter': bench_filter,
+    'gazetteer': bench_gazetteer,
+    'ingest': bench_ingest,
+    'memo': bench_memo,
+    'metainfo': bench_metainfo,
+    'postings': bench_postings,
+    'readers': bench_readers,
+    'registers': bench_registers,
+    'spill': bench_spill,
+    'validators': bench_validators,
+    'zipreader': bench_zipreader,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all): ' + ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--size', type=int, help='number of items')
+    args = parser.parse_args()
+    random.seed(1)
+    for name in args.names or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: ' + name)
+        if args.size is not None:
+            BENCHMARKS[name](args.size)
+        else:
+            BENCHMARKS[name]()
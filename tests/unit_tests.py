@@ -3,10 +3,26 @@
 Unit tests for the library.
 """
 
+import bz2
+import concurrent.futures
+import gzip
+import http.server
+import io
+import json
 import logging
+import lzma
+import os
+import pickle
 import sys
+import tempfile
+import threading
+import time
+import zipfile
 
 from os import path
+from urllib.parse import parse_qs, urlparse
+
+import pytest
 
 # from geokelone import *
 from geokelone import data, geo, text #, settings
@@ -24,6 +40,17 @@ geokelone.settings.ROUNDING = 3
 def test_expand():
     assert data.load.expand('[VW]ien(na)?') == ['Vien', 'Vienna', 'Wien', 'Wienna']
     assert data.load.expand('(Außer|Über)au') == ['Außerau', 'Überau']
+    # capped expansion
+    assert data.load.expand(r'Sankt|St\.? ?[A-Z]\w*', limit=3) == ['Sankt', 'StA', 'StA0']
+    assert next(data.load.iterexpand(r'St\.? ?[A-Z]\w*')) == 'StA'
+    # patterns matched at lookup time
+    register = data.compact.PatternRegister()
+    register.add_pattern(r'Sankt|St\.? ?[A-Z]\w*', {'values': ('1', '2', 'Sankt'), 'level': 0})
+    register.add('Stadt', {'values': ('3', '4', 'Stadt'), 'level': 1})
+    register.add_pattern(r'Sta(d|t)t', {'values': ('5', '6', 'Statt'), 'level': 0})
+    register.add_pattern(r'Sankt(', {'values': ('7', '8', 'Sankt'), 'level': 0})
+    assert 'St. Xyz' in register and register['StAb']['values'][2] == 'Sankt' and 'Sa' not in register
+    assert register['Stadt']['values'] == ('5', '6', 'Statt') and list(register) == ['Stadt'] and len(register.patterns) == 2
 
 
 def test_store_variants():
@@ -39,6 +66,18 @@ def test_read():
     assert text.readfile.readtok(path.join(TEST_DIR, 'data/dummy-file.txt')) == []
     assert len(text.readfile.readtok(path.join(TEST_DIR, 'data/fontane-stechlin.tok'))) == 44
     assert len(text.readfile.readtagged(path.join(TEST_DIR, 'data/fontane-stechlin.tagged'))) == 4
+    # streaming and compressed input
+    inputfile = path.join(TEST_DIR, 'data/fontane-stechlin.txt')
+    assert list(text.readfile.iterplain(inputfile, blocksize=5)) == text.readfile.readplain(inputfile)
+    with tempfile.TemporaryDirectory() as tempdir:
+        for extension, module in (('.gz', gzip), ('.bz2', bz2), ('.xz', lzma)):
+            for original, reader in (('fontane-stechlin.txt', text.readfile.readplain), ('fontane-stechlin.tok', text.readfile.readtok), ('fontane-stechlin.tagged', text.readfile.readtagged)):
+                compressed = path.join(tempdir, original + extension)
+                with open(path.join(TEST_DIR, 'data', original), 'rb') as inputfh, module.open(compressed, 'wb') as outputfh:
+                    outputfh.write(inputfh.read())
+                assert reader(compressed) == reader(path.join(TEST_DIR, 'data', original))
+    tokens = text.readfile.itertagged(path.join(TEST_DIR, 'data/fontane-stechlin.tagged'))
+    assert not isinstance(tokens, list) and next(tokens) == 'Preußen'
 
 
 def custom_csv():
@@ -49,6 +88,9 @@ def custom_csv():
     customized = data.load.load_csv(registry)
     # test alternatives
     assert 'Atest' in customized and 'Btest' in customized
+    # without expansion
+    patterns = data.load.load_csv(registry, expand_variants=False)
+    assert isinstance(patterns, data.compact.PatternRegister) and all(patterns[name] == customized[name] for name in customized)
     return customized
 
 
@@ -60,9 +102,59 @@ def custom_tsv():
     customized = data.load.load_tsv(registry)
     # test alternatives
     assert 'Sankt Petersburg' in customized # and 'St. Petersburg' in customized
+    # compiled register
+    with tempfile.TemporaryDirectory() as tempdir:
+        assert data.load.load_tsv(registry, cachedir=tempdir) == customized and len(os.listdir(tempdir)) == 1
+        assert data.load.load_tsv(registry, cachedir=tempdir) == customized and len(os.listdir(tempdir)) == 1
+        geokelone.settings.MINLENGTH = 5
+        assert 'Berlin' in data.load.load_tsv(registry, cachedir=tempdir) and len(os.listdir(tempdir)) == 2
+        geokelone.settings.MINLENGTH = 4
+        # truncated or invalid cache files are rebuilt
+        for content in (b'', b'garbage', pickle.dumps(customized)[:20], b'cgeokelone.data.compact\nMissing\n.'):
+            for cachefile in os.listdir(tempdir):
+                with open(path.join(tempdir, cachefile), 'wb') as outfh:
+                    outfh.write(content)
+            assert data.load.load_tsv(registry, cachedir=tempdir) == customized
+        # rejections counted when the register is compiled
+        stats = data.validators.RejectionStats()
+        assert data.load.load_tsv(registry, level=1, cachedir=tempdir, stats=stats) and stats['unsuitable characters'] == 1
     return customized
 
 
+def test_register_set():
+    csvfile, tsvfile = path.join(TEST_DIR, 'data/dummy-registry.csv'), path.join(TEST_DIR, 'data/dummy-registry.tsv')
+    csvdict, tsvdict = data.load.load_csv(csvfile), data.load.load_tsv(tsvfile, level=1)
+    registers = data.registers.RegisterSet([(tsvfile, 1), csvfile])
+    assert registers['Berlin'] == {'values': ('1', '1.1', 'Berlin'), 'level': 1} and registers['Atest'] == csvdict['Atest']
+    assert len(registers) == len(set(csvdict) | set(tsvdict)) and registers.stats['kept'] == len(set(csvdict) & set(tsvdict))
+    # same level: the last register wins
+    override = {'Berlin': {'values': ('2', '2.2', 'Berlin'), 'level': 1}}
+    registers = data.registers.RegisterSet([(tsvfile, 1), override])
+    assert registers['Berlin']['values'] == ('2', '2.2', 'Berlin') and registers.stats['replaced'] == 1
+    # parallel loading
+    size, data.registers.PARALLEL_SIZE = data.registers.PARALLEL_SIZE, 0
+    try:
+        assert dict(data.registers.RegisterSet([(tsvfile, 1), csvfile], workers=2)) == dict(data.registers.RegisterSet([(tsvfile, 1), csvfile], workers=1))
+    finally:
+        data.registers.PARALLEL_SIZE = size
+    # search
+    tokens = text.readfile.readtok(path.join(TEST_DIR, 'data/fontane-stechlin.tok'))
+    assert sorted(geo.geocoding.search(tokens, dict(), dict(), data.registers.RegisterSet([csvfile]))) == ['Berlin', 'Petersburg', 'Preußen']
+    # pattern registers: regex entries are kept with the same precedence rules
+    patterns = data.compact.PatternRegister()
+    patterns.add_pattern(r'Sankt|St\.? ?[A-Z]\w*', {'values': ('3', '3.3', 'Sankt'), 'level': 1})
+    patterns.add('Berlin', {'values': ('3', '3.3', 'Berlin'), 'level': 0})
+    registers = data.registers.RegisterSet([(tsvfile, 1), patterns])
+    assert registers.patterns and registers['StIngbert']['values'] == ('3', '3.3', 'Sankt') and 'Stadt' not in registers
+    assert registers['Berlin'] == tsvdict['Berlin'] and registers.stats['kept'] == 1
+    registers = data.registers.RegisterSet([patterns, {'Sankt': {'values': ('4', '4.4', 'Sankt'), 'level': 1}}])
+    assert registers['Sankt']['values'] == ('4', '4.4', 'Sankt') and registers['St Ingbert']['values'] == ('3', '3.3', 'Sankt')
+    assert data.registers.RegisterSet([{'Sankt': {'values': ('4', '4.4', 'Sankt'), 'level': 1}}, patterns])['Sankt']['values'] == ('3', '3.3', 'Sankt')
+    assert not data.registers.RegisterSet([data.compact.PatternRegister()])
+    registers = data.registers.RegisterSet([patterns])
+    assert 'StIngbert' in geo.geocoding.search(['in', 'StIngbert', '.'], dict(), dict(), registers, matcher=geo.matching.TokenTrie(registers))['Sankt']
+
+
 def test_validate_entry():
     assert data.validators.validate_entry(' ') is False
     assert data.validators.validate_entry('Efghi!') is False
@@ -108,12 +200,43 @@ def test_data_validators():
     assert data.validators.validate_result(['6536007', '46.938', '11.442', 'X', 'YY', '2087', 'B', 'NULL', 2]) is False
     assert data.validators.validate_result(['6536007', '46.938', '11.442', 'X', 'YY', '2087', 'B B B B B', 'NULL', 2]) is False
 
+    # batch versions and rejection counters
+    data.validators.rejections.clear()
+    names = [' ', 'Efghi!', 'AAA BBB Ccc Dddd Ee', 'Amsterdam', 'Marcq-en-Barœul']
+    assert data.validators.mask_entries(names) == [data.validators.validate_entry(name) for name in names]
+    assert data.validators.mask_latlon(['0', '-90', '90.1', 'nan', 'X'], [0, '180', '0', '0', '0']) == [True, True, False, False, False]
+    assert data.validators.validate_latlon('nan', 0) is False
+    rows = [['2849119', '48.13333', '8.85', 'P', 'DE', '0'], ['2849119', '48.13333', '8.85'], ['2849119', 'G13', 'D10', 'P', 'DE', '0'], ['2849119', '1-2', '0', 'P', 'DE', '0'], ['2849119', '48.13333', '8.85', 'P', 'DE', '-10'], ['2849119', '148.1', '8.85', 'P', 'DE', '0']]
+    assert data.validators.mask_geonames_registry(rows) == [data.validators.validate_geonames_registry(row) for row in rows] == [True, False, False, False, False, False]
+    assert data.validators.rejections['entry too short'] == 2 and data.validators.rejections['unsuitable characters'] == 2 and data.validators.rejections['too many spaces'] == 2 and data.validators.rejections['geonames'] == 4 and data.validators.rejections['population'] == 2 and data.validators.rejections['coordinates'] == 8
+    # rejection statistics: counts, samples and merging
+    stats = data.validators.RejectionStats(samples=2)
+    assert data.validators.mask_tok(['A B', 'C D', 'E F', 'G'], stats) == [False, False, False, True]
+    assert data.validators.validate_latlon(100, 0, stats) is False
+    assert stats.summary() == {'token': {'count': 3, 'samples': ['A B', 'C D']}, 'coordinates': {'count': 1, 'samples': [(100, 0)]}}
+    other = pickle.loads(pickle.dumps(stats))
+    assert other == stats and other.samples == stats.samples and other.maxsamples == 2
+    stats.merge(other)
+    assert stats['token'] == 6 and stats.samples['token'] == ['A B', 'C D']
+    stats.clear()
+    assert not stats and stats.summary() == dict()
+    # loaders without statistics: counts added to the module ones
+    data.validators.rejections.clear()
+    data.load.load_tsv(path.join(TEST_DIR, 'data/dummy-registry.tsv'))
+    assert data.validators.rejections == {'unsuitable characters': 1}
+    stats = data.validators.RejectionStats()
+    data.load.load_tsv(path.join(TEST_DIR, 'data/dummy-registry.tsv'), stats=stats)
+    assert stats == data.validators.rejections == {'unsuitable characters': 1}
+    data.validators.rejections.clear()
+
 
 def test_text_validators():
     assert data.validators.validate_tok('Marcq-en-Barœul') is True
     assert data.validators.validate_tok('Marcq en Barœul') is False
     assert data.validators.validate_tagged('Token	NN	Token') is True
     assert data.validators.validate_tagged('Token	nn	Token') is False
+    assert data.validators.mask_tok(['Marcq-en-Barœul', 'Marcq en Barœul']) == [True, False]
+    assert data.validators.mask_tagged(['Token	NN	Token', 'Token	nn	Token']) == [True, False]
     assert data.validators.validate_tagged(',	$,	,') is True
     # assert data.validators.validate_text('') is True
 
@@ -132,6 +255,57 @@ def test_geonames_download():
     assert data.geonames.generate_urls(['fa', 'fi', 'fr']) == (['http://download.geonames.org/export/dump/FA.zip', 'http://download.geonames.org/export/dump/FI.zip', 'http://download.geonames.org/export/dump/FR.zip'], ['FA.txt', 'FI.txt', 'FR.txt'])
     data.geonames.filter_zipfile(path.join(TEST_DIR, 'data/VA.zip'), 'VA.txt', 'VA')
     assert len(data.geonames.metainfo) == 11
+    # streaming and parallel ingestion
+    zipped = path.join(TEST_DIR, 'data/VA.zip')
+    assert data.geonames.metainfo['6691831'] == data.ingest.ingest(zipped, workers=1)[1]['6691831']
+    codesdict, metainfo = data.ingest.ingest([zipped, zipped], ['VA', 'VA'], workers=2, chunksize=5)
+    assert len(metainfo) == 11 and metainfo == data.geonames.metainfo
+    stats = data.validators.RejectionStats()
+    assert data.ingest.ingest([zipped, zipped], workers=2, chunksize=5, stats=stats)[1] == metainfo
+    assert stats['duplicate'] == 11 and sum(stats.values()) > 11
+    assert all(isinstance(ids, set) for ids in codesdict.values())
+    assert len(data.ingest.ingest(zipped, ['IT'], workers=1)[1]) == 0
+    with tempfile.TemporaryDirectory() as tempdir:
+        textfile = path.join(tempdir, 'VA.txt')
+        with open(textfile, 'wb') as outfh:
+            outfh.writelines(data.ingest.iterlines(zipped))
+        assert data.ingest.ingest(textfile, workers=1) == (codesdict, metainfo)
+        # bounded memory: shards merged into register files
+        codesfile, metafile = path.join(tempdir, 'codes.dict'), path.join(tempdir, 'meta.dict')
+        data.ingest.ingest_files([zipped, textfile], codesfile, metafile, workers=1, memory_limit=5000, tempdir=tempdir)
+        reference_codes, reference_meta = path.join(tempdir, 'ref-codes.dict'), path.join(tempdir, 'ref-meta.dict')
+        data.geonames.writefile(codesdict, reference_codes)
+        data.geonames.writefile(metainfo, reference_meta)
+        with open(metafile, encoding='utf-8') as inputfh, open(reference_meta, encoding='utf-8') as reffh:
+            assert inputfh.read() == reffh.read()
+        loaded = data.load.geonames_codes(codesfile, data.load.geonames_meta(metafile))
+        assert {name: set(ids) for name, ids in loaded.items()} == {name: ids for name, ids in codesdict.items() if len(name) > 1}
+    # population values compared as numbers
+    assert data.geonames.is_duplicate('1', '10', {'1': ('0', '0', 'P', 'PPL', 'VA', '9')}) is True
+    assert data.geonames.is_duplicate('1', '9', {'1': ('0', '0', 'P', 'PPL', 'VA', 10)}) is False
+    line = '6691831	Vatican City	Vatican City		41.90268	12.45414	P	PPLC	VA		00				%s		55	Europe/Vatican	2018-01-01\n'
+    with tempfile.TemporaryDirectory() as tempdir:
+        textfile = path.join(tempdir, 'duplicates.txt')
+        with open(textfile, 'w', encoding='utf-8') as outfh:
+            outfh.write(line % '9' + line % '10')
+        metainfo = data.ingest.ingest(textfile, workers=1)[1]
+        assert metainfo['6691831'][-1] == '9'
+        codesfile, metafile = path.join(tempdir, 'codes.dict'), path.join(tempdir, 'meta.dict')
+        data.ingest.ingest_files(textfile, codesfile, metafile, workers=1, tempdir=tempdir)
+        with open(metafile, encoding='utf-8') as inputfh:
+            assert inputfh.read().rstrip('\n').split('\t')[-1] == '9'
+    # block reader: lines and characters split between blocks
+    sample = 'Außerau\tÜberau\n\nWien'.encode('utf-8')
+    assert [line for lines in data.geonames.iterbatches(io.BytesIO(sample), blocksize=3) for line in lines] == ['Außerau\tÜberau', '', 'Wien']
+    assert list(data.geonames.iterbatches(io.BytesIO(sample))) == [['Außerau\tÜberau', ''], ['Wien']]
+    with open(zipped, 'rb') as inputfh:
+        registers = dict(data.geonames.codesdict), dict(data.geonames.metainfo)
+        data.geonames.codesdict.clear()
+        data.geonames.metainfo.clear()
+        data.geonames.filter_zipfile(inputfh, 'VA.txt', 'VA', blocksize=100)
+        assert (data.geonames.codesdict, data.geonames.metainfo) == registers
+    # worldwide dumps
+    assert data.geonames.generate_urls(['allCountries', 'cities500']) == (['http://download.geonames.org/export/dump/allCountries.zip', 'http://download.geonames.org/export/dump/cities500.zip'], ['allCountries.txt', 'cities500.txt'])
 
 
 def test_geonames_filter():
@@ -164,6 +338,25 @@ def test_geonames_filter():
     result = data.geonames.quality_control('2867714	Munich	Munich	Monachium,Monaco di Baviera,München	48.13743	11.57549	P	PPLA	DE		02	091	09162	09162000	1260391		524	Europe/Berlin	2014-01-26')
     print(result)
     assert result is not None and result[0] == {'Monachium', 'Monaco di Baviera', 'München'}
+    stats = data.validators.RejectionStats()
+    line = '2867714	Munich	Munich	Mü,Monaco di Baviera,München!	48.13743	11.57549	P	PPLA	DE		02	091	09162	09162000	1260391		524	Europe/Berlin	2014-01-26'
+    assert data.geonames.quality_control(line, stats=stats)[0] == {'Monaco di Baviera'} and stats == {'entry too short': 1, 'unsuitable characters': 1}
+    assert data.geonames.filter_lines([line], stats=stats, seen=dict())[0][0] == {'Monaco di Baviera'} and stats == {'entry too short': 2, 'unsuitable characters': 2}
+    # batch filter: same decisions
+    lines = [line.decode('utf-8') for line in data.ingest.iterlines(path.join(TEST_DIR, 'data/VA.zip'))]
+    lines.extend(['\n', '		2.3	AAA	AAA	AAA	AAA	AAA	AAA	AAA	AAA	AAA	AAA	AAA	AAA	AAA', '2801074	Breitfeld	Breitfeld		50.26417	6.15389	P	PPL	BEL		WAL	WLG	63	63067	0		432	Europe/Brussels	2017-03-25', '2801074	Breitfeld	Breitfeld		nan	inf	P	PPL	BE		WAL	WLG	63	63067	0		432	Europe/Brussels	2017-03-25', '2867714	Munich	Munich	Monachium,Monaco di Baviera,München	48.13743	11.57549	P	PPLA	DE		02	091	09162	09162000	1260391		524	Europe/Berlin	2014-01-26'])
+    for level in ('MINIMUM', 'MAXIMUM'):
+        geokelone.settings.FILTER_LEVEL = level
+        for ccode in (None, 'VA'):
+            expected = [result for result in (data.geonames.quality_control(line, ccode, dict()) for line in lines) if result[1] is not None]
+            assert data.geonames.filter_lines(lines, ccode, dict()) == expected and expected
+            # same rejection statistics
+            expected_stats, stats = data.validators.RejectionStats(), data.validators.RejectionStats()
+            for line in lines:
+                data.geonames.quality_control(line, ccode, dict(), expected_stats)
+            data.geonames.filter_lines(lines, ccode, dict(), stats)
+            assert stats == expected_stats and stats['malformed'] > 0
+    geokelone.settings.FILTER_LEVEL = 'MINIMUM'
 
 
 def test_geonames_store():
@@ -189,6 +382,158 @@ def test_geonames_store():
     assert data.geonames.quality_control('2801074	Breitfeld	Breitfeld	Breitfeld,Breitfelds	50.26417	6.15389	P	PPL	BE		WAL	WLG	63	63067	0		432	Europe/Brussels	2017-03-25') == (None, None, None)
 
 
+def test_store_precompute():
+    infotuple = ('2801074', '50.26417', '6.15389', 'P', 'BE', '432')
+    register = dict()
+    data.geonames.store_metainfo(infotuple, register=register)
+    assert geo.geocoding.reference_cache.lookup('2801074', register['2801074']) is None
+    data.geonames.store_metainfo(infotuple, precompute=True, register=register)
+    assert geo.geocoding.reference_cache.lookup('2801074', register['2801074']) is not None
+    geo.geocoding.reference_cache.clear()
+
+
+def test_alternates():
+    rows = [
+        ('1', '2867714', 'de', 'München', '1', '', '', '', '', ''),
+        ('2', '2867714', 'de', 'Minga', '', '', '1', '', '', ''),
+        ('3', '2867714', 'it', 'Monaco di Baviera', '', '', '', '', '', ''),
+        ('4', '554234', 'de', 'Königsberg', '', '', '', '1', '', ''),
+        ('5', '554234', 'de', 'Kbg.', '', '1', '', '', '', ''),
+        ('6', '2950159', 'de', 'Berlin', '', '', '', '', '', ''),
+        ('7', '2950159', 'link', 'https://de.wikipedia.org/wiki/Berlin', '', '', '', '', '', ''),
+        ('8', '6553047', 'de', 'Stadt Aachen', '', '', '', '', '', ''),
+        ('9', '2867714', 'de', 'München', '', '', '', '', '', ''),
+    ]
+    with tempfile.TemporaryDirectory() as tempdir:
+        filename = path.join(tempdir, 'alternateNamesV2.zip')
+        with zipfile.ZipFile(filename, 'w') as myzip:
+            myzip.writestr('alternateNamesV2.txt', ''.join('\t'.join(row) + '\n' for row in rows))
+            myzip.writestr('iso-languagecodes.txt', 'ISO 639-3\n')
+        assert list(data.alternates.iteralternates(filename, 'DE')) == [('2867714', 'München'), ('554234', 'Königsberg'), ('554234', 'Kbg.'), ('2950159', 'Berlin'), ('6553047', 'Stadt Aachen'), ('2867714', 'München')]
+        assert [name for _, name in data.alternates.iteralternates(filename, 'de', historic=False, colloquial=True, short=False)] == ['München', 'Minga', 'Berlin', 'Stadt Aachen', 'München']
+        assert data.alternates.load_alternates(filename, language='it') == {'Monaco di Baviera': ['2867714']}
+        # merged into existing registers, restricted to known entries
+        metainfo = data.load.geonames_meta(path.join(TEST_DIR, 'data/dummy-geonames-meta.dict'))
+        codesdict = data.load.geonames_codes(path.join(TEST_DIR, 'data/dummy-geonames-codes.dict'), metainfo)
+        data.alternates.load_alternates(filename, metainfo, codesdict, language='de')
+        assert codesdict['Stadt Aachen'] == ['6553047'] and 'Berlin' not in codesdict
+        assert geo.geocoding.search(['Stadt', 'Aachen'], codesdict, metainfo) == {'6553047': ['50.776', '6.087', 'A', 'DE', '244951', 'Stadt Aachen', 'NULL', 1]}
+        # compact postings
+        table = data.alternates.load_alternates(filename, compact=True, language='de')
+        assert dict(table) == {'Berlin': ['2950159'], 'Kbg.': ['554234'], 'Königsberg': ['554234'], 'München': ['2867714'], 'Stadt Aachen': ['6553047']}
+        assert len(data.compact.PostingsBuilder().build()) == 0
+
+
+def test_geonames_update():
+    geokelone.settings.FILTER_LEVEL = 'MINIMUM'
+    zipped = path.join(TEST_DIR, 'data/VA.zip')
+    lines = [line.decode('utf-8') for line in data.ingest.iterlines(zipped)]
+    modified = {
+        # new coordinates and names
+        '6691831': '6691831\tVatican City\tVatican City\tVaticano,Vatikan,Vatikanstaat\t41.9027\t12.4541\tP\tPPLC\tVA\t\t\t\t\t\t829\t\t55\tEurope/Vatican\t2019-01-02\n',
+        # refused type
+        '6696760': '6696760\tVatican Radio\tVatican Radio\tRadio Vaticana\t41.90189\t12.44834\tS\tRSTN\tVA\t\t\t\t\t\t0\t\t0\tEurope/Vatican\t2019-01-02\n',
+        # new entry
+        '9999999': '9999999\tGiardini Vaticani\tGiardini Vaticani\tVatican Gardens\t41.9039\t12.4508\tL\tPRK\tVA\t\t\t\t\t\t0\t\t60\tEurope/Vatican\t2019-01-02\n',
+    }
+    with tempfile.TemporaryDirectory() as tempdir:
+        modfile, delfile = path.join(tempdir, 'modifications-2019-01-02.txt'), path.join(tempdir, 'deletes-2019-01-02.txt')
+        with open(modfile, 'w', encoding='utf-8') as outfh:
+            outfh.writelines(modified.values())
+        with open(delfile, 'w', encoding='utf-8') as outfh:
+            outfh.write('7289974\tPiazza Pio XII\tduplicate\n')
+        # expected: dump with changes
+        dumpfile = path.join(tempdir, 'VA.txt')
+        with open(dumpfile, 'w', encoding='utf-8') as outfh:
+            outfh.writelines(modified.pop(line.split('\t')[0], line) for line in lines if not line.startswith('7289974\t'))
+            outfh.writelines(modified.values())
+        expected_codes, expected_meta = data.ingest.ingest(dumpfile, workers=1)
+        # registers in memory
+        codesdict, metainfo = data.ingest.ingest(zipped, workers=1)
+        changes = data.update.read_changes(modfile, delfile)
+        assert changes['7289974'] is None and changes['6696760'] is None
+        index = data.update.reverse_index(codesdict)
+        assert data.update.apply_changes(changes, codesdict, metainfo, index=index) == {'6691831', '6696760', '9999999', '7289974'}
+        assert (codesdict, metainfo) == (expected_codes, expected_meta)
+        assert {nameid: set(names) for nameid, names in index.items()} == {nameid: set(names) for nameid, names in data.update.reverse_index(codesdict).items()}
+        # same result without a prepared index
+        codesdict, metainfo = data.ingest.ingest(zipped, workers=1)
+        data.update.apply_changes(changes, codesdict, metainfo)
+        assert (codesdict, metainfo) == (expected_codes, expected_meta)
+        # files, no duplicate lines
+        codesfile, metafile = path.join(tempdir, 'codes.dict'), path.join(tempdir, 'meta.dict')
+        original_codes, original_meta = data.ingest.ingest(zipped, workers=1)
+        for _ in range(2):
+            data.geonames.writefile(original_codes, codesfile)
+            data.geonames.writefile(original_meta, metafile)
+        data.update.update_files(codesfile, metafile, changes)
+        reference = path.join(tempdir, 'reference.dict')
+        data.geonames.writefile(expected_meta, reference)
+        with open(metafile, encoding='utf-8') as inputfh, open(reference, encoding='utf-8') as reffh:
+            assert inputfh.read() == reffh.read()
+        loaded = data.load.geonames_codes(codesfile, data.load.geonames_meta(metafile))
+        assert {name: set(ids) for name, ids in loaded.items()} == {name: ids for name, ids in expected_codes.items() if len(name) > 1}
+        # database backend
+        with data.database.SqliteGazetteer(path.join(tempdir, 'va.sqlite')) as backend:
+            data.ingest.ingest(zipped, backend=backend, workers=1)
+            data.update.apply_changes(changes, backend=backend)
+            assert sorted(backend.metainfo) == sorted(expected_meta) and sorted(backend.codesdict) == sorted(expected_codes)
+
+
+def test_database():
+    geokelone.settings.FILTER_LEVEL = 'MINIMUM'
+    metainfo = data.load.geonames_meta(path.join(TEST_DIR, 'data/dummy-geonames-meta.dict'))
+    codes = data.load.geonames_codes(path.join(TEST_DIR, 'data/dummy-geonames-codes.dict'), metainfo)
+    with tempfile.TemporaryDirectory() as tempdir:
+        # copy of existing registers
+        with data.database.SqliteGazetteer(path.join(tempdir, 'gazetteer.sqlite'), cache_size=2) as backend:
+            backend.update(codes, metainfo)
+            assert len(backend.codesdict) == 5 and len(backend.metainfo) == 9
+            assert backend.codesdict['Valwig'] == ['6553731', '2817894'] and 'Valwi' not in backend.codesdict
+            assert backend.metainfo['3247449'] == (50.77664, 6.08342, 'P', 'DE', 265208) and '1' not in backend.metainfo
+            tokens = ['Aachen', 'Mörsfeld', ',', 'Öderquarter', 'Moor', 'XXX', 'Reichenbach', 'am', 'Heuberg', '.']
+            assert sorted(geo.geocoding.search(tokens, backend.codesdict, backend.metainfo)) == sorted(geo.geocoding.search(tokens, codes, metainfo))
+            assert backend.codesdict.cache.hits > 0 and len(backend.codesdict.cache.data) == 2
+            # one connection per thread and per process
+            expected = geo.geocoding.search(tokens, backend.codesdict, backend.metainfo)
+            with concurrent.futures.ThreadPoolExecutor(4) as executor:
+                futures = [executor.submit(geo.geocoding.Geocoder(backend.codesdict, backend.metainfo).search, tokens) for _ in range(8)]
+                assert all(future.result() == expected for future in futures)
+            copied = pickle.loads(pickle.dumps(backend.codesdict))
+            assert copied['Valwig'] == ['6553731', '2817894'] and copied.connection is not backend.codesdict.connection
+            inputfile = path.join(tempdir, 'tokens.txt')
+            with open(inputfile, 'w', encoding='utf-8') as outfh:
+                outfh.write('\n'.join(tokens) + '\n')
+            assert geo.geocoding.search_corpus([inputfile] * 2, backend.codesdict, backend.metainfo, workers=2) == geo.geocoding.search_corpus([inputfile] * 2, backend.codesdict, backend.metainfo, workers=1)
+        # filtered entries, batch inserts
+        with data.database.SqliteGazetteer(path.join(tempdir, 'va.sqlite'), batch_size=5) as backend:
+            data.geonames.filter_zipfile(path.join(TEST_DIR, 'data/VA.zip'), 'VA.txt', 'VA', backend)
+            assert len(backend.metainfo) == 11 and not backend.pending_meta
+            assert all(backend.codesdict[name][0] in backend.metainfo for name in backend.codesdict)
+        # duplicate IDs within a batch: same decisions as with the registers in memory
+        line = '6691831	%s	%s		41.90268	12.45414	P	PPLC	VA		00				%s		55	Europe/Vatican	2018-01-01\n'
+        zipped = path.join(tempdir, 'duplicates.zip')
+        with zipfile.ZipFile(zipped, 'w') as myzip:
+            myzip.writestr('VA.txt', line % ('Vatican City', 'Vatican City', '10') + line % ('Citta del Vaticano', 'Citta del Vaticano', '9') + line % ('Vatikanstadt', 'Vatikanstadt', '20'))
+        registers = dict(data.geonames.codesdict), dict(data.geonames.metainfo)
+        data.geonames.codesdict.clear()
+        data.geonames.metainfo.clear()
+        try:
+            data.geonames.filter_zipfile(zipped, 'VA.txt', 'VA')
+            with data.database.SqliteGazetteer(path.join(tempdir, 'duplicates.sqlite')) as backend:
+                data.geonames.filter_zipfile(zipped, 'VA.txt', 'VA', backend)
+                assert backend.metainfo['6691831'][-1] == int(data.geonames.metainfo['6691831'][-1]) == 9
+                assert sorted(backend.codesdict) == sorted(data.geonames.codesdict) == ['Citta del Vaticano', 'Vatican City']
+                # entries already in the database
+                data.geonames.filter_zipfile(zipped, 'VA.txt', 'VA', backend)
+                assert backend.metainfo['6691831'][-1] == 9 and len(backend.seen) == 1
+        finally:
+            data.geonames.codesdict.clear()
+            data.geonames.metainfo.clear()
+            data.geonames.codesdict.update(registers[0])
+            data.geonames.metainfo.update(registers[1])
+
+
 def test_tagged():
     # setup
     inputfile = path.join(TEST_DIR, 'data/fontane-stechlin.tagged')
@@ -200,6 +545,24 @@ def test_tagged():
     results = geo.geocoding.search(splitted, dict(), dict(), custom_tsv())
     assert len(results) == 3
     assert 'Berlin' in results and 'Petersburg' in results and 'Preußen' in results
+    patterns = data.load.load_tsv(path.join(TEST_DIR, 'data/dummy-registry.tsv'), expand_variants=False)
+    assert geo.geocoding.search(splitted, dict(), dict(), patterns) == results
+    customized = custom_tsv()
+    matcher = geo.matching.TokenTrie(customized)
+    assert geo.geocoding.search(splitted, dict(), dict(), customized, matcher=matcher) == results
+    # names only found by a pattern of the register
+    register = data.compact.PatternRegister()
+    register.add_pattern(r'Sankt|St\.? ?[A-Z]\w*', {'values': ('1', '1.1', 'Sankt'), 'level': 0})
+    tokens = ['in', 'StBerlin', 'und', 'St', 'Ingbert', '.']
+    expected = geo.geocoding.search(tokens, dict(), dict(), register)
+    assert expected['Sankt'][5] == 'StBerlin' and expected['Sankt'][-1] == 2
+    matcher = geo.matching.TokenTrie(dict(), register)
+    assert ['StBerlin'] in matcher and matcher.prefixes(['St', 'Ingbert', 'und']) == [2]
+    # lookups are not counted as rejections
+    data.validators.rejections.clear()
+    assert 'a' not in register and 'x$y' not in register and not data.validators.rejections
+    assert geo.geocoding.search(tokens, dict(), dict(), register, matcher=matcher) == expected
+    assert geo.geocoding.search(tokens, dict(), dict(), register, matcher=matcher, mode='longest') == geo.geocoding.search(tokens, dict(), dict(), register, mode='longest')
 
 
 def test_tok():
@@ -215,11 +578,146 @@ def test_tok():
     assert 'Berlin' in results and 'Petersburg' in results and 'Preußen' in results
 
 
+def test_corpus():
+    inputfiles = [path.join(TEST_DIR, 'data/fontane-stechlin.tok'), path.join(TEST_DIR, 'data/dummy-file.txt'), path.join(TEST_DIR, 'data/fontane-stechlin.tok')]
+    customized = custom_csv()
+    # serial run: documents one after the other
+    tokens = list()
+    for inputfile in inputfiles:
+        tokens.extend(text.readfile.readtok(inputfile))
+        tokens.append('XXX')
+    expected = geo.geocoding.search(tokens, dict(), dict(), customized)
+    assert expected['Berlin'][-1] == 2 * geo.geocoding.search(text.readfile.readtok(inputfiles[0]), dict(), dict(), customized)['Berlin'][-1]
+    assert geo.geocoding.search_corpus(inputfiles, dict(), dict(), customized, workers=2) == expected
+    assert geo.geocoding.search_corpus(inputfiles, dict(), dict(), customized, workers=1) == expected
+    # in-process search: no worker state left, concurrent calls are independent
+    assert geo.geocoding._worker_geocoder is None
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(geo.geocoding.search_corpus, inputfiles, dict(), dict(), register, workers=1) for register in (customized, dict()) * 3]
+        assert all(future.result() == (expected if number % 2 == 0 else dict()) for number, future in enumerate(futures))
+    results = geo.geocoding.search_corpus([path.join(TEST_DIR, 'data/fontane-stechlin.tagged')] * 2, dict(), dict(), customized, reader=text.readfile.itertagged, workers=2)
+    assert sorted(results) == ['Berlin', 'Petersburg', 'Preußen']
+    # merge
+    assert geo.geocoding.merge_results([{'1': ['A', 1]}, {'1': ['B', 2], '2': ['C', 1]}]) == {'1': ['A', 3], '2': ['C', 1]}
+
+
 def test_utils():
     assert data.utils.send_request('http://www.iana.org/404') is None
     assert type(data.utils.send_request('http://www.iana.org/', returnbytes=True)) == bytes
 
 
+class StubCacheHandler(http.server.BaseHTTPRequestHandler):
+    """Serve versioned content with an ETag."""
+    version = 1
+    requests = list()
+
+    def do_GET(self):
+        etag = '"v%s"' % self.version
+        self.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = ('%s version %s' % (self.path, self.version)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_response_cache():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubCacheHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    base = 'http://127.0.0.1:%s/' % server.server_address[1]
+    try:
+        with tempfile.TemporaryDirectory() as tempdir:
+            data.utils.cache = data.utils.ResponseCache(tempdir)
+            assert data.utils.send_request(base + 'a') == '/a version 1'
+            assert data.utils.send_request(base + 'a', returnbytes=True) == b'/a version 1'
+            assert len(StubCacheHandler.requests) == 1
+            # expired: conditional request, not modified then modified
+            data.utils.cache.ttl = 0
+            output = io.BytesIO()
+            assert data.utils.download(base + 'a', output) is True and output.getvalue() == b'/a version 1'
+            assert StubCacheHandler.requests[-1] == ('/a', '"v1"')
+            StubCacheHandler.version = 2
+            assert data.utils.send_request(base + 'a') == '/a version 2'
+            # offline mode
+            data.utils.cache.offline = True
+            assert data.utils.send_request(base + 'a') == '/a version 2'
+            assert data.utils.send_request(base + 'b') is None
+            assert len(StubCacheHandler.requests) == 3
+            # eviction of the least recently used entries
+            data.utils.cache = data.utils.ResponseCache(tempdir, max_size=30)
+            data.utils.send_request(base + 'b')
+            data.utils.send_request(base + 'c')
+            assert data.utils.cache.lookup(base + 'a') is None and data.utils.cache.lookup(base + 'c') is not None
+            assert len(os.listdir(path.join(tempdir, 'objects'))) == 2
+            assert data.utils.cache.total == 24 and len(data.utils.cache.index) == 2
+            # hits do not rewrite the entries
+            entryfile = data.utils.cache.entry_path(base + 'c')
+            modified = os.stat(entryfile).st_mtime_ns
+            data.utils.cache.offline = True
+            assert data.utils.send_request(base + 'c') == '/c version 2' and os.stat(entryfile).st_mtime_ns == modified
+            # interrupted download: no temporary body left
+            class Interrupted(object):
+                encoding, headers = 'utf-8', dict()
+                def iter_content(self, chunk_size):
+                    yield b'part'
+                    raise IOError('connection lost')
+            with pytest.raises(IOError):
+                data.utils.cache.store(base + 'd', Interrupted(), io.BytesIO())
+            assert len(os.listdir(path.join(tempdir, 'objects'))) == 2
+    finally:
+        data.utils.cache = None
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+class StubSlowHandler(http.server.BaseHTTPRequestHandler):
+    """Answer after a delay."""
+    def do_GET(self):
+        time.sleep(0.5)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(b'late')
+
+    def log_message(self, *args):
+        pass
+
+
+def test_request_timeout():
+    # no TLS version forced on the connections
+    assert all(not isinstance(adapter, data.utils.requests.adapters.HTTPAdapter) or 'ssl_version' not in adapter.poolmanager.connection_pool_kw for adapter in data.utils.session.adapters.values())
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubSlowHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = 'http://127.0.0.1:%s/' % server.server_address[1]
+    timeout, geokelone.settings.TIMEOUT = geokelone.settings.TIMEOUT, 0.1
+    try:
+        assert data.utils.send_request(url) is None
+        assert data.utils.download(url, io.BytesIO()) is False
+        with tempfile.TemporaryDirectory() as tempdir:
+            data.utils.cache = data.utils.ResponseCache(tempdir)
+            assert data.utils.send_request(url) is None
+        geokelone.settings.TIMEOUT = 5
+        data.utils.cache = None
+        assert data.utils.send_request(url) == 'late'
+    finally:
+        geokelone.settings.TIMEOUT = timeout
+        data.utils.cache = None
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
 def test_geonames():
     # setup
     geokelone.settings.FILTER_LEVEL = 'MINIMUM'
@@ -247,6 +745,89 @@ def test_geonames():
     results = geo.geocoding.search(['It', 'was', 'in', 'Reichenbach', 'am', 'Heuberg', '.'], codes, metainfo)
     assert len(results) == 1 and '6555850' in results
 
+    ## trie-based matching
+    matcher = geo.matching.TokenTrie(codes)
+    assert len(matcher) == 5 and matcher.depth == 3
+    assert ['Reichenbach', 'am', 'Heuberg'] in matcher and ['Reichenbach', 'am'] not in matcher
+    assert matcher.prefixes(['Öderquarter', 'Moor', 'Aachen']) == [2]
+    tokens = ['Aachen', 'Valwig', ',', 'Öderquarter', 'Moor', 'XXX', 'Reichenbach', 'am', 'Heuberg', 'Mörsfeld', '.']
+    expected = geo.geocoding.search(tokens, codes, metainfo)
+    assert len(expected) == 5
+    assert geo.geocoding.search(tokens, codes, metainfo, matcher=matcher) == expected
+    assert geo.geocoding.search(iter(tokens), codes, metainfo, matcher=matcher, mode='longest') == expected
+    assert geo.geocoding.search(tokens, codes, metainfo, mode='longest') == expected
+    # longest chain from the left vs. chains ending at each token
+    test_codesdict = {'Aaaaa Bbbbb': ['1'], 'Bbbbb Ccccc': ['2']}
+    test_metainfo = {'1': ['1', '1', 'P', 'DE', '1'], '2': ['2', '2', 'P', 'DE', '2']}
+    matcher = geo.matching.TokenTrie(test_codesdict)
+    assert list(geo.geocoding.search(['Aaaaa', 'Bbbbb', 'Ccccc'], test_codesdict, test_metainfo, matcher=matcher)) == ['1']
+    assert list(geo.geocoding.search(['Aaaaa', 'Bbbbb', 'Ccccc'], test_codesdict, test_metainfo, matcher=matcher, mode='longest')) == ['1']
+    assert list(geo.geocoding.search(['Xxxxx', 'Bbbbb', 'Ccccc'], test_codesdict, test_metainfo, matcher=matcher, mode='longest')) == ['2']
+
+    ## columnar store
+    table = data.load.geonames_meta(path.join(TEST_DIR, 'data/dummy-geonames-meta.dict'), compact=True)
+    assert isinstance(table, data.compact.MetaInfoTable)
+    assert len(table) == 9 and sorted(table) == sorted(metainfo)
+    assert table['3247449'] == (50.77664, 6.08342, 'P', 'DE', 265208) and table[3247449][4] == 265208
+    assert '1' not in table and 'AAA' not in table
+    assert table.nbytes < 300
+    assert data.compact.MetaInfoTable.from_dict(metainfo)['2858070'] == table['2858070']
+    # same output once written to a file (populations are compared as numbers, not as strings)
+    expected = geo.geocoding.search(tokens[2:], codes, metainfo)
+    results = geo.geocoding.search(tokens[2:], codes, table)
+    assert {k: [str(v) for v in values] for k, values in results.items()} == {k: [str(v) for v in values] for k, values in expected.items()}
+    assert '2817894' in geo.geocoding.search(['Valwig'], codes, table)
+    # duplicates: last row wins
+    duplicates = data.compact.MetaInfoTable.from_rows([('2', '1.5', '1', 'P', 'DE', '10'), ('1', '0', '0', '', 'FR', '0'), ('2', '2.5', '2', 'A', 'AT', '20')])
+    assert list(duplicates) == ['1', '2'] and duplicates['2'] == (2.5, 2.0, 'A', 'AT', 20) and duplicates['1'][2] == ''
+
+    ## integer postings
+    postings = data.load.geonames_codes(path.join(TEST_DIR, 'data/dummy-geonames-codes.dict'), metainfo, compact=True)
+    assert isinstance(postings, data.compact.CodesTable) and dict(postings) == codes
+    assert postings['Valwig'] == ['6553731', '2817894'] and 'Valwi' not in postings and postings.postings.dtype == 'int64'
+    assert geo.geocoding.search(tokens, postings, metainfo) == geo.geocoding.search(tokens, codes, metainfo)
+    assert dict(data.compact.CodesTable.from_dict({'Aachen': {'3247449'}, 'Valwig': ['2', '1', '2']})) == {'Aachen': ['3247449'], 'Valwig': ['2', '1']}
+
+    ## binary gazetteer
+    with tempfile.TemporaryDirectory() as tempdir:
+        gazetteer = path.join(tempdir, 'gazetteer.bin')
+        data.binary.write_gazetteer(gazetteer, codes, metainfo)
+        mapped_codes, mapped_meta = data.binary.load_gazetteer(gazetteer)
+        assert len(mapped_codes) == 5 and list(mapped_codes) == sorted(codes)
+        assert mapped_codes['Valwig'] == ['6553731', '2817894'] and 'Valwig' in mapped_codes and 'Valwi' not in mapped_codes
+        assert dict(mapped_meta) == dict(table)
+        expected = geo.geocoding.search(tokens, codes, table)
+        assert geo.geocoding.search(tokens, mapped_codes, mapped_meta) == expected
+        assert geo.geocoding.search(tokens, mapped_codes, mapped_meta, matcher=geo.matching.TokenTrie(mapped_codes)) == expected
+        # compiled from dictionaries as well as from tables
+        data.binary.write_gazetteer(gazetteer, {'Öderquarter Moor': {'2858070'}}, {'2858070': (53.767, 9.25, 'H', 'DE', '0')})
+        mapped_codes, mapped_meta = data.binary.load_gazetteer(gazetteer)
+        assert dict(mapped_codes) == {'Öderquarter Moor': ['2858070']} and mapped_meta['2858070'] == (53.767, 9.25, 'H', 'DE', 0)
+        with open(gazetteer, 'wb') as outfh:
+            outfh.write(b'0' * 1000)
+        with pytest.raises(ValueError):
+            data.binary.load_gazetteer(gazetteer)
+
+    ## precomputed distances
+    inputfile = path.join(TEST_DIR, 'data/dummy-geonames-meta.dict')
+    metainfo = data.load.geonames_meta(inputfile, precompute=True)
+    cache = geo.geocoding.reference_cache
+    assert cache.is_current() and len(cache.entries) == 9
+    assert cache.lookup('3247449', metainfo['3247449'])[0] == geo.geocoding.reference_distance(*metainfo['3247449'][:2])
+    assert cache.lookup('3247449', ['0', '0', 'P', 'DE', '0']) is None
+    test_metainfo = {'1': ['51.0', '12.0', 'P', 'DE', 500], '2': ['40.0', '3.0', 'P', 'DE', 600]}
+    cache.precompute(test_metainfo)
+    assert geo.geocoding.disambiguate(['1', '2'], 1, test_metainfo) == '1'
+    # values are used as they are
+    cache.entries['1'] = cache.entries['1'][:3] + (100000.0, False)
+    assert geo.geocoding.disambiguate(['1', '2'], 1, test_metainfo) == '2'
+    # invalidation
+    geokelone.settings.FILTER_LEVEL = 'MEDIUM'
+    assert not cache.is_current()
+    assert geo.geocoding.disambiguate(['1', '2'], 1, test_metainfo) == '1'
+    geokelone.settings.FILTER_LEVEL = 'MINIMUM'
+    cache.clear()
+
     ##filter level
     geokelone.settings.FILTER_LEVEL = 'MAXIMUM'
     metainfo = {}
@@ -267,6 +848,7 @@ def test_wikipedia():
     continuecode, newmembers = data.wikipedia.parse_json_response(jsonresponse)
     assert continuecode is None
     assert newmembers == []
+    assert data.wikipedia.parse_json_response('{"continue": {"cmcontinue": "page|2"}, "query": {"categorymembers": [{"ns": 0, "title": "Liste von Orten"}, {"ns": 0, "title": "Ort (Begriffsklärung)"}, {"ns": 0, "title": "\\"Ort\\""}]}}') == ('page|2', ['"Ort"'])
     # correct response
     jsonresponse = data.utils.send_request('https://en.wikipedia.org/w/api.php?action=query&list=categorymembers&format=json&cmlimit=500&cmtitle=Category:Countries_in_Micronesia')
     continuecode, newmembers = data.wikipedia.parse_json_response(jsonresponse)
@@ -274,6 +856,75 @@ def test_wikipedia():
     assert newmembers == ['Federated States of Micronesia', 'Kiribati', 'Marshall Islands', 'Nauru', 'Northern Mariana Islands', 'Palau', 'Category:Kiribati', 'Category:Marshall Islands', 'Category:Federated States of Micronesia', 'Category:Nauru', 'Category:Palau']
 
 
+class StubAPIHandler(http.server.BaseHTTPRequestHandler):
+    """Answer coordinates queries like the Wikipedia API."""
+    places = {'Wien': (48.20833, 16.37306), 'Berlin': (52.51861, 13.40833)}
+    queries = list()
+
+    categories = {
+        'Category:Städte': [[('Wien', 0), ('Category:Hauptstädte', 14)], [('Liste der Städte', 0), ('Berlin', 0)]],
+        'Category:Hauptstädte': [[('Berlin', 0), ('Paris', 0), ('Category:Städte', 14)]],
+    }
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        if params.get('list') == ['categorymembers']:
+            pages = self.categories[params['cmtitle'][0]]
+            number = int(params.get('cmcontinue', ['0'])[0])
+            response = {'query': {'categorymembers': [{'ns': ns, 'title': title} for title, ns in pages[number]]}}
+            if number + 1 < len(pages):
+                response['continue'] = {'cmcontinue': str(number + 1), 'continue': '-||'}
+            return self.reply(response)
+        titles = params['titles'][0].split('|')
+        self.queries.append(titles)
+        normalized = [{'from': title, 'to': title.capitalize()} for title in titles if title != title.capitalize()]
+        pages = dict()
+        for number, title in enumerate(titles):
+            title = title.capitalize()
+            pages[str(number)] = {'title': title}
+            if title in self.places:
+                pages[str(number)]['coordinates'] = [{'lat': self.places[title][0], 'lon': self.places[title][1], 'primary': ''}]
+        self.reply({'query': {'normalized': normalized, 'pages': pages}})
+
+    def reply(self, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_harvesting():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubAPIHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    api_url = 'http://127.0.0.1:%s/{}/api.php' % server.server_address[1]
+    try:
+        names = ['Wien', 'Atlantis', 'berlin', 'Wien', 'Berlin']
+        results = data.wikipedia.harvest_coordinates(names, language='de', workers=2, batchsize=2, api_url=api_url)
+        assert results == [('Wien', 48.208, 16.373), ('Atlantis', None, None), ('berlin', 52.519, 13.408), ('Wien', 48.208, 16.373), ('Berlin', 52.519, 13.408)]
+        assert sorted(StubAPIHandler.queries) == [['Berlin'], ['Wien', 'Atlantis'], ['berlin', 'Wien']]
+        assert data.wikipedia.find_coordinates_batch(['Atlantis'], api_url=api_url) == {'Atlantis': (None, None)}
+        # categories: continuation, depth and cycles
+        assert list(data.wikipedia.iter_category('Category:Städte', api_url=api_url)) == ['Wien', 'Category:Hauptstädte', 'Berlin']
+        members = data.wikipedia.iter_category('Category:Städte', depth=2, api_url=api_url)
+        assert data.wikipedia.harvest_coordinates(members, workers=2, batchsize=2, api_url=api_url) == [('Wien', 48.208, 16.373), ('Berlin', 52.519, 13.408), ('Paris', None, None)]
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    # rate limit shared by all threads
+    limiter = data.wikipedia.RateLimiter(rate=50)
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda _: limiter.wait(), range(11)))
+    assert time.monotonic() - start >= 0.2
+
+
 def test_distances():
     assert geo.geocoding.haversine((53.4, 1.2), (53.4, 1.2)) == 0.0
     assert geo.geocoding.haversine((53.4, 1.2), (61, 10.53)) == 1012.7688
@@ -281,6 +932,16 @@ def test_distances():
     assert geo.geocoding.vincenty((53.4, 1.2), (53.4, 1.2)) == 0.0
     assert geo.geocoding.vincenty((53.4, 1.2), (61, 10.53)) == 1014.90503
     assert geo.geocoding.vincenty((-53.466666, 1), (61, -3.33333)) == 12697.86368
+    assert geo.geocoding.haversine((10, 10), (20, 20)) > 0
+    # vectorized
+    points1 = [(53.4, 1.2), (53.4, 1.2), (-53.466666, 1)]
+    points2 = [(53.4, 1.2), (61, 10.53), (61, -3.33333)]
+    assert geo.geocoding.haversine_many(points1, points2).tolist() == [0.0, 1012.7688, 12733.90603]
+    assert geo.geocoding.vincenty_many(points1, points2).tolist() == [0.0, 1014.90503, 12697.86368]
+    assert geo.geocoding.haversine_many((53.4, 1.2), points2).tolist() == [0.0, 1012.7688, geo.geocoding.haversine((53.4, 1.2), (61, -3.33333))]
+    # nearly antipodal points: fallback
+    assert geo.geocoding.vincenty((0, 0), (0.5, 179.7)) is None
+    assert geo.geocoding.vincenty_many((0, 0), [(0.5, 179.7)]).tolist() == [geo.geocoding.haversine((0, 0), (0.5, 179.7))]
 
 
 def test_geofind():
@@ -375,6 +1036,48 @@ def test_rounds():
     assert geo.geocoding.disambiguating_rounds('AAA', test_codesdict, test_metainfo) is None
 
 
+def test_geocoder():
+    test_metainfo = {'1': [52.5, 13.4, 'P', 'ZZ', 500], '2': [48.2, 16.4, 'P', 'ZZ', 500]}
+    test_codesdict = {'Neustadt': ['1', '2']}
+    tokens = ['In', 'Neustadt', 'und', 'Neustadt', '.'] * 500
+    module_results = geo.geocoding.results
+    berlin = geo.geocoding.Geocoder(test_codesdict, test_metainfo, setting='Berlin')
+    vienna = geo.geocoding.Geocoder(test_codesdict, test_metainfo, setting='Vienna')
+    # concurrent jobs with different settings
+    threads = [threading.Thread(target=geocoder.search, args=(tokens,)) for geocoder in (berlin, vienna)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert list(berlin.results) == ['1'] and berlin.results['1'][-1] == 1000
+    assert list(vienna.results) == ['2'] and vienna.results['2'][-1] == 1000
+    assert geo.geocoding.results is module_results
+    # reuse
+    assert berlin.search(['Neustadt']) == {'1': [52.5, 13.4, 'P', 'ZZ', 500, 'Neustadt', 'NULL', 1]}
+    berlin.reset()
+    assert berlin.results == dict() and berlin.failures == 0
+    with pytest.raises(ValueError):
+        geo.geocoding.Geocoder(test_codesdict, test_metainfo, mode='shortest')
+    # memo shared between settings
+    memo = geo.geocoding.DisambiguationMemo(maxsize=2, fingerprint='test')
+    berlin = geo.geocoding.Geocoder(test_codesdict, test_metainfo, setting='Berlin', memo=memo)
+    vienna = geo.geocoding.Geocoder(test_codesdict, test_metainfo, setting='Vienna', memo=memo)
+    assert berlin.search(tokens[:10])['1'][-1] == 4 and memo.misses == 1 and memo.hits == 3
+    assert list(vienna.search(tokens[:10])) == ['2'] and len(memo) == 2
+    # candidates changed
+    test_codesdict['Neustadt'] = ['2', '1']
+    assert list(berlin.search(['Neustadt'])) == ['1'] and memo.misses == 3
+    # persistence
+    with tempfile.TemporaryDirectory() as tempdir:
+        memofile = path.join(tempdir, 'memo.json')
+        memo.save(memofile)
+        restored = geo.geocoding.DisambiguationMemo.load(memofile, fingerprint='test')
+        assert restored.data == memo.data
+        assert len(geo.geocoding.DisambiguationMemo.load(memofile, fingerprint='other')) == 0
+    memo.clear()
+    assert len(memo) == 0 and memo.hits == 0
+
+
 def test_results():
     # setup
     inputfile = path.join(TEST_DIR, 'data/dummy-results.tsv')
@@ -436,6 +1139,7 @@ if __name__ == '__main__':
     test_geonames_download()
     test_geonames_filter()
     test_geonames_store()
+    test_store_precompute()
     test_geonames()
     test_wikipedia()
 